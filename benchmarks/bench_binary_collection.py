@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+# Time to first book and per-ISBN lookup latency for a collection file:
+# full load_from_text versus opening the mmapped binary file and decoding
+# only the requested records. Building the UserBook (and its note, tag and
+# collection-name rows) is reported apart from the raw record decode.
+# Usage: bench_binary_collection.py [-n 100000] [-l 10000]
+
+
+import os
+import sys
+import argparse
+import random
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+from bench_text_export import build_collection
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help='Books in the collection file.')
+    parser.add_argument('-l', '--lookups', type=int, default=10000,
+                        help='Random ISBN lookups against the binary file.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    book_collection = build_collection(args.number)
+    isbns = random.sample(list(book_collection), min(args.lookups, args.number))
+    with tempfile.TemporaryDirectory() as folder:
+        text_path = os.path.join(folder, 'collection.txt')
+        binary_path = os.path.join(folder, 'collection.bwc')
+        book_collection.save_to_text(text_path)
+        save = timeit.timeit(lambda: book_collection.save_to_binary(binary_path), number=1)
+        loaded = bookwarm.BookCollection('bench user', 'bench collection', None)
+        text_load = timeit.timeit(lambda: loaded.load_from_text(text_path), number=1)
+        binary_load = timeit.timeit(lambda: loaded.load_from_binary(binary_path), number=1)
+        binary_open = timeit.timeit(lambda: bookwarm.BinaryCollection(binary_path).close(),
+                                    number=100) / 100
+        with bookwarm.BinaryCollection(binary_path) as binary_collection:
+            decodes = timeit.timeit(lambda: [binary_collection.fields(isbn) for isbn in isbns],
+                                    number=1)
+            lookups = timeit.timeit(lambda: [binary_collection[isbn] for isbn in isbns],
+                                    number=1)
+        print('{} books: text {:.1f} MB, binary {:.1f} MB'.format(
+            args.number, os.path.getsize(text_path) / 1024 / 1024,
+            os.path.getsize(binary_path) / 1024 / 1024))
+    print('save_to_binary           {:10.3f} s'.format(save))
+    print('load_from_text           {:10.3f} s'.format(text_load))
+    print('load_from_binary         {:10.3f} s'.format(binary_load))
+    print('open mmapped file        {:10.1f} us'.format(binary_open * 1e6))
+    print('random ISBN fields()     {:10.1f} us'.format(decodes / len(isbns) * 1e6))
+    print('random ISBN [] UserBook  {:10.1f} us'.format(lookups / len(isbns) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
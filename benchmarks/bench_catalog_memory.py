@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+# Bytes per book held by the server catalog: ORM Book instances loaded
+# through a session versus compact BookRecord tuples, measured with
+# tracemalloc.  Usage: bench_catalog_memory.py [-n 1000000]
+
+
+import os
+import sys
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+from bench_isbn_lookup import populate
+
+
+def measure(load):
+    tracemalloc.start()
+    books = load()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return books, size
+
+
+def load_orm(database_path):
+    with bookwarm.SQLSession(database_path) as session:
+        return session.query(bookwarm.Book).all()
+
+
+def load_records(database_path):
+    with bookwarm.SQLSession(database_path) as session:
+        return bookwarm.BookRecord.load_all(session)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=1000000,
+                        help='Books in the catalog.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    with tempfile.TemporaryDirectory() as folder:
+        database_path = os.path.join(folder, 'bench_memory.db')
+        populate(database_path, args.number)
+        print('{:>12}  {:>10}  {:>14}'.format('catalog', 'MiB', 'bytes/book'))
+        for name, load in (('ORM Book', load_orm), ('BookRecord', load_records)):
+            books, size = measure(lambda: load(database_path))
+            print('{:>12}  {:10.1f}  {:14.1f}'.format(name, size / 2 ** 20, size / len(books)))
+            del books
+
+
+if __name__ == '__main__':
+    main()
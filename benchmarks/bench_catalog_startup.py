@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# Server start-up cost of the available-books catalog: hydrating every row
+# from SQLite into a BookCatalog versus reopening the mmapped catalog file,
+# plus per-ISBN lookup latency of each against Book.by_isbn. The indexes the
+# server builds at every start are timed too: the tag index over all ISBNs,
+# and the search index loaded from its saved file or rebuilt when stale.
+# Usage: bench_catalog_startup.py [-n 1000000] [-l 10000]
+
+
+import os
+import sys
+import random
+import argparse
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+import bookwarm_search
+from bench_isbn_lookup import populate
+
+
+def load_from_database(database_path):
+    with bookwarm.SQLSession(database_path) as session:
+        return bookwarm.BookCatalog(bookwarm.BookRecord.load_all(session))
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=1000000,
+                        help='Books in the catalog.')
+    parser.add_argument('-l', '--lookups', type=int, default=10000,
+                        help='Random ISBN lookups per catalog.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    isbns = [1000000000 + number for number in
+             random.sample(range(args.number), min(args.lookups, args.number))]
+    with tempfile.TemporaryDirectory() as folder:
+        database_path = os.path.join(folder, 'bench_catalog.db')
+        catalog_path = os.path.join(folder, 'bench_catalog.catalog')
+        populate(database_path, args.number)
+        database_load = timeit.timeit(lambda: load_from_database(database_path), number=1)
+        catalog = load_from_database(database_path)
+        mapped_catalog = bookwarm.MappedBookCatalog(catalog_path)
+        build = timeit.timeit(lambda: mapped_catalog.load(catalog), number=1)
+        mapped_catalog.close()
+        reopen = timeit.timeit(lambda: bookwarm.MappedBookCatalog(catalog_path).close(),
+                               number=1)
+        mapped_catalog = bookwarm.MappedBookCatalog(catalog_path, writable=False)
+        tag_index = timeit.timeit(lambda: bookwarm.TagIndex(
+            (isbn, ()) for isbn in mapped_catalog.isbns()), number=1)
+        search_index = None
+
+        def rebuild_search_index():
+            nonlocal search_index
+            search_index = bookwarm_search.InvertedIndex(mapped_catalog)
+
+        search_rebuild = timeit.timeit(rebuild_search_index, number=1)
+        search_path = os.path.join(folder, 'bench_catalog.search.json')
+        search_index.save(search_path)
+        search_load = timeit.timeit(lambda: bookwarm_search.InvertedIndex.load(search_path),
+                                    number=1)
+        mapped_catalog.close()
+        with bookwarm.SQLSession(database_path) as session:
+            stamp = timeit.timeit(lambda: bookwarm.Book.catalog_stamp(session), number=1)
+            orm_lookups = timeit.timeit(lambda: [bookwarm.Book.by_isbn(session, isbn)
+                                                 for isbn in isbns], number=1)
+        mapped_catalog = bookwarm.MappedBookCatalog(catalog_path, writable=False)
+        dict_lookups = timeit.timeit(lambda: [catalog[isbn] for isbn in isbns], number=1)
+        mapped_lookups = timeit.timeit(lambda: [mapped_catalog[isbn] for isbn in isbns],
+                                       number=1)
+        mapped_catalog.close()
+        print('{} books, catalog file {:.1f} MB'.format(
+            args.number, (os.path.getsize(catalog_path) +
+                          os.path.getsize(catalog_path + '.idx')) / 1024 / 1024))
+    print('start: load rows from SQLite   {:10.3f} s'.format(database_load))
+    print('start: reopen catalog file     {:10.3f} s'.format(reopen))
+    print('start: SQLite stamp check      {:10.3f} s'.format(stamp))
+    print('start: build tag index         {:10.3f} s'.format(tag_index))
+    print('start: load saved search index {:10.3f} s'.format(search_load))
+    print('start: rebuild search index    {:10.3f} s'.format(search_rebuild))
+    print('rebuild catalog file           {:10.3f} s'.format(build))
+    print('lookup Book.by_isbn            {:10.1f} us'.format(orm_lookups / len(isbns) * 1e6))
+    print('lookup in-memory BookCatalog   {:10.1f} us'.format(dict_lookups / len(isbns) * 1e6))
+    print('lookup mapped catalog file     {:10.1f} us'.format(mapped_lookups / len(isbns) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+# Latency of deleting one user's collection by (user, collection_name) as
+# the number of collections owned by other users grows.
+# Usage: bench_collection_delete.py [-s 1000 10000 ...]
+
+
+import os
+import sys
+import argparse
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+
+
+def populate(database_path, size):
+    bookwarm.setup_database(database_path)
+    rows = [dict(user='user {}'.format(number % 1000),
+                 collection_name='collection {}'.format(number)) for number in range(size)]
+    with bookwarm.SQLSession(database_path) as session:
+        session.execute(bookwarm.BookCollection.__table__.insert(), rows)
+        session.commit()
+
+
+def delete_collection(database_path, number):
+    with bookwarm.SQLSession(database_path) as session:
+        session.add(bookwarm.BookCollection('bench user', 'bench {}'.format(number), None))
+        session.commit()
+        bookwarm.BookCollection.delete_by_name(session, 'bench user', 'bench {}'.format(number))
+        session.commit()
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000],
+                        help='Collections owned by other users.')
+    parser.add_argument('-d', '--deletes', type=int, default=200,
+                        help='Create/delete rounds per size.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    print('{:>10}  {:>22}'.format('collections', 'create+delete ms/op'))
+    with tempfile.TemporaryDirectory() as folder:
+        for size in args.sizes:
+            database_path = os.path.join(folder, 'bench_{}.db'.format(size))
+            populate(database_path, size)
+            elapsed = timeit.timeit(lambda: [delete_collection(database_path, number)
+                                             for number in range(args.deletes)], number=1)
+            print('{:>10}  {:22.3f}'.format(size, elapsed * 1000 / args.deletes))
+
+
+if __name__ == '__main__':
+    main()
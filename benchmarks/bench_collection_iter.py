@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+# Per-pass cost of iterating a BookCollection in ISBN order: re-sorting the
+# backing dict every pass versus the cached sorted key view.
+# Usage: bench_collection_iter.py [-s 10000 100000] [-p 20]
+
+
+import os
+import sys
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+
+
+def build_collection(size):
+    book_collection = bookwarm.BookCollection('bench user', 'bench collection', None)
+    # insert in a scrambled order so the sort has real work to do
+    for number in range(size):
+        isbn = 1000000000 + (number * 7919) % size
+        book_collection[isbn] = bookwarm.Book.trusted(isbn, 'title', 'author', 'genre',
+                                                      100, 2000)
+    return book_collection
+
+
+def resorted_pass(book_collection):
+    # what __iter__ used to do on every pass
+    for isbn in sorted(book_collection._BookCollection__book_collection):
+        pass
+
+
+def cached_pass(book_collection):
+    for isbn in book_collection:
+        pass
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[10000, 100000],
+                        help='Books per collection.')
+    parser.add_argument('-p', '--passes', type=int, default=20,
+                        help='Iteration passes per size.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    print('{:>10}  {:>16}  {:>16}  {:>8}'.format('books', 're-sort ns/key',
+                                                 'cached ns/key', 'speedup'))
+    for size in args.sizes:
+        book_collection = build_collection(size)
+        list(book_collection)
+        resorted = timeit.timeit(lambda: resorted_pass(book_collection), number=args.passes)
+        cached = timeit.timeit(lambda: cached_pass(book_collection), number=args.passes)
+        per_key = 1e9 / (size * args.passes)
+        print('{:>10}  {:16.1f}  {:16.1f}  {:7.2f}x'.format(
+            size, resorted * per_key, cached * per_key, resorted / cached))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+# Cost of a change to a stored collection: rewriting the whole snapshot per
+# change versus appending one journal entry, and the time to open a
+# collection from a snapshot plus a long journal (replay scan, then one
+# UserBook built per surviving book).
+# Usage: bench_collection_journal.py [-n 100000] [-j 1000000]
+
+
+import os
+import sys
+import random
+import argparse
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+from bench_text_export import build_collection
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help='Books in the collection snapshot.')
+    parser.add_argument('-j', '--journal', type=int, default=1000000,
+                        help='Journal entries written after the snapshot.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    book_collection = build_collection(args.number)
+    books = list(book_collection.values())
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'collection.bwc')
+        rewrite = timeit.timeit(lambda: book_collection.save_to_binary(path), number=1)
+        journal = bookwarm.CollectionJournal(path, compact_size=2 ** 62)
+        journal.open()
+        changes = [random.choice(books) for _ in range(args.journal)]
+        append = timeit.timeit(lambda: [journal.update(book) for book in changes], number=1)
+        journal.close()
+        journal_size = os.path.getsize(path + '.journal')
+        scan = timeit.timeit(lambda: bookwarm._scan_journal(
+            open(path + '.journal', 'rb').read(), {}), number=1)
+        reopened = bookwarm.BookCollection('bench user', 'bench collection', None)
+        replay = timeit.timeit(lambda: reopened.open_journal(path), number=1)
+        compact = timeit.timeit(lambda: reopened.compact_journal(wait=True), number=1)
+        reopened.close_journal()
+    print('{} books, {} journal entries ({:.1f} MB)'.format(
+        args.number, args.journal, journal_size / 1024 / 1024))
+    print('change by snapshot rewrite   {:10.1f} ms'.format(rewrite * 1e3))
+    print('change by journal append     {:10.1f} us'.format(append / args.journal * 1e6))
+    print('journal scan + checksums     {:10.3f} s'.format(scan))
+    print('open_journal (full replay)   {:10.3f} s'.format(replay))
+    print('compact_journal              {:10.3f} s'.format(compact))
+
+
+if __name__ == '__main__':
+    main()
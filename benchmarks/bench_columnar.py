@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# Reporting queries over a collection: Python loops over
+# BookCollection.values() versus the vectorized ColumnarBooks view.
+# Usage: bench_columnar.py [-n 500000]
+
+
+import os
+import sys
+import argparse
+import collections
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+from bookwarm_columnar import ColumnarBooks
+
+
+GENRES = ('scifi', 'drama', 'poetry', 'crime', 'history')
+
+
+def build_collection(count):
+    books = {}
+    for number in range(count):
+        book = bookwarm.UserBook.trusted(
+            isbn=1000000000 + number, title='title {}'.format(number),
+            author='author {}'.format(number % 5000), genre=GENRES[number % len(GENRES)],
+            no_of_pages=100 + number % 900, year_published=1950 + number % 70,
+            rating=number % 6)
+        books[book.isbn] = book
+    return bookwarm.BookCollection('bench user', 'bench', books)
+
+
+def loop_queries(book_collection):
+    matches = [book.isbn for book in book_collection.values()
+               if book.genre == 'scifi' and 1990 <= book.year_published <= 2000
+               and book.rating >= 4]
+    pages = collections.Counter()
+    ratings = collections.defaultdict(list)
+    for book in book_collection.values():
+        pages[book.genre] += book.no_of_pages
+        ratings[book.author].append(book.rating)
+    mean_rating = {author: sum(values) / len(values) for author, values in ratings.items()}
+    return matches, pages, mean_rating
+
+
+def columnar_queries(columns):
+    return (columns.filter(genre='scifi', year_published=(1990, 2000), rating=(4, None)),
+            columns.sum_by('no_of_pages', by='genre'),
+            columns.mean_by('rating', by='author'))
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=500000,
+                        help='Books in the collection.')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Query rounds per path.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    book_collection = build_collection(args.number)
+    build = timeit.timeit(lambda: ColumnarBooks.from_collection(book_collection), number=1)
+    columns = ColumnarBooks.from_collection(book_collection)
+    loops = timeit.timeit(lambda: loop_queries(book_collection), number=args.repeat)
+    vectorized = timeit.timeit(lambda: columnar_queries(columns), number=args.repeat)
+    print('books: {}  columnar build: {:.3f} s'.format(args.number, build))
+    print('python loops: {:9.2f} ms/round'.format(loops * 1000 / args.repeat))
+    print('columnar:     {:9.2f} ms/round  ({:.0f}x)'.format(vectorized * 1000 / args.repeat,
+                                                            loops / vectorized))
+
+
+if __name__ == '__main__':
+    main()
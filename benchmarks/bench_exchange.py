@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+# JSON Lines and CSV exchange for a collection of tagged, annotated
+# UserBooks: export throughput, and import parsed in this process versus
+# chunked over a process pool.
+# Usage: bench_exchange.py [-n 100000] [-w 4]
+
+
+import os
+import sys
+import argparse
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+from bench_text_export import build_collection
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help='Books in the collection.')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Process pool size, all cores by default.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    book_collection = build_collection(args.number)
+    loaded = bookwarm.BookCollection('bench user', 'bench collection', None)
+    print('{:>6}  {:>9}  {:>14}  {:>16}  {:>16}'.format(
+        'format', 'MB', 'export MB/s', 'import 1 proc/s', 'import pool/s'))
+    with tempfile.TemporaryDirectory() as folder:
+        for fmt in bookwarm.EXCHANGE_FORMATS:
+            path = os.path.join(folder, 'collection.{}'.format(fmt))
+            save = getattr(book_collection, 'save_to_' + fmt)
+            load = getattr(loaded, 'load_from_' + fmt)
+            export = timeit.timeit(lambda: save(path), number=1)
+            size = os.path.getsize(path) / 1024 / 1024
+            serial = timeit.timeit(lambda: load(path, max_workers=0), number=1)
+            pooled = timeit.timeit(lambda: load(path, max_workers=args.workers), number=1)
+            print('{:>6}  {:9.1f}  {:14.1f}  {:16.0f}  {:16.0f}'.format(
+                fmt, size, size / export, args.number / serial, args.number / pooled))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+# Objects/sec for validated construction (__init__) versus the trusted
+# fast path (Book.trusted / UserBook.trusted).
+# Usage: bench_hydration.py [-n 100000]
+
+
+import os
+import sys
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+
+
+def book_rows(count):
+    return [dict(isbn=1000000000 + number, title='title {}'.format(number),
+                 author='author {}'.format(number % 1000), genre='genre',
+                 no_of_pages=100 + number % 900, year_published=1900 + number % 100,
+                 edition=1 + number % 3, publisher='publisher') for number in range(count)]
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help='Books built per path.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    rows = book_rows(args.number)
+    print('{:>10}  {:>16}  {:>16}  {:>8}'.format('class', 'validated obj/s',
+                                                 'trusted obj/s', 'speedup'))
+    for cls in (bookwarm.Book, bookwarm.UserBook):
+        validated = timeit.timeit(lambda: [cls(**row) for row in rows], number=1)
+        trusted = timeit.timeit(lambda: [cls.trusted(**row) for row in rows], number=1)
+        print('{:>10}  {:16,.0f}  {:16,.0f}  {:7.2f}x'.format(
+            cls.__name__, args.number / validated, args.number / trusted, validated / trusted))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+# Lookup cost of Book.by_isbn (indexed) versus the old full-table scan
+# as the catalog grows.  Usage: bench_isbn_lookup.py [-s 1000 10000 ...]
+
+
+import os
+import sys
+import random
+import argparse
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+
+
+def populate(database_path, size):
+    bookwarm.setup_database(database_path)
+    columns = bookwarm.Book.__table__.c
+    rows = [{columns['_Book__isbn'].key: 1000000000 + number,
+             columns['_Book__title'].key: 'title {}'.format(number),
+             columns['_Book__author'].key: 'author {}'.format(number % 1000),
+             columns['_Book__genre'].key: 'genre',
+             columns['_Book__no_of_pages'].key: 100,
+             columns['_Book__edition'].key: 1,
+             columns['_Book__year_published'].key: 2000,
+             columns['_Book__publisher'].key: '',
+             columns['type'].key: 'book'} for number in range(size)]
+    with bookwarm.SQLSession(database_path) as session:
+        session.execute(bookwarm.Book.__table__.insert(), rows)
+        session.commit()
+
+
+def scan_lookup(database_path, isbn):
+    with bookwarm.SQLSession(database_path) as session:
+        for book in session.query(bookwarm.Book).all():
+            if book.isbn == isbn:
+                return book
+
+
+def indexed_lookup(database_path, isbn):
+    with bookwarm.SQLSession(database_path) as session:
+        return bookwarm.Book.by_isbn(session, isbn)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000],
+                        help='Catalog sizes to measure.')
+    parser.add_argument('-l', '--lookups', type=int, default=200,
+                        help='Indexed lookups per size.')
+    parser.add_argument('--scan-limit', type=int, default=10000,
+                        help='Largest catalog to run the full scan on.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    print('{:>10}  {:>16}  {:>16}'.format('books', 'indexed ms/op', 'scan ms/op'))
+    with tempfile.TemporaryDirectory() as folder:
+        for size in args.sizes:
+            database_path = os.path.join(folder, 'bench_{}.db'.format(size))
+            populate(database_path, size)
+            isbns = [1000000000 + random.randrange(size) for _ in range(args.lookups)]
+            indexed = timeit.timeit(lambda: [indexed_lookup(database_path, isbn)
+                                             for isbn in isbns], number=1)
+            scan = '-'
+            if size <= args.scan_limit:
+                scan_isbns = isbns[:5]
+                scan = '{:16.3f}'.format(timeit.timeit(
+                    lambda: [scan_lookup(database_path, isbn) for isbn in scan_isbns],
+                    number=1) * 1000 / len(scan_isbns))
+            print('{:>10}  {:16.3f}  {:>16}'.format(size, indexed * 1000 / len(isbns), scan))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+# TagIndex at catalog scale: building it the way the server does at start-up
+# (every isbn, most with no tags), single inserts afterwards, and one page of
+# an AND query, a broad OR query and a NOT-only query.
+# Usage: bench_tag_index.py [-n 1000000] [-t 50] [-p 100]
+
+
+import os
+import sys
+import random
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=1000000,
+                        help='ISBNs in the index.')
+    parser.add_argument('-t', '--tags', type=int, default=50,
+                        help='Distinct tags; a tenth of the books carry one or two.')
+    parser.add_argument('-p', '--page-size', type=int, default=100,
+                        help='ISBNs per query page.')
+    return parser.parse_args()
+
+
+def build_tagged(number, tags):
+    random.seed(number)
+    isbns = random.sample(range(1000000000, 9999999999), number)
+    tag_names = ['tag{}'.format(tag_no) for tag_no in range(tags)]
+    return [(isbn, set(random.sample(tag_names, random.randint(1, 2)))
+                   if isbn % 10 == 0 else ())
+            for isbn in isbns]
+
+
+def main():
+    args = get_args()
+    tagged = build_tagged(args.number, args.tags)
+    tag_index = None
+
+    def build():
+        nonlocal tag_index
+        tag_index = bookwarm.TagIndex(tagged)
+
+    build_time = timeit.timeit(build, number=1)
+    new_isbns = range(10000000000, 10000010000)
+    insert = timeit.timeit(lambda: [tag_index.set_tags(isbn, ('new',)) for isbn in new_isbns],
+                           number=1)
+    queries = (('AND tag0 tag1', dict(all_of=['tag0', 'tag1'])),
+               ('OR all tags', dict(any_of=['tag{}'.format(tag) for tag in range(args.tags)])),
+               ('NOT-only -tag0', dict(none_of=['tag0'])))
+    print('{} isbns, {} tags'.format(args.number, args.tags))
+    print('build                        {:10.3f} s'.format(build_time))
+    print('set_tags (new isbn)          {:10.1f} us'.format(insert / len(new_isbns) * 1e6))
+    for name, query in queries:
+        first = timeit.timeit(lambda: tag_index.page(limit=args.page_size, **query), number=1)
+        repeat = timeit.timeit(lambda: tag_index.page(limit=args.page_size, **query),
+                               number=10) / 10
+        print('{:28} {:10.1f} ms first, {:.1f} ms again'.format(
+            'page of ' + name, first * 1e3, repeat * 1e3))
+
+
+if __name__ == '__main__':
+    main()
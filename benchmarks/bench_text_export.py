@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+# Throughput of BookCollection.save_to_text against the previous
+# format-per-book writer, on a collection of tagged, annotated UserBooks.
+# Usage: bench_text_export.py [-n 100000]
+
+
+import os
+import sys
+import argparse
+import collections
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+
+
+def build_collection(count):
+    books = {}
+    for number in range(count):
+        isbn = 1000000000 + number
+        in_collections = collections.defaultdict(list)
+        in_collections['bench user'].extend(['bench collection', 'shelf {}'.format(number % 10)])
+        books[isbn] = bookwarm.UserBook.trusted(
+            isbn, 'title {}'.format(number), 'author {}'.format(number % 1000), 'genre',
+            100 + number % 900, 1900 + number % 100, 1 + number % 3, 'publisher',
+            notes=['first note on {}'.format(number), 'second note'],
+            in_collections=in_collections, tags={'tag{}'.format(number % 7), 'bench'})
+    return bookwarm.BookCollection('bench user', 'bench collection', books)
+
+
+def legacy_save(book_collection, path):
+    with open(path, 'w') as fh:
+        for book in book_collection.values():
+            in_collections = ''
+            for user in book.in_collections:
+                in_collections += '  {}: {}'.format(
+                    user, ','.join(collection_name
+                                   for collection_name in book.in_collections[user]))
+            fh.write('[{0.isbn}]\n'
+                     '\ttitle={0.title}\n'
+                     '\tauthor={0.author}\n'
+                     '\tgenre={0.genre}\n'
+                     '\tno_of_pages={0.no_of_pages}\n'
+                     '\tyear_published={0.year_published}\n'
+                     '\tedition={0.edition}\n'
+                     '\tpublisher={0.publisher}\n'
+                     '\tread={0.read}\n'
+                     '\tread_date={0.read_date}\n'
+                     '\trating={0.rating}\n'
+                     '\ttags={tags}\n'
+                     '\tin_collections={in_collections}\n'
+                     '\tNOTES>\n'
+                     '\t\t{notes}\n'
+                     '\t<NOTES\n\n'.format(book,
+                                              tags=' '.join(book.tags),
+                                              in_collections=in_collections.strip(),
+                                              notes='\n\t\t'.join(('{}'.format(line)
+                                                                   for line in book.notes))))
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help='Books in the exported collection.')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Best of this many runs.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    book_collection = build_collection(args.number)
+    with tempfile.TemporaryDirectory() as folder:
+        legacy_path = os.path.join(folder, 'legacy.txt')
+        streaming_path = os.path.join(folder, 'streaming.txt')
+        legacy = min(timeit.repeat(lambda: legacy_save(book_collection, legacy_path),
+                                   number=1, repeat=args.repeat))
+        streaming = min(timeit.repeat(lambda: book_collection.save_to_text(streaming_path),
+                                      number=1, repeat=args.repeat))
+        megabytes = os.path.getsize(streaming_path) / 1024 / 1024
+        with open(legacy_path, 'rb') as legacy_file, open(streaming_path, 'rb') as streaming_file:
+            identical = legacy_file.read() == streaming_file.read()
+    print('{} books, {:.1f} MB, identical output: {}'.format(args.number, megabytes, identical))
+    print('{:>10}  {:>8}  {:>8}'.format('writer', 'seconds', 'MB/s'))
+    for name, elapsed in (('legacy', legacy), ('streaming', streaming)):
+        print('{:>10}  {:8.3f}  {:8.1f}'.format(name, elapsed, megabytes / elapsed))
+
+
+if __name__ == '__main__':
+    main()
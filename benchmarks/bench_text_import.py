@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# Parsing a saved text collection: the previous pyparsing grammar (whole
+# file in memory) against the streaming iter_text_books scanner, in books/s
+# and peak traced memory. Needs pyparsing for the legacy column.
+# Usage: bench_text_import.py [-n 20000]
+
+
+import os
+import sys
+import argparse
+import warnings
+import collections
+import tempfile
+import timeit
+import tracemalloc
+
+from pyparsing import (Suppress, Word, OneOrMore, Regex, restOfLine, ZeroOrMore,
+                       alphas, nums)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+from bench_text_export import build_collection
+
+
+def legacy_parse(path):
+    # grammar and parse actions of the former BookCollection._parse_text
+    def set_book_key(tokens):
+        nonlocal current_key
+        current_key = tokens.isbn[0]
+        parsed_books[current_key]['isbn'] = int(current_key)
+
+    def add_book_attr(tokens):
+        parsed_books[current_key][tokens[0].strip()] = tokens[1].strip()
+
+    def add_notes(tokens):
+        parsed_books[current_key]['notes'] = list(tokens)
+
+    with open(path, encoding='utf-8') as fh:
+        text = fh.read()
+    parsed_books = collections.defaultdict(dict)
+    current_key = ''
+    r_bracket, l_bracket, equals, r_arrow, l_arrow = map(Suppress, '][=><')
+    book_start = (l_bracket + Word(nums) + r_bracket)('isbn')
+    book_start.addParseAction(set_book_key)
+    key_value = Word(alphas + '_') + equals + restOfLine()
+    key_value.addParseAction(add_book_attr)
+    notes_identifier = Suppress('NOTES')
+    notes = (notes_identifier + r_arrow + ZeroOrMore(Regex(r'\w+')) + l_arrow +
+             notes_identifier)
+    notes.addParseAction(add_notes)
+    OneOrMore(book_start + OneOrMore(key_value) + notes).parseString(text, parseAll=True)
+    return len(parsed_books)
+
+
+def streaming_parse(path):
+    with open(path, encoding='utf-8') as fh:
+        return sum(1 for _ in bookwarm.iter_text_books(fh))
+
+
+def measure(parse, path):
+    elapsed = timeit.timeit(lambda: parse(path), number=1)
+    tracemalloc.start()
+    parse(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=20000,
+                        help='Books in the parsed file.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    warnings.simplefilter('ignore')
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'collection.txt')
+        build_collection(args.number).save_to_text(path)
+        megabytes = os.path.getsize(path) / 1024 / 1024
+        print('{} books, {:.1f} MB'.format(args.number, megabytes))
+        print('{:>10}  {:>10}  {:>8}  {:>12}'.format('parser', 'books/s', 'MB/s', 'peak MB'))
+        for name, parse in (('pyparsing', legacy_parse), ('streaming', streaming_parse)):
+            elapsed, peak = measure(parse, path)
+            print('{:>10}  {:10,.0f}  {:8.1f}  {:12.2f}'.format(
+                name, args.number / elapsed, megabytes / elapsed, peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
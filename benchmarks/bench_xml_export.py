@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+# Throughput and peak traced memory of BookCollection.save_to_xml against
+# the previous whole-tree ElementTree exporter.
+# Usage: bench_xml_export.py [-n 100000]
+
+
+import os
+import sys
+import argparse
+import tempfile
+import timeit
+import tracemalloc
+import xml.etree.ElementTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+from bench_text_export import build_collection
+
+
+def legacy_save(book_collection, path):
+    # the former save_to_xml, with its in_collections helper repaired
+    root = xml.etree.ElementTree.Element('books')
+    for book in book_collection.values():
+        main_book = xml.etree.ElementTree.Element('book')
+        for attr in bookwarm.BookCollection.book_attribute_names[:-3]:
+            sub_element = xml.etree.ElementTree.SubElement(main_book, attr)
+            sub_element.text = str(getattr(book, attr))
+        tags = xml.etree.ElementTree.SubElement(main_book, 'tags')
+        tags.text = ' '.join(book.tags)
+        in_collections = xml.etree.ElementTree.SubElement(main_book, 'in_collections')
+        in_collections.text = '  '.join('{}: {}'.format(user, ','.join(names))
+                                        for user, names in book.in_collections.items())
+        notes = xml.etree.ElementTree.SubElement(main_book, 'notes')
+        notes.text = '  '.join(book.notes)
+        root.append(main_book)
+    xml.etree.ElementTree.ElementTree(root).write(path, 'UTF-8')
+
+
+def measure(save, path):
+    elapsed = timeit.timeit(lambda: save(path), number=1)
+    tracemalloc.start()
+    save(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help='Books in the exported collection.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    book_collection = build_collection(args.number)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'collection.xml')
+        results = [(name, measure(save, path)) for name, save in (
+            ('ElementTree', lambda path: legacy_save(book_collection, path)),
+            ('streaming', book_collection.save_to_xml))]
+        megabytes = os.path.getsize(path) / 1024 / 1024
+    print('{} books, {:.1f} MB'.format(args.number, megabytes))
+    print('{:>12}  {:>8}  {:>8}  {:>8}'.format('exporter', 'seconds', 'MB/s', 'peak MB'))
+    for name, (elapsed, peak) in results:
+        print('{:>12}  {:8.3f}  {:8.1f}  {:8.1f}'.format(name, elapsed, megabytes / elapsed,
+                                                        peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
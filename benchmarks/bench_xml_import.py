@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+# Reading an XML collection export: the previous ElementTree.parse +
+# findall/find walk against the iterparse-based iter_xml_books, in books/s
+# and peak traced memory. Times attribute extraction and value conversion,
+# not UserBook construction.
+# Usage: bench_xml_import.py [-s 10000 100000]
+
+
+import os
+import sys
+import argparse
+import collections
+import datetime
+import tempfile
+import timeit
+import tracemalloc
+import xml.etree.ElementTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bookwarm
+
+
+BOOK_XML = ('<book><isbn>{isbn}</isbn><title>title {number}</title>'
+            '<author>author {author}</author><genre>genre</genre>'
+            '<no_of_pages>{pages}</no_of_pages><year_published>2000</year_published>'
+            '<edition>1</edition><publisher>publisher</publisher><read>False</read>'
+            '<read_date>0001-01-01</read_date><rating>3</rating><tags>bench tag{tag}</tags>'
+            '<in_collections>bench user: bench collection,shelf</in_collections>'
+            '<notes>first note  second note</notes></book>')
+
+
+def write_export(path, count):
+    with open(path, 'w', encoding='utf-8') as fh:
+        fh.write('<books>')
+        for number in range(count):
+            fh.write(BOOK_XML.format(isbn=1000000000 + number, number=number,
+                                     author=number % 1000, pages=100 + number % 900,
+                                     tag=number % 7))
+        fh.write('</books>')
+
+
+def legacy_read(path):
+    # attribute extraction and conversions of the former load_from_xml
+    count = 0
+    for book in xml.etree.ElementTree.parse(path).findall('book'):
+        new_book = {}
+        for attr in bookwarm.BookCollection.book_attribute_names:
+            new_book[attr] = book.find(attr).text or ''
+        for int_attr in ('isbn', 'no_of_pages', 'year_published', 'edition', 'rating'):
+            new_book[int_attr] = int(new_book[int_attr])
+        new_book['read'] = bool(new_book['read'])
+        new_book['read_date'] = datetime.datetime.strptime(new_book['read_date'], '%Y-%m-%d')
+        tags_text = book.find('tags').text
+        new_book['tags'] = set(tags_text.split()) if tags_text else set()
+        in_collections = collections.defaultdict(list)
+        for item in (book.find('in_collections').text or '').split('  '):
+            if item:
+                user, collection_names = item.split(':')
+                in_collections[user] = collection_names.strip().split(',')
+        new_book['in_collections'] = in_collections
+        notes_text = book.find('notes').text
+        new_book['notes'] = notes_text.split('  ') if notes_text else []
+        count += 1
+    return count
+
+
+def streaming_read(path):
+    return sum(1 for _ in bookwarm.iter_xml_books(path))
+
+
+def measure(read, path):
+    elapsed = timeit.timeit(lambda: read(path), number=1)
+    tracemalloc.start()
+    read(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[10000, 100000],
+                        help='Books per export file.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    print('{:>8}  {:>7}  {:>10}  {:>10}  {:>8}'.format('books', 'MB', 'reader',
+                                                      'books/s', 'peak MB'))
+    with tempfile.TemporaryDirectory() as folder:
+        for size in args.sizes:
+            path = os.path.join(folder, 'export_{}.xml'.format(size))
+            write_export(path, size)
+            megabytes = os.path.getsize(path) / 1024 / 1024
+            for name, read in (('parse', legacy_read), ('iterparse', streaming_read)):
+                elapsed, peak = measure(read, path)
+                print('{:>8}  {:7.1f}  {:>10}  {:10,.0f}  {:8.2f}'.format(
+                    size, megabytes, name, size / elapsed, peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,41 @@
 #!/usr/bin/python3
 # TODO: Client
 # TODO:  - request collections as necessary and cache them
-# TODO: Server
-# TODO:  - store available books separately in a binary file
-# TODO:  - store each collection separately in a binary file
 
 
+import io
 import os
+import csv
+import json
 import sys
-import operator
+import math
+import mmap
+import struct
+import bisect
 import collections
+import itertools
 import datetime
+import threading
+import pickle
+import multiprocessing
+import concurrent.futures
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 import xml.etree.ElementTree
-import xml.parsers.expat
+import xml.sax.saxutils
+import zlib
 
-from pyparsing import (Suppress, Word, OneOrMore, ParseException, Regex,
-                       restOfLine, ZeroOrMore, alphas, nums)
 from sqlalchemy import (Column, ForeignKey, Integer, String, Boolean,
-                        Date, PickleType, create_engine)
+                        Date, Table, Index, create_engine, event, func, inspect, select, text)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.ext.orderinglist import ordering_list
+from sqlalchemy.orm import (Session, sessionmaker, relationship, reconstructor,
+                            configure_mappers)
+from sqlalchemy.orm.collections import attribute_mapped_collection
+from sqlalchemy.pool import QueuePool
 
 
 if sys.platform.startswith('win'):
@@ -29,21 +45,122 @@ else:
 DB_BASE = declarative_base()
 
 
+ENGINE_DEFAULTS = dict(pool_size=5, max_overflow=10, pool_timeout=30,
+                       journal_mode='WAL', synchronous='NORMAL', cache_size=-16000,
+                       foreign_keys='ON')
+
+_engine_options = {}
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def configure_engine(database_file, **options):
+    unknown = set(options) - set(ENGINE_DEFAULTS)
+    if unknown:
+        raise KeyError('Valid engine options: {}'.format(' '.join(ENGINE_DEFAULTS)))
+    database_file = os.path.abspath(database_file)
+    with _engines_lock:
+        if database_file in _engines:
+            raise RuntimeError('Engine for {} already created.'.format(database_file))
+        _engine_options.setdefault(database_file, {}).update(options)
+
+
+def get_engine(database_file):
+    database_file = os.path.abspath(database_file)
+    with _engines_lock:
+        if database_file not in _engines:
+            options = dict(ENGINE_DEFAULTS, **_engine_options.get(database_file, {}))
+            engine = create_engine(DB_PATH_PREFIX + database_file.lstrip('/'),
+                                   poolclass=QueuePool,
+                                   pool_size=options['pool_size'],
+                                   max_overflow=options['max_overflow'],
+                                   pool_timeout=options['pool_timeout'],
+                                   connect_args={'check_same_thread': False})
+            _set_sqlite_pragmas(engine, options)
+            _engines[database_file] = (engine, sessionmaker(bind=engine))
+        return _engines[database_file]
+
+
+def _set_sqlite_pragmas(engine, options):
+    pragmas = ('PRAGMA journal_mode={journal_mode}'.format(**options),
+               'PRAGMA synchronous={synchronous}'.format(**options),
+               'PRAGMA cache_size={cache_size}'.format(**options),
+               'PRAGMA foreign_keys={foreign_keys}'.format(**options))
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def engine_pool_status(database_file):
+    engine = get_engine(database_file)[0]
+    return dict(size=engine.pool.size(), checked_in=engine.pool.checkedin(),
+                checked_out=engine.pool.checkedout(), overflow=engine.pool.overflow())
+
+
+def dispose_engine(database_file):
+    database_file = os.path.abspath(database_file)
+    with _engines_lock:
+        engine = _engines.pop(database_file, (None,))[0]
+        _engine_options.pop(database_file, None)
+    if engine is not None:
+        engine.dispose()
+
+
+class MigrationError(ValueError): pass
+
+
+def _duplicate_keys(engine, index):
+    columns = list(index.columns)
+    with engine.connect() as connection:
+        return [tuple(row) for row in connection.execute(
+            select(*columns).group_by(*columns).having(func.count() > 1).limit(10))]
+
+
 def setup_database(path_to_db_file):
-    path_to_db_file = DB_PATH_PREFIX + path_to_db_file
-    engine = create_engine(path_to_db_file)
+    engine = get_engine(path_to_db_file)[0]
     DB_BASE.metadata.create_all(engine)
+    # create_all() skips indexes of tables that already exist; a database
+    # from before the ISBN became unique may hold the same ISBN twice
+    inspector = inspect(engine)
+    for table in DB_BASE.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            duplicates = _duplicate_keys(engine, index) if index.unique else []
+            if duplicates:
+                raise MigrationError('Cannot create unique index {} in {}, remove the '
+                                     'duplicate rows of {} first: {}'.format(
+                                         index.name, path_to_db_file, table.name,
+                                         ', '.join(map(str, duplicates))))
+            index.create(engine)
+    with engine.begin() as connection:
+        connection.execute(text('INSERT OR IGNORE INTO catalog_change (id, counter) '
+                                'VALUES (1, 0)'))
+        for statement in CATALOG_CHANGE_TRIGGERS:
+            connection.execute(text(statement))
+
+
+# every write to a books row bumps catalog_change.counter, whoever makes
+# it, so a catalog file stamped with the counter it reflects can tell any
+# edit apart from an unchanged table
+CATALOG_CHANGE_TRIGGERS = tuple(
+    'CREATE TRIGGER IF NOT EXISTS book_catalog_{0} AFTER {1} ON book BEGIN '
+    'UPDATE catalog_change SET counter = counter + 1 WHERE id = 1; END'.format(
+        event_name.lower(), event_name) for event_name in ('INSERT', 'UPDATE', 'DELETE'))
 
 
 class SQLSession:
 
     def __init__(self, database_file):
-        self._database_file = DB_PATH_PREFIX + database_file
+        self._database_file = database_file
 
     def __enter__(self):
-        engine = create_engine(self._database_file)
-        DB_BASE.metadata.bind = engine
-        DBSession = sessionmaker(bind=engine)
+        DBSession = get_engine(self._database_file)[1]
         self.session = DBSession()
         return self.session
 
@@ -51,12 +168,20 @@ class SQLSession:
         self.session.close()
 
 
+collection_book = Table(
+    'collection_book', DB_BASE.metadata,
+    Column('collection_id', Integer, ForeignKey('book_collection.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('book_id', Integer, ForeignKey('book.id', ondelete='CASCADE'),
+           primary_key=True, index=True))
+
+
 class Book(DB_BASE):
 
     __tablename__ = 'book'
 
     id = Column(Integer, primary_key=True)
-    __isbn = Column(Integer, nullable=False)
+    __isbn = Column(Integer, nullable=False, unique=True, index=True)
     __title = Column(String(200), nullable=False)
     __author = Column(String(200), nullable=False)
     __genre = Column(String(200))
@@ -86,6 +211,55 @@ class Book(DB_BASE):
         self.year_published = year_published
         self.publisher = publisher
 
+    @classmethod
+    def trusted(cls, isbn, title, author, genre, no_of_pages,
+                year_published, edition=1, publisher=''):
+        """ Build a book from values that were validated when first stored.
+
+            Skips __init__ assertions and property setters, so it must only be
+            fed rows or files written by BookWarm itself, never user input.
+        """
+        book = cls._sa_class_manager.new_instance()
+        book.type = cls.__mapper__.polymorphic_identity
+        book.__isbn = isbn
+        book.__title = title
+        book.__author = author
+        book.__genre = genre
+        book.__no_of_pages = no_of_pages
+        book.__edition = edition
+        book.__year_published = year_published
+        book.__publisher = publisher
+        return book
+
+    @classmethod
+    def by_isbn(cls, session, isbn):
+        return session.query(cls).filter(cls.__isbn == int(isbn)).one_or_none()
+
+    @classmethod
+    def existing_isbns(cls, session, isbns):
+        return set(isbn for isbn, in session.query(cls.__isbn).filter(cls.__isbn.in_(isbns)))
+
+    @classmethod
+    def catalog_stamp(cls, session):
+        count, checksum = session.query(func.count(cls.__isbn),
+                                        func.sum(cls.__isbn % CATALOG_STAMP_MODULUS)).one()
+        return count, checksum or 0, CatalogChange.current(session)
+
+    @classmethod
+    def in_collection(cls, session, collection_id, isbn=None):
+        query = (session.query(cls)
+                 .join(collection_book, collection_book.c.book_id == cls.id)
+                 .filter(collection_book.c.collection_id == collection_id))
+        if isbn is not None:
+            query = query.filter(cls.__isbn == int(isbn))
+        return query.order_by(cls.__isbn)
+
+    def column_values(self):
+        values = {column.key: getattr(self, column.key)
+                  for column in Book.__table__.columns if column.key not in ('id', 'type')}
+        values['type'] = 'book'
+        return values
+
     @property
     def isbn(self):
         return self.__isbn
@@ -148,6 +322,71 @@ class Book(DB_BASE):
         self.__publisher = new_publisher
 
 
+class CatalogChange(DB_BASE):
+
+    __tablename__ = 'catalog_change'
+
+    id = Column(Integer, primary_key=True)
+    counter = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def current(cls, session):
+        # no row before setup_database() has run the catalog triggers
+        return session.query(cls.counter).filter(cls.id == 1).scalar() or 0
+
+
+class UserBookNote(DB_BASE):
+
+    __tablename__ = 'userbook_note'
+
+    id = Column(Integer, primary_key=True)
+    userbook_id = Column(Integer, ForeignKey('userbook.id', ondelete='CASCADE'),
+                         nullable=False, index=True)
+    position = Column(Integer, nullable=False)
+    text = Column(String, nullable=False)
+
+    @classmethod
+    def isbn_notes(cls, session):
+        book_table = Book.__table__
+        return session.execute(select(book_table.c._Book__isbn, cls.text).join(
+            book_table, book_table.c.id == cls.userbook_id).order_by(
+            cls.userbook_id, cls.position)).all()
+
+    @classmethod
+    def notes_stamp(cls, session):
+        count, ids, length = session.query(func.count(cls.id), func.sum(cls.id),
+                                           func.sum(func.length(cls.text))).one()
+        return count, ids or 0, length or 0
+
+
+class UserBookTag(DB_BASE):
+
+    __tablename__ = 'userbook_tag'
+
+    userbook_id = Column(Integer, ForeignKey('userbook.id', ondelete='CASCADE'),
+                         primary_key=True)
+    tag = Column(String(200), primary_key=True, index=True)
+
+    @classmethod
+    def isbn_tags(cls, session):
+        book_table = Book.__table__
+        return session.execute(select(book_table.c._Book__isbn, cls.tag).join(
+            book_table, book_table.c.id == cls.userbook_id)).all()
+
+
+class UserBookCollectionName(DB_BASE):
+
+    __tablename__ = 'userbook_collection_name'
+    __table_args__ = (Index('ix_userbook_collection_name_user_collection',
+                            'user', 'collection_name'),)
+
+    id = Column(Integer, primary_key=True)
+    userbook_id = Column(Integer, ForeignKey('userbook.id', ondelete='CASCADE'),
+                         nullable=False, index=True)
+    user = Column(String, nullable=False)
+    collection_name = Column(String, nullable=False)
+
+
 class UserBook(Book):
 
     __tablename__ = 'userbook'
@@ -156,12 +395,22 @@ class UserBook(Book):
     __read = Column(Boolean)
     __read_date = Column(Date)
     __rating = Column(Integer)
-    __in_collections = Column(PickleType)
-    __notes = Column(PickleType)
-    __tags = Column(PickleType)
+    __collection_name_rows = relationship(UserBookCollectionName, lazy='selectin',
+                                          cascade='all, delete-orphan')
+    __note_rows = relationship(UserBookNote, order_by=UserBookNote.position, lazy='selectin',
+                               collection_class=ordering_list('position'),
+                               cascade='all, delete-orphan')
+    __tag_rows = relationship(UserBookTag, collection_class=set, lazy='selectin',
+                              cascade='all, delete-orphan')
+    __notes = association_proxy('_UserBook__note_rows', 'text',
+                                creator=lambda note: UserBookNote(text=note))
+    __tags = association_proxy('_UserBook__tag_rows', 'tag',
+                               creator=lambda tag: UserBookTag(tag=tag))
 
     __mapper_args__ = {'polymorphic_identity': 'userbook'}
 
+    __pending = None
+
     def __init__(self, isbn, title, author, genre, no_of_pages,
                  year_published, edition=1, publisher='',
                  notes=None, read=False, read_date=datetime.date.min, rating=0,
@@ -175,17 +424,60 @@ class UserBook(Book):
         self.read_date = read_date
         self.rating = rating
 
+    @classmethod
+    def trusted(cls, isbn, title, author, genre, no_of_pages,
+                year_published, edition=1, publisher='',
+                notes=None, read=False, read_date=datetime.date.min, rating=0,
+                in_collections=None, tags=None):
+        """ Trusted counterpart of __init__, see Book.trusted. """
+        book = super().trusted(isbn, title, author, genre, no_of_pages,
+                               year_published, edition, publisher)
+        book.__read = read
+        book.__read_date = read_date
+        book.__rating = rating
+        book.__in_collections = in_collections or collections.defaultdict(list)
+        # building the note, tag and collection name rows costs far more than
+        # the book itself, so they wait for the first flush (_store_pending)
+        book.__pending = dict(notes=notes or [], tags=tags or set())
+        return book
+
+    @reconstructor
+    def _init_on_load(self):
+        self.__in_collections = None
+
+    def _store_pending(self):
+        if self.__pending is not None:
+            pending, self.__pending = self.__pending, None
+            self.__notes = pending['notes']
+            self.__tags = pending['tags']
+            self.__collection_name_rows = [UserBookCollectionName(user=user, collection_name=name)
+                                           for user in self.__in_collections
+                                           for name in self.__in_collections[user]]
+
+    @classmethod
+    def by_tag(cls, session, tag):
+        return session.query(cls).join(cls.__tag_rows).filter(UserBookTag.tag == tag)
+
     @property
     def notes(self):
+        if self.__pending is not None:
+            return self.__pending['notes']
         return self.__notes
 
     @notes.setter
     def notes(self, new_notes):
         assert isinstance(new_notes, list), 'Must be a list class.'
-        self.__notes = new_notes
+        if self.__pending is not None:
+            self.__pending['notes'] = new_notes
+        else:
+            self.__notes = new_notes
 
     @property
     def in_collections(self):
+        if self.__in_collections is None:
+            self.__in_collections = collections.defaultdict(list)
+            for row in self.__collection_name_rows:
+                self.__in_collections[row.user].append(row.collection_name)
         return self.__in_collections
 
     @in_collections.setter
@@ -194,6 +486,9 @@ class UserBook(Book):
             'Must be a defaultdict class.')
         assert all(isinstance(element, list) for element in new_in_collections.values()), (
             'Each value has to be list class.')
+        self.__collection_name_rows = [UserBookCollectionName(user=user, collection_name=name)
+                                       for user in new_in_collections
+                                       for name in new_in_collections[user]]
         self.__in_collections = new_in_collections
 
     @property
@@ -226,12 +521,17 @@ class UserBook(Book):
 
     @property
     def tags(self):
+        if self.__pending is not None:
+            return self.__pending['tags']
         return self.__tags
 
     @tags.setter
     def tags(self, new_tags):
         assert isinstance(new_tags, set), 'Must be a set class.'
-        self.__tags = new_tags
+        if self.__pending is not None:
+            self.__pending['tags'] = new_tags
+        else:
+            self.__tags = new_tags
 
     def add_note(self, new_note):
         assert isinstance(new_note, str) and len(new_note) > 1, (
@@ -242,6 +542,8 @@ class UserBook(Book):
         assert (isinstance(user_collection_name, str) and isinstance(user, str)
             and len(user) > 1) and len(user_collection_name) > 1, ('Must be a non-empty string.')
         self.in_collections[user].append(user_collection_name)
+        self.__collection_name_rows.append(UserBookCollectionName(
+            user=user, collection_name=user_collection_name))
 
     def add_tag(self, tag_to_add):
         assert isinstance(tag_to_add, str) and len(tag_to_add) > 1, (
@@ -249,6 +551,1440 @@ class UserBook(Book):
         self.tags.add(tag_to_add)
 
 
+@event.listens_for(Session, 'before_flush')
+def _store_pending_rows(session, flush_context, instances):
+    for instance in session.new:
+        if isinstance(instance, UserBook):
+            instance._store_pending()
+
+
+def _intern(text):
+    # genre and publisher repeat across many books but are nullable columns
+    return None if text is None else sys.intern(text)
+
+
+class BookRecord(collections.namedtuple('BookRecord', 'isbn title author genre no_of_pages '
+                                                     'year_published edition publisher')):
+
+    __slots__ = ()
+
+    @classmethod
+    def from_book(cls, book):
+        if isinstance(book, cls):
+            return book
+        return cls(book.isbn, book.title, book.author, _intern(book.genre),
+                   book.no_of_pages, book.year_published, book.edition,
+                   _intern(book.publisher))
+
+    @classmethod
+    def from_row(cls, row):
+        isbn, title, author, genre, no_of_pages, year_published, edition, publisher = row
+        return cls(isbn, title, author, _intern(genre), no_of_pages,
+                   year_published, edition, _intern(publisher))
+
+    @classmethod
+    def load_all(cls, session):
+        columns = [Book.__table__.c['_Book__' + field] for field in cls._fields]
+        return [cls.from_row(row) for row in session.execute(select(*columns))]
+
+    def to_book(self):
+        return Book.trusted(*self)
+
+
+def _index_bounds(index, low=None, high=None):
+    start = 0 if low is None else bisect.bisect_left(index, (low,))
+    stop = len(index) if high is None else bisect.bisect_right(index, (high, math.inf))
+    return start, max(start, stop)
+
+
+class BookCatalog:
+
+    available_filters = BookRecord._fields
+    # the only fields its records have; no tags, read or rating
+    record_fields = BookRecord._fields
+
+    def __init__(self, books=()):
+        self._lock = threading.Lock()
+        self._books = {}
+        self._sorted_isbns = []
+        self._indexes = {}
+        self._version = 0
+        self.load(books)
+
+    @property
+    def version(self):
+        return self._version
+
+    def load(self, books):
+        with self._lock:
+            self._books = {book.isbn: BookRecord.from_book(book) for book in books}
+            self._sorted_isbns = sorted(self._books)
+            self._indexes = {}
+            self._version += 1
+
+    def put(self, book):
+        assert isinstance(book, (Book, BookRecord)), 'Must be Book (sub)class or BookRecord.'
+        record = BookRecord.from_book(book)
+        with self._lock:
+            if record.isbn not in self._books:
+                bisect.insort(self._sorted_isbns, record.isbn)
+            else:
+                self._unindex(self._books[record.isbn])
+            self._books[record.isbn] = record
+            for key, index in self._indexes.items():
+                if getattr(record, key) is not None:
+                    bisect.insort(index, (getattr(record, key), record.isbn))
+            self._version += 1
+
+    def put_many(self, books):
+        with self._lock:
+            for book in books:
+                assert isinstance(book, (Book, BookRecord)), (
+                    'Must be Book (sub)class or BookRecord.')
+                record = BookRecord.from_book(book)
+                if record.isbn not in self._books:
+                    self._sorted_isbns.append(record.isbn)
+                self._books[record.isbn] = record
+            self._sorted_isbns.sort()
+            self._indexes = {}
+            self._version += 1
+
+    def discard(self, isbn):
+        isbn = int(isbn)
+        with self._lock:
+            record = self._books.pop(isbn, None)
+            if record is not None:
+                del self._sorted_isbns[bisect.bisect_left(self._sorted_isbns, isbn)]
+                self._unindex(record)
+                self._version += 1
+
+    def get(self, isbn, default=None):
+        return self._books.get(int(isbn), default)
+
+    def __getitem__(self, isbn):
+        return self._books[int(isbn)]
+
+    def index_count(self, key, low=None, high=None):
+        with self._lock:
+            start, stop = _index_bounds(self._sorted_index(key), low, high)
+        return stop - start
+
+    def index_range(self, key, low=None, high=None):
+        with self._lock:
+            index = self._sorted_index(key)
+            start, stop = _index_bounds(index, low, high)
+            return [isbn for _, isbn in index[start:stop]]
+
+    def _sorted_index(self, key):
+        if key not in BookCatalog.available_filters:
+            raise KeyError('Valid filters: {}'.format(' '.join(BookCatalog.available_filters)))
+        if key not in self._indexes:
+            # NULL columns never fall in a range and would not sort
+            self._indexes[key] = sorted((getattr(record, key), isbn)
+                                        for isbn, record in self._books.items()
+                                        if getattr(record, key) is not None)
+        return self._indexes[key]
+
+    def _unindex(self, record):
+        for key, index in self._indexes.items():
+            if getattr(record, key) is not None:
+                del index[bisect.bisect_left(index, (getattr(record, key), record.isbn))]
+
+    def snapshot(self):
+        with self._lock:
+            return self._version, [self._books[isbn] for isbn in self._sorted_isbns]
+
+    def isbns(self):
+        with self._lock:
+            return list(self._sorted_isbns)
+
+    def page(self, after=None, limit=100):
+        with self._lock:
+            start = 0 if after is None else bisect.bisect_right(self._sorted_isbns, int(after))
+            isbns = self._sorted_isbns[start:start + limit]
+            more = start + limit < len(self._sorted_isbns)
+        return isbns, (isbns[-1] if isbns and more else None)
+
+    def __contains__(self, isbn):
+        return int(isbn) in self._books
+
+    def __iter__(self):
+        return iter(self.snapshot()[1])
+
+    def __len__(self):
+        return len(self._books)
+
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+TEXT_FIELDS = frozenset(('title', 'author', 'genre', 'no_of_pages', 'year_published',
+                         'edition', 'publisher', 'read', 'read_date', 'rating', 'tags',
+                         'in_collections'))
+TEXT_INT_FIELDS = frozenset(('no_of_pages', 'year_published', 'edition', 'rating'))
+# NULL columns are written as empty fields and read back as None; the
+# placeholders only stand in while the other values are validated
+TEXT_NULL_PLACEHOLDERS = dict(genre='unknown', no_of_pages=1, year_published=1, edition=1,
+                              rating=0, read_date=datetime.date.min)
+
+
+class TextFormatError(ValueError): pass
+
+
+def _field_text(value):
+    return '' if value is None else str(value)
+
+
+def _user_book(book_values):
+    # the setters reject None, so a book with NULL fields is checked with
+    # placeholders and then built as it was stored
+    nulls = {key: placeholder for key, placeholder in TEXT_NULL_PLACEHOLDERS.items()
+             if key in book_values and book_values[key] is None}
+    if not nulls:
+        return UserBook(**book_values)
+    UserBook(**dict(book_values, **nulls))
+    return UserBook.trusted(**book_values)
+
+
+def _in_collections_text(in_collections):
+    return '  '.join('{}: {}'.format(user, ','.join(collection_names))
+                     for user, collection_names in in_collections.items())
+
+
+def _text_value(key, value):
+    if not value and key in TEXT_NULL_PLACEHOLDERS:
+        return None
+    if key in TEXT_INT_FIELDS:
+        return int(value)
+    if key == 'read':
+        if value not in ('True', 'False'):
+            raise ValueError('expected True or False')
+        return value == 'True'
+    if key == 'read_date':
+        return datetime.date.fromisoformat(value)
+    if key == 'tags':
+        return set(value.split())
+    if key == 'in_collections':
+        in_collections = collections.defaultdict(list)
+        for item in value.split('  '):
+            if item.strip():
+                user, collection_names = item.split(':')
+                in_collections[user.strip()].extend(collection_name.strip() for collection_name
+                                                    in collection_names.split(','))
+        return in_collections
+    return value
+
+
+def iter_xml_books(source):
+    # yields the attributes of each <book> as it closes, then drops the
+    # element from the root so memory stays flat for any file size
+    books = xml.etree.ElementTree.iterparse(source, events=('start', 'end'))
+    _, root = next(books)
+    for event, element in books:
+        if event == 'end' and element.tag == 'book':
+            fields = {child.tag: (child.text or '').strip() for child in element}
+            book_values = dict(isbn=int(fields['isbn']),
+                               notes=[note for note in fields['notes'].split('  ') if note])
+            for key in TEXT_FIELDS:
+                book_values[key] = _text_value(key, fields[key])
+            root.clear()
+            yield book_values
+
+
+def iter_text_books(fh):
+    # yields (first line number, attribute dict) per book as its '<NOTES'
+    # line is read, so only one book is ever held in memory
+    book_values, notes, start_line, line_no = None, None, 0, 0
+    for line_no, line in enumerate(fh, 1):
+        stripped = line.strip()
+        if book_values is None:
+            if not stripped:
+                continue
+            if not (stripped[:1] == '[' and stripped[-1:] == ']' and stripped[1:-1].isdigit()):
+                raise TextFormatError('line {}: expected "[isbn]", got {!r}'.format(
+                    line_no, stripped))
+            book_values, notes, start_line = dict(isbn=int(stripped[1:-1])), None, line_no
+        elif notes is not None:
+            if stripped == '<NOTES':
+                book_values['notes'] = notes
+                yield start_line, book_values
+                book_values = None
+            elif stripped:
+                notes.append(stripped)
+        elif stripped == 'NOTES>':
+            notes = []
+        elif stripped:
+            key, equals, value = stripped.partition('=')
+            key = key.strip()
+            if not equals or key not in TEXT_FIELDS:
+                raise TextFormatError('line {}: expected "key=value" or "NOTES>", got {!r}'.format(
+                    line_no, stripped))
+            if key in book_values:
+                raise TextFormatError('line {}: duplicate key {!r}'.format(line_no, key))
+            try:
+                book_values[key] = _text_value(key, value.strip())
+            except ValueError as value_err:
+                raise TextFormatError('line {}: invalid {} value {!r}: {}'.format(
+                    line_no, key, value.strip(), value_err)) from value_err
+    if book_values is not None:
+        raise TextFormatError('line {}: book [{}] from line {} is missing "<NOTES"'.format(
+            line_no, book_values['isbn'], start_line))
+
+
+def _write_chunks(fh, texts, chunk_size=WRITE_BUFFER_SIZE):
+    text_file = isinstance(fh, io.TextIOBase)
+    chunk, size = [], 0
+    for text in texts:
+        chunk.append(text)
+        size += len(text)
+        if size >= chunk_size:
+            data = ''.join(chunk)
+            fh.write(data if text_file else data.encode('utf-8'))
+            chunk, size = [], 0
+    data = ''.join(chunk)
+    fh.write(data if text_file else data.encode('utf-8'))
+
+
+def _atomic_save(path, write):
+    # readers see either the previous file or the complete new one
+    temporary_path = '{}.tmp'.format(path)
+    try:
+        with open(temporary_path, 'wb', buffering=WRITE_BUFFER_SIZE) as fh:
+            write(fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+# JSON Lines and CSV exchange: one book per line/row, with the fields of
+# BookCollection.book_attribute_names for collections or BookRecord._fields
+# for the server catalog. CSV starts with a header row, keeps tags space
+# separated, notes newline separated and in_collections as in the text
+# format. Imports are cut into chunks that a process pool parses and
+# validates; the chunks come back in input order.
+EXCHANGE_FORMATS = ('jsonl', 'csv')
+EXCHANGE_CHUNK_SIZE = 5000
+
+
+class ExchangeFormatError(ValueError): pass
+
+
+def _exchange_fields(kind):
+    assert kind in ('collection', 'catalog'), 'Kind must be "collection" or "catalog".'
+    return BookCollection.book_attribute_names if kind == 'collection' else BookRecord._fields
+
+
+def _jsonl_lines(books, fields):
+    for book in books:
+        values = {}
+        for field in fields:
+            value = getattr(book, field)
+            if field == 'read_date':
+                value = value.isoformat()
+            elif field == 'tags':
+                value = sorted(value)
+            elif field == 'notes':
+                value = list(value)
+            elif field == 'in_collections':
+                value = {user: list(collection_names)
+                         for user, collection_names in value.items()}
+            values[field] = value
+        yield json.dumps(values, ensure_ascii=False) + '\n'
+
+
+def _csv_lines(books, fields):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(fields)
+    for rows in iter(lambda: list(itertools.islice(books, 1000)), []):
+        for book in rows:
+            row = []
+            for field in fields:
+                value = getattr(book, field)
+                if field == 'tags':
+                    value = ' '.join(sorted(value))
+                elif field == 'notes':
+                    value = '\n'.join(value)
+                elif field == 'in_collections':
+                    value = _in_collections_text(value)
+                elif field == 'read_date':
+                    value = value.isoformat()
+                row.append(value)
+            writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def write_exchange_books(fh, books, fmt, kind='collection'):
+    assert fmt in EXCHANGE_FORMATS, 'Format must be one of: {}'.format(
+        ' '.join(EXCHANGE_FORMATS))
+    lines = _jsonl_lines if fmt == 'jsonl' else _csv_lines
+    _write_chunks(fh, lines(iter(books), _exchange_fields(kind)))
+
+
+def save_exchange_books(file, books, fmt, kind='collection'):
+    # file may be a path, written atomically, or an open file object
+    if isinstance(file, str):
+        _atomic_save(file, lambda fh: write_exchange_books(fh, books, fmt, kind))
+    else:
+        write_exchange_books(file, books, fmt, kind)
+
+
+def _exchange_value(key, value, fmt):
+    if fmt == 'csv':
+        if key == 'isbn':
+            return int(value)
+        if key == 'notes':
+            return value.split('\n')
+        return _text_value(key, value)
+    if key == 'read_date':
+        return datetime.date.fromisoformat(value)
+    if key in ('tags', 'notes'):
+        # a bare string would otherwise become a set or list of characters
+        if not (isinstance(value, list) and all(isinstance(item, str) for item in value)):
+            raise ValueError('{} must be a list of strings'.format(key))
+        return set(value) if key == 'tags' else value
+    if key == 'in_collections':
+        if not (isinstance(value, dict) and
+                all(isinstance(names, list) for names in value.values())):
+            raise ValueError('in_collections must map users to lists of collection names')
+        return collections.defaultdict(list, {user: list(collection_names)
+                                              for user, collection_names in value.items()})
+    return value
+
+
+def _parse_exchange_chunk(fmt, kind, fields, records):
+    # runs in a worker process; records are (line_no, JSON line or CSV row)
+    # and each book is validated by building it through the checked __init__
+    book_type = UserBook if kind == 'collection' else Book
+    books, failures = [], []
+    for line_no, record in records:
+        try:
+            if fmt == 'csv':
+                if len(record) != len(fields):
+                    raise ValueError('expected {} columns, got {}'.format(len(fields), len(record)))
+                raw_values = {key: value for key, value in zip(fields, record) if value != ''}
+            else:
+                raw_values = json.loads(record)
+                if not isinstance(raw_values, dict):
+                    raise ValueError('expected a JSON object')
+                unknown = set(raw_values).difference(fields)
+                if unknown:
+                    raise ValueError('unknown fields: {}'.format(' '.join(sorted(unknown))))
+            values = {key: _exchange_value(key, value, fmt) for key, value in raw_values.items()}
+            book_type(**values)
+        except (ValueError, TypeError, AttributeError, AssertionError) as parse_err:
+            failures.append((line_no, str(parse_err) or 'Invalid record.'))
+        else:
+            books.append((line_no, values))
+    return books, failures
+
+
+def _csv_records(fh):
+    reader = csv.reader(fh)
+    line_no = 1
+    for row in reader:
+        if row:
+            yield line_no, row
+        line_no = reader.line_num + 1
+
+
+def _exchange_chunks(fh, fmt, kind, chunk_size):
+    allowed_fields = _exchange_fields(kind)
+    if fmt == 'jsonl':
+        fields = allowed_fields
+        records = ((line_no, line) for line_no, line in enumerate(fh, 1) if line.strip())
+    else:
+        records = _csv_records(fh)
+        fields = tuple(next(records, (1, ()))[1])
+        unknown = set(fields).difference(allowed_fields)
+        if unknown:
+            raise ExchangeFormatError('line 1: unknown columns: {}'.format(
+                ' '.join(sorted(unknown))))
+    for chunk in iter(lambda: list(itertools.islice(records, chunk_size)), []):
+        yield fmt, kind, fields, chunk
+
+
+def _exchange_mp_context():
+    # workers are never forked: the caller may be a thread of a process
+    # holding SQLite connections, mmaps and locks that fork would copy
+    start_methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in start_methods
+                                       else 'spawn')
+
+
+def read_exchange_books(fh, fmt, kind='collection', max_workers=None, chunk_size=None,
+                        mp_context=None):
+    # yields (books, failures) per chunk in input order: books are
+    # (line_no, values) ready for Book/UserBook.trusted, failures are
+    # (line_no, message); max_workers=0 parses in this process
+    assert fmt in EXCHANGE_FORMATS, 'Format must be one of: {}'.format(
+        ' '.join(EXCHANGE_FORMATS))
+    chunks = _exchange_chunks(fh, fmt, kind, chunk_size or EXCHANGE_CHUNK_SIZE)
+    if max_workers == 0:
+        for chunk in chunks:
+            yield _parse_exchange_chunk(*chunk)
+        return
+    in_flight = 2 * (max_workers or os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers, mp_context=mp_context or _exchange_mp_context()) as executor:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_parse_exchange_chunk, *chunk))
+            if len(pending) >= in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Binary collection file, all integers little-endian:
+#   header   magic, version, flags, book count, index offset
+#   records  per book, in ISBN order: payload length, fixed fields, then
+#            title/author/genre/publisher/tags/notes/in_collections as one
+#            UTF-8 block separated by NUL (lists by US, user/name by RS)
+#   index    all ISBNs as sorted u64, then the record offsets as u64
+BINARY_MAGIC = b'BWCL'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sHHIQ')
+BINARY_LENGTH = struct.Struct('<I')
+BINARY_FIXED = struct.Struct('<QIiIiI?')
+BINARY_SEPARATORS = ('\x00', '\x1f', '\x1e')
+
+
+class BinaryFormatError(ValueError): pass
+
+
+def _binary_record(book):
+    # a plain Book is stored with the UserBook defaults for the user fields
+    tags, notes = getattr(book, 'tags', ()), getattr(book, 'notes', ())
+    in_collections = getattr(book, 'in_collections', {})
+    book_texts = [book.title, book.author, book.genre or '', book.publisher or '']
+    texts = [*book_texts, '\x1f'.join(tags), '\x1f'.join(notes),
+             '\x1f'.join('{}\x1e{}'.format(user, collection_name)
+                         for user, collection_names in in_collections.items()
+                         for collection_name in collection_names)]
+    fields = [*book_texts, *tags, *notes,
+              *in_collections, *itertools.chain(*in_collections.values())]
+    if any(separator in field for field in fields for separator in BINARY_SEPARATORS):
+        raise BinaryFormatError('Book {} contains a reserved control character.'.format(book.isbn))
+    try:
+        fixed = BINARY_FIXED.pack(book.isbn, book.no_of_pages, book.year_published, book.edition,
+                                  getattr(book, 'rating', 0),
+                                  getattr(book, 'read_date', datetime.date.min).toordinal(),
+                                  getattr(book, 'read', False))
+    except struct.error as pack_err:
+        raise BinaryFormatError('Book {} cannot be stored: {}'.format(
+            book.isbn, pack_err)) from pack_err
+    payload = fixed + '\x00'.join(texts).encode('utf-8')
+    return BINARY_LENGTH.pack(len(payload)) + payload
+
+
+def _binary_fields(buffer, offset):
+    # offsets come from the file itself, so a damaged file must fail as
+    # BinaryFormatError rather than read past the end or raise struct.error
+    try:
+        length, = BINARY_LENGTH.unpack_from(buffer, offset)
+        start = offset + BINARY_LENGTH.size
+        if length < BINARY_FIXED.size or start + length > len(buffer):
+            raise BinaryFormatError('record at {} runs past the end of the file'.format(offset))
+        (isbn, no_of_pages, year_published, edition, rating,
+         read_date, read) = BINARY_FIXED.unpack_from(buffer, start)
+        texts = bytes(buffer[start + BINARY_FIXED.size:start + length]).decode('utf-8')
+        title, author, genre, publisher, tags, notes, in_collections = texts.split('\x00')
+        collection_names = collections.defaultdict(list)
+        for pair in in_collections.split('\x1f') if in_collections else ():
+            user, collection_name = pair.split('\x1e')
+            collection_names[user].append(collection_name)
+        read_date = datetime.date.fromordinal(read_date)
+    except BinaryFormatError:
+        raise
+    except (struct.error, ValueError) as record_err:
+        raise BinaryFormatError('bad record at {}: {}'.format(offset, record_err)) from record_err
+    return dict(isbn=isbn, title=title, author=author, genre=genre, no_of_pages=no_of_pages,
+                year_published=year_published, edition=edition, publisher=publisher,
+                notes=notes.split('\x1f') if notes else [], read=read,
+                read_date=read_date, rating=rating,
+                in_collections=collection_names,
+                tags=set(tags.split('\x1f')) if tags else set())
+
+
+def write_binary_books(fh, books):
+    # books must come in ISBN order; fh must be seekable to patch the header
+    write_binary_records(fh, ((book.isbn, _binary_record(book)) for book in books))
+
+
+def write_binary_records(fh, records):
+    # records are (isbn, _binary_record bytes) pairs in ISBN order
+    start = fh.tell()
+    fh.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, 0, 0))
+    isbns, offsets = [], []
+    position = BINARY_HEADER.size
+    chunk = []
+    for isbn, record in records:
+        isbns.append(isbn)
+        offsets.append(position)
+        position += len(record)
+        chunk.append(record)
+        if len(chunk) >= 4096:
+            fh.write(b''.join(chunk))
+            chunk = []
+    fh.write(b''.join(chunk))
+    fh.write(struct.pack('<{}Q'.format(len(isbns)), *isbns))
+    fh.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+    end = fh.tell()
+    fh.seek(start)
+    fh.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, len(isbns), position))
+    fh.seek(end)
+
+
+class _PackedColumn:
+
+    # read-only sequence over packed u64 values, so bisect can search
+    # the index in place without unpacking it
+    def __init__(self, buffer, offset, count):
+        self._buffer = buffer
+        self._offset = offset
+        self._count = count
+
+    def __getitem__(self, position):
+        if not 0 <= position < self._count:
+            raise IndexError(position)
+        return struct.unpack_from('<Q', self._buffer, self._offset + 8 * position)[0]
+
+    def __len__(self):
+        return self._count
+
+
+class BinaryCollection:
+
+    def __init__(self, path):
+        with open(path, 'rb') as fh:
+            if not os.fstat(fh.fileno()).st_size:
+                raise BinaryFormatError('{}: empty file'.format(path))
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, _, count, index_offset = BINARY_HEADER.unpack_from(self._mmap)
+        except struct.error as header_err:
+            self.close()
+            raise BinaryFormatError('{}: truncated header'.format(path)) from header_err
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            self.close()
+            raise BinaryFormatError('{}: not a version {} BookWarm collection file'.format(
+                path, BINARY_VERSION))
+        if index_offset < BINARY_HEADER.size or index_offset + 16 * count > len(self._mmap):
+            self.close()
+            raise BinaryFormatError('{}: truncated index'.format(path))
+        self._isbns = _PackedColumn(self._mmap, index_offset, count)
+        self._offsets = _PackedColumn(self._mmap, index_offset + 8 * count, count)
+
+    def _position(self, isbn):
+        position = bisect.bisect_left(self._isbns, isbn)
+        if position < len(self._isbns) and self._isbns[position] == isbn:
+            return position
+        return None
+
+    def fields(self, isbn):
+        position = self._position(isbn)
+        if position is None:
+            raise KeyError(isbn)
+        return _binary_fields(self._mmap, self._offsets[position])
+
+    def __getitem__(self, isbn):
+        return UserBook.trusted(**self.fields(isbn))
+
+    def get(self, isbn, default=None):
+        try:
+            return self[isbn]
+        except KeyError:
+            return default
+
+    def values(self):
+        for position in range(len(self._offsets)):
+            yield UserBook.trusted(**_binary_fields(self._mmap, self._offsets[position]))
+
+    def __contains__(self, isbn):
+        return self._position(isbn) is not None
+
+    def __iter__(self):
+        return iter(self._isbns)
+
+    def __len__(self):
+        return len(self._isbns)
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Server catalog file: the available books as an append-only record log
+# that any number of processes can mmap read-only, with a sorted ISBN index
+# in a side file. Little-endian throughout:
+#   <path>      header   magic, version, flags, generation
+#               records  payload length, op, isbn, no_of_pages,
+#                        year_published, edition, a bit mask of the nullable
+#                        fields that are None, then title/author/genre/
+#                        publisher as one NUL separated UTF-8 block; a put
+#                        supersedes earlier records for its ISBN, a delete
+#                        carries no text and removes it, a mark carries the
+#                        catalog_change counter the file is in step with in
+#                        place of the ISBN
+#   <path>.idx  header   magic, version, flags, generation, live books,
+#                        records and log length covered by the index, and
+#                        the last mark within that length
+#               columns  sorted ISBNs as u64, then their record offsets
+# Records past the covered length are replayed into a small overlay when
+# the file is opened or refreshed. Only one process may open it writable;
+# it holds an exclusive flock on <path>.lock while it does.
+CATALOG_MAGIC = b'BWCT'
+CATALOG_INDEX_MAGIC = b'BWCI'
+CATALOG_VERSION = 3
+CATALOG_HEADER = struct.Struct('<4sHHQ')
+CATALOG_INDEX_HEADER = struct.Struct('<4sHHQQQQQ')
+CATALOG_FIXED = struct.Struct('<BQIiIB')
+CATALOG_NULLABLE = ('genre', 'no_of_pages', 'year_published', 'edition', 'publisher')
+CATALOG_OP = struct.Struct('<BQ')
+CATALOG_PUT, CATALOG_DELETE, CATALOG_MARK = 1, 0, 2
+CATALOG_INDEX_INTERVAL = 65536
+CATALOG_STAMP_MODULUS = 2147483647
+
+
+def _catalog_put(record):
+    nulls = sum(1 << bit for bit, field in enumerate(CATALOG_NULLABLE)
+                if getattr(record, field) is None)
+    texts = tuple(text or '' for text in
+                  (record.title, record.author, record.genre, record.publisher))
+    if any('\x00' in text for text in texts):
+        raise BinaryFormatError('Book {} contains a NUL character.'.format(record.isbn))
+    payload = (CATALOG_FIXED.pack(CATALOG_PUT, record.isbn, record.no_of_pages or 0,
+                                  record.year_published or 0, record.edition or 0, nulls) +
+               '\x00'.join(texts).encode('utf-8'))
+    return BINARY_LENGTH.pack(len(payload)) + payload
+
+
+def _catalog_delete(isbn):
+    payload = CATALOG_FIXED.pack(CATALOG_DELETE, isbn, 0, 0, 0, 0)
+    return BINARY_LENGTH.pack(len(payload)) + payload
+
+
+def _catalog_mark(change):
+    payload = CATALOG_FIXED.pack(CATALOG_MARK, change, 0, 0, 0, 0)
+    return BINARY_LENGTH.pack(len(payload)) + payload
+
+
+class CatalogLockedError(RuntimeError): pass
+
+
+def _lock_catalog(path):
+    # the lock lives in a side file because rewrite() replaces the log
+    lock_fh = open('{}.lock'.format(path), 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_fh.close()
+            raise CatalogLockedError('{} is open for writing by another process.'.format(path))
+    return lock_fh
+
+
+def _catalog_book(buffer, offset):
+    length, = BINARY_LENGTH.unpack_from(buffer, offset)
+    start = offset + BINARY_LENGTH.size
+    _, isbn, no_of_pages, year_published, edition, nulls = CATALOG_FIXED.unpack_from(
+        buffer, start)
+    title, author, genre, publisher = bytes(
+        buffer[start + CATALOG_FIXED.size:start + length]).decode('utf-8').split('\x00')
+    record = BookRecord(isbn, title, author, _intern(genre), no_of_pages,
+                        year_published, edition, _intern(publisher))
+    if nulls:
+        record = record._replace(**{field: None for bit, field in enumerate(CATALOG_NULLABLE)
+                                    if nulls & (1 << bit)})
+    return record
+
+
+def catalog_stamp(isbns, change=0):
+    # cheap fingerprint of a set of ISBNs plus the catalog_change counter
+    # it was read at, computed the same way in SQL by Book.catalog_stamp so
+    # a stale catalog file is caught at start
+    return len(isbns), sum(isbn % CATALOG_STAMP_MODULUS for isbn in isbns), change
+
+
+class CatalogFile:
+
+    # persistent isbn -> BookRecord mapping; lookups bisect the mmapped
+    # index and decode a single record, nothing is hydrated up front
+    def __init__(self, path, writable=False):
+        self._lock = threading.Lock()
+        self._path = path
+        self._index_path = '{}.idx'.format(path)
+        self._writable = writable
+        self._fh = None
+        self._mmap = None
+        self._index_mmap = None
+        self._lock_fh = _lock_catalog(path) if writable else None
+        try:
+            if writable and not os.path.exists(path):
+                self._write_files(())
+            self._open()
+        except Exception:
+            self._unlock()
+            raise
+
+    def _open(self):
+        with open(self._path, 'rb') as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._inode = os.fstat(fh.fileno()).st_ino
+        try:
+            magic, version, _, self._generation = CATALOG_HEADER.unpack_from(self._mmap)
+        except struct.error as header_err:
+            self._close_maps()
+            raise BinaryFormatError('{}: truncated header'.format(self._path)) from header_err
+        if magic != CATALOG_MAGIC or version != CATALOG_VERSION:
+            self._close_maps()
+            raise BinaryFormatError('{}: not a version {} BookWarm catalog file'.format(
+                self._path, CATALOG_VERSION))
+        covered = self._open_index()
+        self._tail = {}
+        self._length = self._replay(covered)
+        if self._writable:
+            if self._length < len(self._mmap):
+                # drop a record cut short by a crash mid-append
+                os.truncate(self._path, self._length)
+                self._remap()
+            self._fh = open(self._path, 'ab')
+            if self._index_mmap is None or len(self._tail) >= CATALOG_INDEX_INTERVAL:
+                self._write_index()
+
+    def _open_index(self):
+        self._index_mmap = None
+        self._isbns = self._offsets = _PackedColumn(b'', 0, 0)
+        self._count = self._superseded = self._change = 0
+        try:
+            with open(self._index_path, 'rb') as fh:
+                index_mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            (magic, version, _, generation, count, records,
+             covered, change) = CATALOG_INDEX_HEADER.unpack_from(index_mmap)
+        except (EnvironmentError, ValueError, struct.error):
+            return CATALOG_HEADER.size
+        if (magic != CATALOG_INDEX_MAGIC or version != CATALOG_VERSION
+                or generation != self._generation or covered > len(self._mmap)
+                or CATALOG_INDEX_HEADER.size + 16 * count > len(index_mmap)):
+            index_mmap.close()
+            return CATALOG_HEADER.size
+        self._index_mmap = index_mmap
+        self._isbns = _PackedColumn(index_mmap, CATALOG_INDEX_HEADER.size, count)
+        self._offsets = _PackedColumn(index_mmap, CATALOG_INDEX_HEADER.size + 8 * count, count)
+        self._count = count
+        self._superseded = records - count
+        self._change = change
+        return covered
+
+    def _replay(self, offset, touched=None):
+        buffer = self._mmap
+        end = len(buffer)
+        while offset + BINARY_LENGTH.size + CATALOG_FIXED.size <= end:
+            length, = BINARY_LENGTH.unpack_from(buffer, offset)
+            if offset + BINARY_LENGTH.size + length > end:
+                break
+            op, isbn = CATALOG_OP.unpack_from(buffer, offset + BINARY_LENGTH.size)
+            self._apply(op, isbn, offset)
+            if touched is not None and op != CATALOG_MARK:
+                touched.add(isbn)
+            offset += BINARY_LENGTH.size + length
+        return offset
+
+    def _apply(self, op, isbn, offset):
+        if op == CATALOG_MARK:
+            self._change = isbn
+            return
+        present = self._offset(isbn) is not None
+        self._tail[isbn] = offset if op == CATALOG_PUT else None
+        self._count += (op == CATALOG_PUT) - present
+        self._superseded += present + (op == CATALOG_DELETE)
+
+    def _offset(self, isbn):
+        if isbn in self._tail:
+            return self._tail[isbn]
+        position = bisect.bisect_left(self._isbns, isbn)
+        if position < len(self._isbns) and self._isbns[position] == isbn:
+            return self._offsets[position]
+        return None
+
+    def _read(self, offset):
+        if offset >= len(self._mmap):
+            self._remap()
+        return _catalog_book(self._mmap, offset)
+
+    def _remap(self):
+        with open(self._path, 'rb') as fh:
+            remapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mmap.close()
+        self._mmap = remapped
+
+    def _live_offsets(self):
+        isbns = offsets = ()
+        if self._index_mmap is not None:
+            count = len(self._isbns)
+            isbns = struct.unpack_from('<{}Q'.format(count), self._index_mmap,
+                                       CATALOG_INDEX_HEADER.size)
+            offsets = struct.unpack_from('<{}Q'.format(count), self._index_mmap,
+                                         CATALOG_INDEX_HEADER.size + 8 * count)
+        if not self._tail:
+            return isbns, offsets
+        live = [(isbn, offset) for isbn, offset in zip(isbns, offsets)
+                if isbn not in self._tail]
+        live.extend((isbn, offset) for isbn, offset in self._tail.items() if offset is not None)
+        live.sort()
+        return [isbn for isbn, _ in live], [offset for _, offset in live]
+
+    def _write_index(self):
+        isbns, offsets = self._live_offsets()
+        records = len(isbns) + self._superseded
+
+        def write_index(fh):
+            fh.write(CATALOG_INDEX_HEADER.pack(CATALOG_INDEX_MAGIC, CATALOG_VERSION, 0,
+                                               self._generation, len(isbns), records,
+                                               self._length, self._change))
+            fh.write(struct.pack('<{}Q'.format(len(isbns)), *isbns))
+            fh.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+
+        _atomic_save(self._index_path, write_index)
+        previous_index = self._index_mmap
+        self._open_index()
+        self._tail = {}
+        if previous_index is not None:
+            previous_index.close()
+
+    def _write_files(self, records, change=0):
+        # records must come in ISBN order
+        self._generation = int.from_bytes(os.urandom(8), 'little')
+        self._change = change
+        self._length = CATALOG_HEADER.size
+        self._superseded = 0
+        isbns, offsets = [], []
+
+        def write_log(fh):
+            fh.write(CATALOG_HEADER.pack(CATALOG_MAGIC, CATALOG_VERSION, 0, self._generation))
+            chunk = []
+            for record in records:
+                data = _catalog_put(record)
+                isbns.append(record.isbn)
+                offsets.append(self._length)
+                self._length += len(data)
+                chunk.append(data)
+                if len(chunk) >= 4096:
+                    fh.write(b''.join(chunk))
+                    chunk = []
+            # the mark keeps the log alone complete should the index be lost
+            chunk.append(_catalog_mark(change))
+            self._length += len(chunk[-1])
+            fh.write(b''.join(chunk))
+
+        def write_index(fh):
+            fh.write(CATALOG_INDEX_HEADER.pack(CATALOG_INDEX_MAGIC, CATALOG_VERSION, 0,
+                                               self._generation, len(isbns), len(isbns),
+                                               self._length, change))
+            fh.write(struct.pack('<{}Q'.format(len(isbns)), *isbns))
+            fh.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+
+        _atomic_save(self._path, write_log)
+        _atomic_save(self._index_path, write_index)
+
+    def _append(self, op, entries):
+        assert self._writable, 'Catalog file is open read-only.'
+        self._fh.write(b''.join(data for _, data in entries))
+        self._fh.flush()
+        for isbn, data in entries:
+            self._apply(op, isbn, self._length)
+            self._length += len(data)
+        if len(self._tail) >= CATALOG_INDEX_INTERVAL:
+            self._write_index()
+
+    def update(self, records):
+        entries = [(record.isbn, _catalog_put(record)) for record in records]
+        with self._lock:
+            self._append(CATALOG_PUT, entries)
+
+    def __setitem__(self, isbn, record):
+        assert int(isbn) == record.isbn, 'Key must be the record ISBN.'
+        self.update([record])
+
+    def pop(self, isbn, *default):
+        isbn = int(isbn)
+        with self._lock:
+            offset = self._offset(isbn)
+            if offset is None:
+                if default:
+                    return default[0]
+                raise KeyError(isbn)
+            record = self._read(offset)
+            self._append(CATALOG_DELETE, [(isbn, _catalog_delete(isbn))])
+        return record
+
+    def rewrite(self, records, change=0):
+        # replaces the whole log with the given records, in ISBN order, and
+        # drops every superseded record; readers keep the old file until
+        # they refresh
+        assert self._writable, 'Catalog file is open read-only.'
+        with self._lock:
+            self._write_files(records, change)
+            self._close_maps()
+            self._open()
+
+    def compact(self):
+        self.rewrite([self[isbn] for isbn in self.isbns()], self._change)
+
+    def mark(self, change):
+        # records the catalog_change counter the file is now in step with
+        with self._lock:
+            self._append(CATALOG_MARK, [(change, _catalog_mark(change))])
+
+    @property
+    def change(self):
+        return self._change
+
+    def stale(self):
+        # cheap check for a reader: the writer appended or rewrote the file
+        stat = os.stat(self._path)
+        return stat.st_ino != self._inode or stat.st_size != self._length
+
+    def refresh(self):
+        # returns the ISBNs put or deleted since the last refresh, or None
+        # when the file was rewritten and any book may have changed
+        with self._lock:
+            if os.stat(self._path).st_ino != self._inode:
+                self._close_maps()
+                self._open()
+                return None
+            touched = set()
+            self._remap()
+            self._length = self._replay(self._length, touched)
+            return touched
+
+    def __getitem__(self, isbn):
+        with self._lock:
+            offset = self._offset(int(isbn))
+            if offset is None:
+                raise KeyError(isbn)
+            return self._read(offset)
+
+    def get(self, isbn, default=None):
+        try:
+            return self[isbn]
+        except KeyError:
+            return default
+
+    def isbns(self):
+        with self._lock:
+            return list(self._live_offsets()[0])
+
+    def items(self):
+        for isbn in self.isbns():
+            record = self.get(isbn)
+            if record is not None:
+                yield isbn, record
+
+    def __contains__(self, isbn):
+        with self._lock:
+            return self._offset(int(isbn)) is not None
+
+    def __iter__(self):
+        return iter(self.isbns())
+
+    def __len__(self):
+        return self._count
+
+    def _close_maps(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if self._index_mmap is not None:
+            self._index_mmap.close()
+            self._index_mmap = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _unlock(self):
+        if self._lock_fh is not None:
+            self._lock_fh.close()
+            self._lock_fh = None
+
+    def close(self):
+        if self._writable and self._mmap is not None and self._superseded > self._count:
+            self.compact()
+        with self._lock:
+            if self._writable and self._tail and self._mmap is not None:
+                self._write_index()
+            self._close_maps()
+            self._unlock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MappedBookCatalog(BookCatalog):
+
+    # BookCatalog over a CatalogFile: the records stay in the shared file
+    # and only the sorted ISBN list and any secondary indexes are in memory
+    def __init__(self, path, writable=True):
+        self._lock = threading.Lock()
+        self._books = CatalogFile(path, writable)
+        self._sorted_isbns = self._books.isbns()
+        self._indexes = {}
+        self._version = 0
+
+    def load(self, books, change=0):
+        records = {book.isbn: BookRecord.from_book(book) for book in books}
+        with self._lock:
+            self._books.rewrite((records[isbn] for isbn in sorted(records)), change)
+            self._sorted_isbns = self._books.isbns()
+            self._indexes = {}
+            self._version += 1
+
+    def put_many(self, books):
+        records = []
+        for book in books:
+            assert isinstance(book, (Book, BookRecord)), 'Must be Book (sub)class or BookRecord.'
+            records.append(BookRecord.from_book(book))
+        with self._lock:
+            new_isbns = {record.isbn for record in records if record.isbn not in self._books}
+            self._books.update(records)
+            self._sorted_isbns.extend(new_isbns)
+            self._sorted_isbns.sort()
+            self._indexes = {}
+            self._version += 1
+
+    def stale(self):
+        return self._books.stale()
+
+    def refresh(self):
+        # returns the ISBNs changed by the writer, see CatalogFile.refresh
+        with self._lock:
+            touched = self._books.refresh()
+            if touched is None:
+                self._sorted_isbns = self._books.isbns()
+            else:
+                for isbn in sorted(touched):
+                    position = bisect.bisect_left(self._sorted_isbns, isbn)
+                    listed = (position < len(self._sorted_isbns) and
+                              self._sorted_isbns[position] == isbn)
+                    if isbn in self._books and not listed:
+                        self._sorted_isbns.insert(position, isbn)
+                    elif isbn not in self._books and listed:
+                        del self._sorted_isbns[position]
+            self._indexes = {}
+            self._version += 1
+            return touched
+
+    def mark(self, change):
+        self._books.mark(change)
+
+    @property
+    def change(self):
+        return self._books.change
+
+    def stamp(self):
+        with self._lock:
+            return catalog_stamp(self._sorted_isbns, self._books.change)
+
+    def close(self):
+        with self._lock:
+            self._books.close()
+
+
+# Collection journal, kept next to a binary collection snapshot as
+# <snapshot>.journal, little-endian:
+#   entries  payload length, CRC-32 of the payload, then the payload: an op
+#            byte followed by a full binary book record (add/update) or the
+#            ISBN as u64 (remove)
+# Entries carry whole book states, so replaying one twice is harmless and
+# replay stops at the first torn or corrupt entry. Compaction moves the
+# journal aside to <snapshot>.journal.compacting, writes a new snapshot in
+# a background thread and then deletes the moved journal; opening replays
+# snapshot, moved journal and journal, in that order.
+JOURNAL_ENTRY = struct.Struct('<II')
+JOURNAL_ISBN = struct.Struct('<Q')
+JOURNAL_ADD, JOURNAL_UPDATE, JOURNAL_REMOVE = 1, 2, 3
+JOURNAL_COMPACT_SIZE = 64 * 1024 * 1024
+
+
+def _scan_journal(buffer, latest):
+    # records the last entry per ISBN as (buffer, record offset) or None for
+    # a removal, decoding nothing else; returns the length of the valid prefix
+    view = memoryview(buffer)
+    offset = 0
+    while offset + JOURNAL_ENTRY.size <= len(buffer):
+        length, checksum = JOURNAL_ENTRY.unpack_from(buffer, offset)
+        start = offset + JOURNAL_ENTRY.size
+        if (length < 1 + JOURNAL_ISBN.size or start + length > len(buffer)
+                or zlib.crc32(view[start:start + length]) != checksum):
+            break
+        if buffer[start] == JOURNAL_REMOVE:
+            isbn, = JOURNAL_ISBN.unpack_from(buffer, start + 1)
+            latest[isbn] = None
+        else:
+            isbn, = JOURNAL_ISBN.unpack_from(buffer, start + 1 + BINARY_LENGTH.size)
+            latest[isbn] = (buffer, start + 1)
+        offset = start + length
+    return offset
+
+
+class CollectionJournal:
+
+    def __init__(self, snapshot_path, compact_size=JOURNAL_COMPACT_SIZE):
+        self._lock = threading.Lock()
+        self._snapshot_path = snapshot_path
+        self._journal_path = '{}.journal'.format(snapshot_path)
+        self._compacting_path = '{}.compacting'.format(self._journal_path)
+        self._compact_size = compact_size
+        self._compaction = None
+        self._fh = None
+
+    @property
+    def size(self):
+        with self._lock:
+            return self._fh.tell() if self._fh is not None else 0
+
+    def replay(self):
+        # every surviving book is decoded once, however often it was journaled
+        latest = {}
+        journal_length = 0
+        for path in (self._compacting_path, self._journal_path):
+            if os.path.exists(path):
+                with open(path, 'rb') as fh:
+                    journal_length = _scan_journal(fh.read(), latest)
+        books = {}
+        if os.path.exists(self._snapshot_path):
+            with BinaryCollection(self._snapshot_path) as snapshot:
+                for isbn in snapshot:
+                    if isbn not in latest:
+                        books[isbn] = snapshot[isbn]
+        for isbn, entry in latest.items():
+            if entry is not None:
+                books[isbn] = UserBook.trusted(**_binary_fields(*entry))
+        return books, journal_length
+
+    def open(self):
+        books, journal_length = self.replay()
+        self._fh = open(self._journal_path, 'ab')
+        if self._fh.tell() > journal_length:
+            # drop an entry torn by a crash so new ones stay reachable
+            self._fh.truncate(journal_length)
+        return books
+
+    def _append(self, payload):
+        entry = JOURNAL_ENTRY.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            self._fh.write(entry)
+            self._fh.flush()
+            return (self._fh.tell() >= self._compact_size
+                    and (self._compaction is None or not self._compaction.is_alive()))
+
+    def add(self, book):
+        return self._append(bytes((JOURNAL_ADD,)) + _binary_record(book))
+
+    def update(self, book):
+        return self._append(bytes((JOURNAL_UPDATE,)) + _binary_record(book))
+
+    def remove(self, isbn):
+        return self._append(bytes((JOURNAL_REMOVE,)) + JOURNAL_ISBN.pack(isbn))
+
+    def compact(self, books, wait=False):
+        # books must be the whole collection in ISBN order; they are encoded
+        # here so the writer thread never reads books that may still change
+        assert self._fh is not None, 'Journal is not open.'
+        with self._lock:
+            running = self._compaction is not None and self._compaction.is_alive()
+        records = None if running else [(book.isbn, _binary_record(book)) for book in books]
+        with self._lock:
+            if records is not None and (self._compaction is None
+                                        or not self._compaction.is_alive()):
+                self._fh.close()
+                if os.path.exists(self._compacting_path):
+                    # an earlier compaction failed; keep its entries first
+                    with open(self._journal_path, 'rb') as journal, \
+                            open(self._compacting_path, 'ab') as compacting:
+                        compacting.write(journal.read())
+                    os.remove(self._journal_path)
+                else:
+                    os.replace(self._journal_path, self._compacting_path)
+                self._fh = open(self._journal_path, 'ab')
+                self._compaction = threading.Thread(target=self._write_snapshot,
+                                                    args=(records,), daemon=True)
+                self._compaction.start()
+            compaction = self._compaction
+        if wait:
+            compaction.join()
+
+    def _write_snapshot(self, records):
+        try:
+            _atomic_save(self._snapshot_path, lambda fh: write_binary_records(fh, records))
+            os.remove(self._compacting_path)
+        except (IOError, EnvironmentError, BinaryFormatError) as compact_err:
+            print('{} compaction error: {}'.format(os.path.basename(sys.argv[0]), compact_err))
+
+    def close(self):
+        with self._lock:
+            compaction = self._compaction
+        if compaction is not None:
+            compaction.join()
+        with self._lock:
+            if self._fh is not None:
+                self._fh.flush()
+                os.fsync(self._fh.fileno())
+                self._fh.close()
+                self._fh = None
+
+
+_NO_TAGS = frozenset()
+
+
+class TagIndex:
+
+    # each tag keeps the set of isbns carrying it, so building is one pass
+    # over the tags and AND/OR/NOT cost the size of the sets involved; a
+    # sorted isbn list serves pages of NOT-only and very broad queries
+    def __init__(self, tagged=()):
+        self._lock = threading.Lock()
+        self._tags = {}
+        self._postings = {}
+        for isbn, tags in tagged:
+            if isbn in self._tags:
+                self._clear(isbn)
+            self._tags[isbn] = set(tags) if tags else _NO_TAGS
+            for tag in self._tags[isbn]:
+                self._postings.setdefault(tag, set()).add(isbn)
+        self._sorted = sorted(self._tags)
+        self._added = []
+        self._removed = set()
+
+    def add(self, isbn, tag):
+        with self._lock:
+            self._known(isbn).add(tag)
+            self._postings.setdefault(tag, set()).add(isbn)
+
+    def set_tags(self, isbn, tags):
+        with self._lock:
+            self._clear(isbn)
+            self._known(isbn).update(tags)
+            for tag in self._tags[isbn]:
+                self._postings.setdefault(tag, set()).add(isbn)
+
+    def discard(self, isbn):
+        with self._lock:
+            if isbn in self._tags:
+                self._clear(isbn)
+                del self._tags[isbn]
+                self._removed.add(isbn)
+
+    def query(self, all_of=(), any_of=(), none_of=()):
+        return self.page(all_of, any_of, none_of, limit=None)[0]
+
+    def page(self, all_of=(), any_of=(), none_of=(), after=None, limit=100):
+        with self._lock:
+            isbns = self._select(all_of, any_of, none_of, after, limit)
+        more = limit is not None and len(isbns) > limit
+        isbns = isbns[:limit]
+        return isbns, (isbns[-1] if more else None)
+
+    def frequencies(self):
+        with self._lock:
+            return {tag: len(isbns) for tag, isbns in self._postings.items()}
+
+    def tags_of(self, isbn):
+        with self._lock:
+            return set(self._tags.get(isbn, ()))
+
+    def _select(self, all_of, any_of, none_of, after, limit):
+        # returns up to limit + 1 isbns above after, the extra one only
+        # tells page() that another page follows
+        all_postings = sorted((self._postings.get(tag, _NO_TAGS) for tag in all_of), key=len)
+        any_postings = [self._postings.get(tag, _NO_TAGS) for tag in any_of]
+        excluded = [self._postings[tag] for tag in none_of if tag in self._postings]
+        if all_of:
+            matches = len(all_postings[0])
+        elif any_of:
+            matches = sum(map(len, any_postings))
+        else:
+            matches = len(self._tags)
+        if limit is None or matches * 8 < len(self._tags):
+            candidates = all_postings[0].intersection(*all_postings[1:]) if all_of else None
+            if any_of:
+                any_isbns = set().union(*any_postings)
+                candidates = any_isbns if candidates is None else candidates & any_isbns
+            if candidates is None:
+                candidates = self._sorted_isbns()
+            ordered = sorted(isbn for isbn in candidates if after is None or isbn > after)
+            all_postings = any_postings = ()
+        else:
+            # broad query: walk the sorted isbns from the page token and
+            # stop once the page is full instead of collecting every match
+            sorted_isbns = self._sorted_isbns()
+            start = 0 if after is None else bisect.bisect_right(sorted_isbns, after)
+            ordered = (sorted_isbns[pos] for pos in range(start, len(sorted_isbns)))
+        isbns = []
+        for isbn in ordered:
+            if (all(isbn in tagged for tagged in all_postings) and
+                    (not any_postings or any(isbn in tagged for tagged in any_postings)) and
+                    not any(isbn in tagged for tagged in excluded)):
+                isbns.append(isbn)
+                if limit is not None and len(isbns) > limit:
+                    break
+        return isbns
+
+    def _sorted_isbns(self):
+        # changes since the last walk are merged in one pass; sorted() is
+        # linear over the part that is already in order
+        if self._removed:
+            self._sorted = [isbn for isbn in self._sorted if isbn not in self._removed]
+            self._added = [isbn for isbn in self._added if isbn not in self._removed]
+            self._removed = set()
+        if self._added:
+            self._sorted = sorted(self._sorted + self._added)
+            self._added = []
+        return self._sorted
+
+    def _known(self, isbn):
+        tags = self._tags.get(isbn)
+        if tags is _NO_TAGS:
+            tags = self._tags[isbn] = set()
+        elif tags is None:
+            tags = self._tags[isbn] = set()
+            if isbn in self._removed:
+                # discarded since the last walk, so still listed
+                self._removed.discard(isbn)
+            else:
+                self._added.append(isbn)
+        return tags
+
+    def _clear(self, isbn):
+        for tag in self._tags.get(isbn, ()):
+            self._postings[tag].discard(isbn)
+            if not self._postings[tag]:
+                del self._postings[tag]
+        if isbn in self._tags:
+            self._tags[isbn] = _NO_TAGS
+
+    def __contains__(self, isbn):
+        return isbn in self._tags
+
+    def __len__(self):
+        return len(self._tags)
+
+
 def delegate_methods(attribute_name, method_names):
     def decorator(cls):
         nonlocal attribute_name
@@ -263,17 +1999,19 @@ def delegate_methods(attribute_name, method_names):
     return decorator
 
 
-@delegate_methods('__book_collection', ('pop', '__getitem__', '__delitem__',
-                                        '__len__', '__str__', '__repr__',
+@delegate_methods('__book_collection', ('__getitem__', '__len__', '__str__', '__repr__',
                                         '__values__', '__items__'))
 class BookCollection(DB_BASE):
 
     __tablename__ = 'book_collection'
+    __table_args__ = (Index('ix_book_collection_user_collection_name',
+                            'user', 'collection_name', unique=True),)
 
     id = Column(Integer, primary_key=True)
     user = Column(String, nullable=False)
     collection_name = Column(String, nullable=False)
-    __book_collection = Column(PickleType)
+    __book_collection = relationship(Book, secondary=collection_book,
+                                     collection_class=attribute_mapped_collection('isbn'))
 
     available_filters = ('isbn', 'title', 'author', 'genre', 'year_published',
                          'edition', 'publisher')
@@ -288,6 +2026,8 @@ class BookCollection(DB_BASE):
         assert isinstance(collection_name, str) and len(collection_name) > 1, (
             'Must be a non-empty string')
         self.collection_name = collection_name
+        self.__reset_indexes()
+        self.__journal = None
         self.__book_collection = {}
         if book_collection:
             assert isinstance(book_collection, dict), 'Must be a dict class.'
@@ -295,15 +2035,63 @@ class BookCollection(DB_BASE):
                 'Each item of book_collection has to be Book (sub)class')
             self.__book_collection = book_collection
 
+    @classmethod
+    def by_name(cls, session, user, collection_name):
+        return session.query(cls).filter(cls.user == user,
+                                         cls.collection_name == collection_name).one_or_none()
+
+    @classmethod
+    def delete_by_name(cls, session, user, collection_name):
+        return session.query(cls).filter(
+            cls.user == user, cls.collection_name == collection_name).delete(
+                synchronize_session=False)
+
+    @reconstructor
+    def _init_on_load(self):
+        self.__reset_indexes()
+        self.__journal = None
+
     def __setitem__(self, isbn, book_instance):
         assert isinstance(book_instance, Book), 'Must be Book (sub)class.'
         assert isinstance(isbn, int) and (len(str(isbn)) == 10 or len(str(isbn)) == 13), (
             'ISBN must be non-empty integer of 10 or 13 digits.')
+        compaction_due = False
+        if self.__journal is not None:
+            if isbn in self.__book_collection:
+                compaction_due = self.__journal.update(book_instance)
+            else:
+                compaction_due = self.__journal.add(book_instance)
+        if isbn in self.__book_collection:
+            self.__unindex(isbn, self.__book_collection[isbn])
+        elif self.__sorted_isbns is not None:
+            bisect.insort(self.__sorted_isbns, isbn)
         self.__book_collection[isbn] = book_instance
+        self.__index(isbn, book_instance)
+        self.__journaled(compaction_due)
+
+    def __delitem__(self, isbn):
+        compaction_due = False
+        if self.__journal is not None and isbn in self.__book_collection:
+            compaction_due = self.__journal.remove(isbn)
+        self.__unindex(isbn, self.__book_collection.pop(isbn))
+        self.__forget(isbn)
+        self.__journaled(compaction_due)
+
+    def pop(self, isbn, *default):
+        if isbn not in self.__book_collection:
+            return self.__book_collection.pop(isbn, *default)
+        compaction_due = self.__journal is not None and self.__journal.remove(isbn)
+        book_instance = self.__book_collection.pop(isbn)
+        self.__unindex(isbn, book_instance)
+        self.__forget(isbn)
+        self.__journaled(compaction_due)
+        return book_instance
 
     def __iter__(self):
-        for isbn in sorted(self.__book_collection):
-            yield isbn
+        if self.__sorted_isbns is None:
+            self.__sorted_isbns = sorted(self.__book_collection)
+        # iterate a copy so the collection may change while it is walked
+        return iter(self.__sorted_isbns[:])
 
     keys = __iter__
 
@@ -316,224 +2104,469 @@ class BookCollection(DB_BASE):
             yield (isbn, self.__book_collection[isbn])
 
     def filter(self, key):
+        # books without a value (NULL genre or publisher) come last
+        return ([self.__book_collection[isbn] for _, isbn in self._sorted_index(key)] +
+                [self.__book_collection[isbn] for isbn in self
+                 if getattr(self.__book_collection[isbn], key) is None])
+
+    def between(self, key, low=None, high=None):
+        index = self._sorted_index(key)
+        position = 0 if low is None else bisect.bisect_left(index, (low,))
+        while position < len(index):
+            value, isbn = index[position]
+            if high is not None and value > high:
+                return
+            yield self.__book_collection[isbn]
+            position += 1
+
+    def add_tag(self, isbn, tag):
+        # tag through the collection (or store the book again) so the
+        # tag index sees it; UserBook.add_tag alone bypasses the index
+        self.__book_collection[isbn].add_tag(tag)
+        if self.__tag_index is not None:
+            self.__tag_index.add(isbn, tag)
+        if self.__journal is not None:
+            self.__journaled(self.__journal.update(self.__book_collection[isbn]))
+
+    def tagged(self, all_of=(), any_of=(), none_of=()):
+        return [self.__book_collection[isbn]
+                for isbn in self._tag_index().query(all_of, any_of, none_of)]
+
+    def tag_frequencies(self):
+        return self._tag_index().frequencies()
+
+    def index_count(self, key, low=None, high=None):
+        start, stop = _index_bounds(self._sorted_index(key), low, high)
+        return stop - start
+
+    def index_range(self, key, low=None, high=None):
+        index = self._sorted_index(key)
+        start, stop = _index_bounds(index, low, high)
+        return [isbn for _, isbn in index[start:stop]]
+
+    def startswith(self, key, prefix):
+        index = self._sorted_index(key)
+        position = bisect.bisect_left(index, (prefix,))
+        while position < len(index):
+            value, isbn = index[position]
+            if not value.startswith(prefix):
+                return
+            yield self.__book_collection[isbn]
+            position += 1
+
+    def _sorted_index(self, key):
         if key not in BookCollection.available_filters:
             raise KeyError('Valid filters: {}'.format(
                 ' '.join(BookCollection.available_filters)))
-        return sorted(self.__book_collection.values(), key=operator.attrgetter(key))
-
-    def save_to_text(self):
-        filename = '{} {}.txt'.format(self.user, self.collection_name)
-        fullpath_to_save = os.path.join(os.path.dirname(__file__), filename)
+        if key not in self.__indexes:
+            # as in BookCatalog, None values are left out of the index
+            self.__indexes[key] = sorted((getattr(book_instance, key), isbn)
+                                         for isbn, book_instance in self.__book_collection.items()
+                                         if getattr(book_instance, key) is not None)
+        return self.__indexes[key]
+
+    def _tag_index(self):
+        if self.__tag_index is None:
+            self.__tag_index = TagIndex((isbn, getattr(book_instance, 'tags', None) or ())
+                                        for isbn, book_instance in self.__book_collection.items())
+        return self.__tag_index
+
+    def __reset_indexes(self):
+        self.__indexes = {}
+        self.__sorted_isbns = None
+        self.__tag_index = None
+
+    def __journaled(self, compaction_due):
+        # called once the change is applied, so the snapshot includes it
+        if compaction_due:
+            self.__journal.compact([self.__book_collection[isbn] for isbn in self])
+
+    def __forget(self, isbn):
+        if self.__sorted_isbns is not None:
+            del self.__sorted_isbns[bisect.bisect_left(self.__sorted_isbns, isbn)]
+        if self.__tag_index is not None:
+            self.__tag_index.discard(isbn)
+
+    def __index(self, isbn, book_instance):
+        for key, index in self.__indexes.items():
+            if getattr(book_instance, key) is not None:
+                bisect.insort(index, (getattr(book_instance, key), isbn))
+        if self.__tag_index is not None:
+            self.__tag_index.set_tags(isbn, getattr(book_instance, 'tags', None) or ())
+
+    def __unindex(self, isbn, book_instance):
+        for key, index in list(self.__indexes.items()):
+            entry = (getattr(book_instance, key), isbn)
+            if entry[0] is None:
+                # not indexed, unless it held a value when it was
+                del self.__indexes[key]
+                continue
+            position = bisect.bisect_left(index, entry)
+            if position < len(index) and index[position] == entry:
+                del index[position]
+            else:
+                # the book was edited in place since it was indexed
+                del self.__indexes[key]
+
+    def find_book(self, session, isbn):
+        return Book.in_collection(session, self.id, isbn).one_or_none()
+
+    def add_book(self, session, book):
+        session.execute(collection_book.insert().values(collection_id=self.id,
+                                                        book_id=book.id))
+        session.expire(self, ['_BookCollection__book_collection'])
+        self.__reset_indexes()
+
+    def remove_book(self, session, isbn):
+        book = self.find_book(session, isbn)
+        if book is not None:
+            session.execute(collection_book.delete().where(
+                (collection_book.c.collection_id == self.id) &
+                (collection_book.c.book_id == book.id)))
+            session.expire(self, ['_BookCollection__book_collection'])
+            self.__reset_indexes()
+        return book
+
+    def save_to_text(self, file=None):
         try:
-            with open(fullpath_to_save, 'w') as fh:
-                for book in self.__book_collection.values():
-                    in_collections = ''
-                    for user in book.in_collections:
-                        in_collections += '  {}: {}'.format(
-                            user, ','.join(collection_name
-                                           for collection_name in book.in_collections[user]))
-                    fh.write('[{0.isbn}]\n'
-                             '\ttitle={0.title}\n'
-                             '\tauthor={0.author}\n'
-                             '\tgenre={0.genre}\n'
-                             '\tno_of_pages={0.no_of_pages}\n'
-                             '\tyear_published={0.year_published}\n'
-                             '\tedition={0.edition}\n'
-                             '\tpublisher={0.publisher}\n'
-                             '\tread={0.read}\n'
-                             '\tread_date={0.read_date}\n'
-                             '\trating={0.rating}\n'
-                             '\ttags={tags}\n'
-                             '\tin_collections={in_collections}\n'
-                             '\tNOTES>\n'
-                             '\t\t{notes}\n'
-                             '\t<NOTES\n\n'.format(book,
-                                                      tags=' '.join(book.tags),
-                                                      in_collections=in_collections.strip(),
-                                                      notes='\n\t\t'.join(('{}'.format(line)
-                                                                           for line in book.notes))))
+            if file is None or isinstance(file, str):
+                filename = '{} {}.txt'.format(self.user, self.collection_name)
+                fullpath_to_save = file or os.path.join(os.path.dirname(__file__), filename)
+                _atomic_save(fullpath_to_save, self.write_text)
+            else:
+                self.write_text(file)
             return True
         except (EnvironmentError, IOError, UnicodeError) as save_err:
             print('Error while saving collection {}: {}'.format(self.collection_name,
                                                                 save_err))
             return False
 
-    def _parse_text(self, text):
-
-        """ BNF
-
-
-            BOOK         ::=        BOOK_ISBN \s* ATTR_LIST \s* NOTES 
-            NOTES        ::=        'NOTES>' NOTES_VALUES '<NOTES'
-            NOTES_VALUES ::=        TEXT 
-                                    | TEXT \s* NOTES_VALUES
-            ATTR_LIST    ::=        ATTR 
-                                    | ATTR \s* ATTR_LIST
-            ATTR         ::=        KEY \s* = \s* VALUE
-            VALUE        ::=        TEXT 
-                                    | INT
-                                    | DATE
-            BOOK_ISBN    ::=        '[' INT ']'
-            KEY          ::=        [a-zA-Z_]+
-            INT          ::=        \d+
-            TEXT         ::=        [^\s]+
-            DATE         ::=        \d{4}-\d{2}-\d{2} 
-
-        """
-
-        def set_book_key(tokens):
-            nonlocal current_key
-            current_key = tokens.isbn[0]
-            parsed_books[current_key]['isbn'] = int(current_key)
+    def write_text(self, fh):
+        _write_chunks(fh, self._text_records())
 
-        def get_in_collection_value(key, value):
-            in_collections = {}
-            items = value.split('  ')
-            for item in items:
-                user, collection_names = item.split(':')
-                in_collections[user] = (collection_names.strip().split(',')
-                                        if ',' in collection_names else [collection_names.strip()])
-            return in_collections
-
-        def add_book_attr(tokens):
-            key, value = tokens[0].strip(), tokens[1].strip()
-            if key == 'in_collections' and tokens[1]:
-                value = get_in_collection_value(key, tokens[1])
-            if key in frozenset(('year_published', 'no_of_pages', 'edition', 'rating')):
-                value = int(value)
-            if key == 'read_date':
-                value = datetime.datetime.strptime(value, '%Y-%m-%d')
-            if key == 'read':
-                value = bool(value)
-            parsed_books[current_key][key] = value
-
-        def add_notes(tokens):
-            parsed_books[current_key]['notes'] = list(tokens)
-
-        parsed_books = collections.defaultdict(dict)
-        current_key = ''
-
-        r_bracket, l_bracket, equals, r_arrow, l_arrow = map(Suppress, '][=><')
-        book_start = (l_bracket + Word(nums) + r_bracket)('isbn')
-        book_start.addParseAction(set_book_key)
-        key = Word(alphas + '_')
-        value = restOfLine()
-        key_value = key + equals + value
-        key_value.addParseAction(add_book_attr)
-        notes_identifier = Suppress('NOTES')
-        notes_text = ZeroOrMore(Regex(r'\w+'))
-        notes = notes_identifier + r_arrow + notes_text + l_arrow + notes_identifier
-        notes.addParseAction(add_notes)
-        book = book_start + OneOrMore(key_value) + notes
-        books = OneOrMore(book)
+    def _text_records(self):
+        for book in self.__book_collection.values():
+            in_collections = _in_collections_text(book.in_collections)
+            yield ''.join(('[', str(book.isbn), ']\n'
+                           '\ttitle=', book.title, '\n'
+                           '\tauthor=', book.author, '\n'
+                           '\tgenre=', _field_text(book.genre), '\n'
+                           '\tno_of_pages=', _field_text(book.no_of_pages), '\n'
+                           '\tyear_published=', _field_text(book.year_published), '\n'
+                           '\tedition=', _field_text(book.edition), '\n'
+                           '\tpublisher=', _field_text(book.publisher), '\n'
+                           '\tread=', str(book.read), '\n'
+                           '\tread_date=', _field_text(book.read_date), '\n'
+                           '\trating=', _field_text(book.rating), '\n'
+                           '\ttags=', ' '.join(book.tags), '\n'
+                           '\tin_collections=', in_collections, '\n'
+                           '\tNOTES>\n'
+                           '\t\t', '\n\t\t'.join(book.notes), '\n'
+                           '\t<NOTES\n\n'))
 
+    def _parse_text(self, text):
         try:
-            books.parseString(text, parseAll=True)
-            return parsed_books
-        except ParseException as parse_err:
+            return {book['isbn']: book for _, book in iter_text_books(io.StringIO(text))} or []
+        except TextFormatError as parse_err:
             print('Error: {}'.format(parse_err))
             return []
 
-    def load_from_text(self):
-        filename = '{} {}.txt'.format(self.user, self.collection_name)
-        fullpath_to_load = os.path.join(os.path.dirname(__file__), filename)
+    def load_from_text(self, file=None):
         try:
-            with open(fullpath_to_load) as fh:
-                source_file_text = fh.read()
-        except (EnvironmentError, IOError) as load_err:
+            if file is None or isinstance(file, str):
+                filename = '{} {}.txt'.format(self.user, self.collection_name)
+                fullpath_to_load = file or os.path.join(os.path.dirname(__file__), filename)
+                with open(fullpath_to_load, encoding='utf-8') as fh:
+                    book_collection = self._read_text(fh)
+            else:
+                book_collection = self._read_text(file)
+        except (EnvironmentError, IOError, UnicodeError, TextFormatError) as load_err:
             print('Error while loading collection {}: {}'.format(self.collection_name,
                                                                  load_err))
             return False
 
-        book_collection = {}
-        books = self._parse_text(source_file_text)
-        if not books:
+        if not book_collection:
             return False
-        for isbn in books.keys():
-            book_collection[isbn] = books[isbn]
         self.__book_collection.clear()
         self.__book_collection.update(book_collection)
+        self.__reset_indexes()
         return True
 
-    def save_to_xml(self):
-
-        def prepare_in_collections(book):
-            in_collections_str = ''
-            for user in book.in_collections:
-                in_collections_str += '  {}: {}'.format(
-                    user, ','.join(collection_name.strip()
-                                   for collection_name in book.in_collections[user]))
-            return in_collections
+    def _read_text(self, fh):
+        book_collection = {}
+        for line_no, book_values in iter_text_books(fh):
+            try:
+                book_collection[book_values['isbn']] = _user_book(book_values)
+            except (AssertionError, TypeError) as book_err:
+                raise TextFormatError('line {}: book [{}]: {}'.format(
+                    line_no, book_values['isbn'], book_err)) from book_err
+        return book_collection
+
+    def save_to_xml(self, file=None):
+        try:
+            if file is None or isinstance(file, str):
+                filename = '{} {}.xml'.format(self.user, self.collection_name)
+                fullpath_to_save = file or os.path.join(os.path.dirname(__file__), filename)
+                _atomic_save(fullpath_to_save, self.write_xml)
+            else:
+                self.write_xml(file)
+            return True
+        except (IOError, EnvironmentError, UnicodeError) as export_err:
+            print('{} error: {}'.format(os.path.basename(sys.argv[0]), export_err))
+            return False
 
-        filename = '{} {}.xml'.format(self.user, self.collection_name)
-        fullpath_to_save = os.path.join(os.path.dirname(__file__), filename)
+    def write_xml(self, fh):
+        _write_chunks(fh, itertools.chain(("<?xml version='1.0' encoding='UTF-8'?>\n<books>",),
+                                          self._xml_records(), ('</books>',)))
 
-        root = xml.etree.ElementTree.Element('books')
+    def _xml_records(self):
+        escape = xml.sax.saxutils.escape
         for book in self.__book_collection.values():
-            main_book = xml.etree.ElementTree.Element('book')
-            for attr in BookCollection.book_attribute_names[:-3]:
-                sub_element = xml.etree.ElementTree.SubElement(main_book, attr)
-                sub_element.text = str(getattr(book, attr))
-            tags = xml.etree.ElementTree.SubElement(main_book, 'tags')
-            tags.text = ' '.join(book.tags)
-            in_collections = xml.etree.ElementTree.SubElement(main_book, 'in_collections')
-            in_collections.text = prepare_in_collections(book)
-            notes = xml.etree.ElementTree.SubElement(main_book, 'notes')
-            notes.text = '  '.join(('{}'.format(line) for line in book.notes))
-            root.append(main_book)
-
-        tree = xml.etree.ElementTree.ElementTree(root)
+            yield ''.join(('<book><isbn>', str(book.isbn), '</isbn>'
+                           '<title>', escape(book.title), '</title>'
+                           '<author>', escape(book.author), '</author>'
+                           '<genre>', escape(_field_text(book.genre)), '</genre>'
+                           '<no_of_pages>', _field_text(book.no_of_pages), '</no_of_pages>'
+                           '<year_published>', _field_text(book.year_published),
+                           '</year_published>'
+                           '<edition>', _field_text(book.edition), '</edition>'
+                           '<publisher>', escape(_field_text(book.publisher)), '</publisher>'
+                           '<read>', str(book.read), '</read>'
+                           '<read_date>', _field_text(book.read_date), '</read_date>'
+                           '<rating>', _field_text(book.rating), '</rating>'
+                           '<tags>', escape(' '.join(book.tags)), '</tags>'
+                           '<in_collections>', escape(_in_collections_text(book.in_collections)),
+                           '</in_collections>'
+                           '<notes>', escape('  '.join(book.notes)), '</notes></book>'))
+
+    def save_to_binary(self, file=None):
         try:
-            tree.write(fullpath_to_save, 'UTF-8')
+            if file is None or isinstance(file, str):
+                filename = '{} {}.bwc'.format(self.user, self.collection_name)
+                fullpath_to_save = file or os.path.join(os.path.dirname(__file__), filename)
+                _atomic_save(fullpath_to_save, self.write_binary)
+            else:
+                self.write_binary(file)
             return True
-        except (IOError, EnvironmentError, xml.parsers.expat.ExpatError) as export_err:
+        except (IOError, EnvironmentError, BinaryFormatError) as export_err:
             print('{} error: {}'.format(os.path.basename(sys.argv[0]), export_err))
             return False
 
-    def load_from_xml(self):
+    def write_binary(self, fh):
+        write_binary_books(fh, (self.__book_collection[isbn] for isbn in self))
 
-        def get_in_collections_value(key, value):
-            in_collections = collections.defaultdict(list)
-            if not value:
-                return in_collections
-            items = value.split('  ')
-            for item in items:
-                user, collection_names = item.split(':')
-                in_collections[user] = (collection_names.strip().split(',')
-                                        if ',' in collection_names else [collection_names.strip()])
-            return in_collections
+    def load_from_binary(self, path=None):
+        filename = '{} {}.bwc'.format(self.user, self.collection_name)
+        path = path or os.path.join(os.path.dirname(__file__), filename)
+        try:
+            with BinaryCollection(path) as binary_collection:
+                new_books = {book.isbn: book for book in binary_collection.values()}
+        except (IOError, EnvironmentError, ValueError, UnicodeError) as import_err:
+            print('{} import error: {}'.format(os.path.basename(sys.argv[0]), import_err))
+            return False
+        self.__book_collection.clear()
+        self.__book_collection.update(new_books)
+        self.__reset_indexes()
+        return True
 
-        filename = '{} {}.xml'.format(self.user, self.collection_name)
-        fullpath_to_load = os.path.join(os.path.dirname(__file__), filename)
+    def open_journal(self, path=None, compact_size=JOURNAL_COMPACT_SIZE):
+        # loads the snapshot at path plus its journal, then logs every later
+        # add, update and remove; in-place edits of a book must be stored
+        # again (collection[isbn] = book) to reach the journal
+        filename = '{} {}.bwc'.format(self.user, self.collection_name)
+        path = path or os.path.join(os.path.dirname(__file__), filename)
+        self.close_journal()
+        journal = CollectionJournal(path, compact_size)
         try:
-            data = xml.etree.ElementTree.parse(fullpath_to_load)
-        except (IOError, EnvironmentError, xml.parsers.expat.ExpatError) as import_err:
+            new_books = journal.open()
+        except (IOError, EnvironmentError, ValueError, UnicodeError) as import_err:
             print('{} import error: {}'.format(os.path.basename(sys.argv[0]), import_err))
             return False
+        self.__book_collection.clear()
+        self.__book_collection.update(new_books)
+        self.__reset_indexes()
+        self.__journal = journal
+        return True
 
-        new_books = {}
+    def compact_journal(self, wait=False):
+        assert self.__journal is not None, 'No journal is open.'
+        self.__journal.compact([self.__book_collection[isbn] for isbn in self], wait)
+
+    def close_journal(self):
+        if self.__journal is not None:
+            self.__journal.close()
+            self.__journal = None
+
+    def load_from_xml(self, file=None):
         try:
-            for book in data.findall('book'):
-                new_book = {}
-                for attr in BookCollection.book_attribute_names:
-                    new_book[attr] = book.find(attr).text or ''
-                for int_attr in ('isbn', 'no_of_pages', 'year_published',
-                                 'edition', 'rating'):
-                    new_book[int_attr] = int(new_book[int_attr])
-                new_book['read'] = bool(new_book['read'])
-                new_book['read_date'] = datetime.datetime.strptime(new_book['read_date'], '%Y-%m-%d')
-                tags_text = book.find('tags').text
-                new_book['tags'] = set(tags_text.split()) if tags_text else set()
-                new_book['in_collections'] = get_in_collections_value('in_collections',
-                                                                      book.find('in_collections').text)
-                notes_text = book.find('notes').text
-                new_book['notes'] = notes_text.split('  ') if notes_text else  []
-                book_to_add = UserBook(**new_book)
+            if file is None or isinstance(file, str):
+                filename = '{} {}.xml'.format(self.user, self.collection_name)
+                file = file or os.path.join(os.path.dirname(__file__), filename)
+            new_books = {}
+            for book_values in iter_xml_books(file):
+                book_to_add = _user_book(book_values)
                 new_books[book_to_add.isbn] = book_to_add
-        except (ValueError, TypeError, LookupError) as import_err:
+        except (IOError, EnvironmentError, xml.etree.ElementTree.ParseError,
+                ValueError, TypeError, LookupError, AssertionError) as import_err:
             print('{} import error: {}'.format(os.path.basename(sys.argv[0]), import_err))
             return False
         else:
             self.__book_collection.clear()
             self.__book_collection.update(new_books)
-            return True
\ No newline at end of file
+            self.__reset_indexes()
+            return True
+
+    def save_to_jsonl(self, file=None):
+        return self._save_exchange(file, 'jsonl')
+
+    def save_to_csv(self, file=None):
+        return self._save_exchange(file, 'csv')
+
+    def _save_exchange(self, file, fmt):
+        filename = '{} {}.{}'.format(self.user, self.collection_name, fmt)
+        try:
+            save_exchange_books(file or os.path.join(os.path.dirname(__file__), filename),
+                                (self.__book_collection[isbn] for isbn in self), fmt)
+            return True
+        except (EnvironmentError, IOError, UnicodeError) as save_err:
+            print('Error while saving collection {}: {}'.format(self.collection_name,
+                                                                save_err))
+            return False
+
+    def load_from_jsonl(self, file=None, max_workers=None):
+        return self._load_exchange(file, 'jsonl', max_workers)
+
+    def load_from_csv(self, file=None, max_workers=None):
+        return self._load_exchange(file, 'csv', max_workers)
+
+    def _load_exchange(self, file, fmt, max_workers):
+        filename = '{} {}.{}'.format(self.user, self.collection_name, fmt)
+        try:
+            if file is None or isinstance(file, str):
+                with open(file or os.path.join(os.path.dirname(__file__), filename),
+                          encoding='utf-8', newline='') as fh:
+                    new_books = self._read_exchange(fh, fmt, max_workers)
+            else:
+                new_books = self._read_exchange(file, fmt, max_workers)
+        except (EnvironmentError, IOError, UnicodeError, ExchangeFormatError) as import_err:
+            print('{} import error: {}'.format(os.path.basename(sys.argv[0]), import_err))
+            return False
+        self.__book_collection.clear()
+        self.__book_collection.update(new_books)
+        self.__reset_indexes()
+        return True
+
+    def _read_exchange(self, fh, fmt, max_workers):
+        new_books = {}
+        for books, failures in read_exchange_books(fh, fmt, 'collection', max_workers):
+            if failures:
+                raise ExchangeFormatError('line {}: {}'.format(*failures[0]))
+            for _, book_values in books:
+                new_books[book_values['isbn']] = UserBook.trusted(**book_values)
+        return new_books
+
+
+# Book.trusted() builds instances without going through __init__, which is
+# where SQLAlchemy would otherwise configure the mappers on first use.
+configure_mappers()
+
+
+class _PickledObject:
+
+    def __new__(cls, *args, **kwargs):
+        return object.__new__(cls)
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __setstate__(self, state):
+        self.state = state
+
+
+# all an old PickleType column may name besides our own classes and
+# SQLAlchemy's instance state, which both unpickle into inert stubs
+MIGRATION_PICKLE_CLASSES = {('builtins', 'dict'), ('builtins', 'list'), ('builtins', 'set'),
+                            ('builtins', 'frozenset'), ('builtins', 'object'),
+                            ('collections', 'defaultdict'), ('datetime', 'date'),
+                            ('copyreg', '_reconstructor')}
+
+
+class _MigrationUnpickler(pickle.Unpickler):
+
+    def find_class(self, module, name):
+        if module == __name__ or module.startswith('sqlalchemy'):
+            return _PickledObject
+        if (module, name) not in MIGRATION_PICKLE_CLASSES:
+            raise pickle.UnpicklingError('{}.{} is not allowed in a pickled column.'.format(
+                module, name))
+        return super().find_class(module, name)
+
+
+def _unpickle(blob):
+    return _MigrationUnpickler(io.BytesIO(blob)).load() if blob is not None else None
+
+
+def _pickled_in_collections(in_collections):
+    # early versions stored a plain dict
+    return collections.defaultdict(list, in_collections or {})
+
+
+def _book_from_pickled_state(state):
+    state = state[0] if isinstance(state, tuple) else state
+    attributes = {}
+    for key, value in state.items():
+        for prefix in ('_Book__', '_UserBook__'):
+            if key.startswith(prefix) and value is not None:
+                attributes[key[len(prefix):]] = value
+    if 'in_collections' in attributes:
+        attributes['in_collections'] = _pickled_in_collections(attributes['in_collections'])
+    if any(key.startswith('_UserBook__') for key in state):
+        return UserBook.trusted(**attributes)
+    return Book.trusted(**attributes)
+
+
+def migrate_pickled_database(path_to_db_file):
+    setup_database(path_to_db_file)
+    inspector = inspect(get_engine(path_to_db_file)[0])
+    userbook_columns = {column['name'] for column in inspector.get_columns('userbook')}
+    collection_columns = {column['name'] for column in inspector.get_columns('book_collection')}
+    pickled_userbook_columns = ('_UserBook__notes', '_UserBook__tags', '_UserBook__in_collections')
+    migrated = 0
+    with SQLSession(path_to_db_file) as session:
+        try:
+            if set(pickled_userbook_columns) <= userbook_columns:
+                rows = session.execute(text(
+                    'SELECT id, {0}, {1}, {2} FROM userbook '
+                    'WHERE {0} IS NOT NULL OR {1} IS NOT NULL OR {2} IS NOT NULL'.format(
+                        *pickled_userbook_columns))).fetchall()
+                for userbook_id, notes, tags, in_collections in rows:
+                    book = session.get(UserBook, userbook_id)
+                    book.notes = _unpickle(notes) or []
+                    book.tags = _unpickle(tags) or set()
+                    book.in_collections = _pickled_in_collections(_unpickle(in_collections))
+                    migrated += 1
+                session.execute(text('UPDATE userbook SET {} = NULL, {} = NULL, {} = NULL'.format(
+                    *pickled_userbook_columns)))
+            if '_BookCollection__book_collection' in collection_columns:
+                rows = session.execute(text(
+                    'SELECT id, _BookCollection__book_collection FROM book_collection '
+                    'WHERE _BookCollection__book_collection IS NOT NULL')).fetchall()
+                for collection_id, book_collection in rows:
+                    collection = session.get(BookCollection, collection_id)
+                    for isbn, pickled_book in (_unpickle(book_collection) or {}).items():
+                        book = (Book.by_isbn(session, isbn) or
+                                _book_from_pickled_state(pickled_book.state))
+                        collection[book.isbn] = book
+                    migrated += 1
+                session.execute(text('UPDATE book_collection '
+                                     'SET _BookCollection__book_collection = NULL'))
+            session.commit()
+        except (pickle.UnpicklingError, AttributeError, TypeError, ValueError,
+                AssertionError, EOFError) as migrate_err:
+            session.rollback()
+            raise MigrationError('Cannot migrate pickled rows in {}: {!r}'.format(
+                path_to_db_file, migrate_err)) from migrate_err
+        except Exception:
+            session.rollback()
+            raise
+    return migrated
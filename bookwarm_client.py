@@ -3,10 +3,16 @@
 
 import asyncio
 import getpass
+import itertools
 import datetime
 import collections
 
 import CmdUtils
+import bookwarm_frames
+
+
+IMPORT_FRAME_RECORDS = 5000
+IMPORT_FRAMES_IN_FLIGHT = 4
 
 
 class MenuCancel(Exception): pass
@@ -21,6 +27,10 @@ class BookWarmClient(asyncio.Protocol):
 
     def __init__(self, user):
         self._user = user
+        self._frames = bookwarm_frames.FrameReader()
+        self._next_page = None
+        self._page_query = None
+        self._import_state = None
         self._menus = dict(main_menu=self._main_menu_options,
                            books_menu=self._books_menu_options,
                            empty_books_menu=self._books_empty_options,
@@ -36,12 +46,21 @@ class BookWarmClient(asyncio.Protocol):
         self._write(self._user)
 
     def data_received(self, raw_data):
-        decoded_data = raw_data.decode('utf-8')
+        try:
+            frames = self._frames.feed(raw_data)
+        except bookwarm_frames.FrameError as frame_err:
+            print('Bad reply from server: {}'.format(frame_err))
+            self._transport.close()
+            return
+        for frame in frames:
+            decoded_data = frame.decode('utf-8')
 
-        status, command, reply = decoded_data.split('  ')
-        self._handle_server_data(status, command, reply)
+            status, command, reply = decoded_data.split('  ', 2)
+            self._handle_server_data(status, command, reply)
 
     def connection_lost(self, exc):
+        if self._import_state:
+            self._import_state['fh'].close()
         print('Server closed the connection.')
         asyncio.get_event_loop().stop()
 
@@ -49,7 +68,9 @@ class BookWarmClient(asyncio.Protocol):
         if status == 'FUNC':
             self.__getattribute__(command)(reply)
         else:
+            self._next_page = None
             if status == 'RE':
+                reply, self._next_page = bookwarm_frames.split_page_token(reply)
                 print(reply)
 
             self._menus[command]()
@@ -57,6 +78,7 @@ class BookWarmClient(asyncio.Protocol):
     def _main_menu_options(self):
         user_choice = CmdUtils.get_str('(A)ll books  (M)y Collections  (Q)uit',
                                        input_type='option', valid='amq')
+        self._page_query = None
         self._send_formatted(command=user_choice, client_data='None', options_menu='main_menu')
 
     def _books_empty_options(self):
@@ -66,11 +88,31 @@ class BookWarmClient(asyncio.Protocol):
         else:
             self._main_menu_options()
 
+    def _next_page_option(self):
+        return ('  (N)ext page', 'n') if self._next_page else ('', '')
+
     def _books_menu_options(self):
-        user_choice = CmdUtils.get_str('(A)dd Book  (V)iew  (E)dit  (D)elete  (B)ack',
-                                       input_type='option', valid='avedb')
+        next_msg, next_valid = self._next_page_option()
+        user_choice = CmdUtils.get_str('(A)dd Book  (V)iew  (E)dit  (D)elete  (S)earch  (T)ags  '
+                                       '(I)mport  (B)ack' + next_msg, input_type='option',
+                                       valid='avedstib' + next_valid)
         if user_choice == 'b':
             self._main_menu_options()
+        elif user_choice == 'i':
+            self._bulk_import()
+        elif user_choice == 's':
+            self._search_books()
+        elif user_choice == 't':
+            self._find_books_by_tags()
+        elif user_choice == 'n' and self._page_query:
+            command, query = self._page_query
+            self._send_formatted(command=command,
+                                 client_data='{}{} {}'.format(bookwarm_frames.PAGE_TOKEN_PREFIX,
+                                                              self._next_page, query),
+                                 options_menu='books_menu')
+        elif user_choice == 'n':
+            self._send_formatted(command='a', client_data=self._next_page,
+                                 options_menu='main_menu')
         elif user_choice == 'a':
             self._find_isbn(fallback_menu='books_menu')
         elif user_choice == 'd':
@@ -113,9 +155,13 @@ class BookWarmClient(asyncio.Protocol):
             self._main_menu_options()
 
     def _collections_menu_options(self):
-        user_choice = CmdUtils.get_str('(A)dd Collection  (V)iew  (E)dit  (D)elete  (B)ack',
-                                       input_type='option', valid='vedb')
-        if user_choice == 'a':
+        next_msg, next_valid = self._next_page_option()
+        user_choice = CmdUtils.get_str('(A)dd Collection  (V)iew  (E)dit  (D)elete  (B)ack' + next_msg,
+                                       input_type='option', valid='vedb' + next_valid)
+        if user_choice == 'n':
+            self._send_formatted(command='m', client_data=self._next_page,
+                                 options_menu='main_menu')
+        elif user_choice == 'a':
             self._send_collection_option_or_cancel(user_choice=user_choice)
         elif user_choice == 'e':
             self._send_collection_option_or_cancel(user_choice=user_choice)
@@ -233,6 +279,93 @@ class BookWarmClient(asyncio.Protocol):
                                          options_menu='books_menu')
                     return True
 
+    def _bulk_import(self):
+        try:
+            import_path = self.__get_str_or_cancel(msg='File with one book per line (or "c" to cancel)',
+                                                   input_type='string', min_len=1, max_len=255)
+            fh = open(import_path, encoding='utf-8')
+        except MenuCancel:
+            self._books_menu_options()
+            return
+        except EnvironmentError as import_err:
+            print('Cannot import: {}'.format(import_err))
+            self._books_menu_options()
+            return
+        self._import_state = dict(fh=fh, records=(line.rstrip('\n') for line in fh),
+                                  sent=0, done=0, added=0, failed=0)
+        while (self._import_state['sent'] < IMPORT_FRAMES_IN_FLIGHT and
+               self._send_import_frame()):
+            pass
+        if not self._import_state['sent']:
+            print('Nothing to import.')
+            self._import_state = None
+            self._books_menu_options()
+
+    def _send_import_frame(self):
+        # only IMPORT_FRAMES_IN_FLIGHT frames wait for their _bulk_added at
+        # any time, so a large file is read and sent as the server keeps up
+        state = self._import_state
+        try:
+            chunk = list(itertools.islice(state['records'], IMPORT_FRAME_RECORDS))
+        except UnicodeDecodeError as import_err:
+            print('Cannot import the rest of the file: {}'.format(import_err))
+            chunk = []
+        if not chunk:
+            state['fh'].close()
+            state['records'] = iter(())
+            return False
+        self._send_formatted(command='i', client_data='\n'.join(chunk),
+                             options_menu='books_menu')
+        state['sent'] += 1
+        return True
+
+    def _bulk_added(self, reply):
+        counts, *failures = reply.split('\n')
+        added, failed = map(int, counts.split())
+        state = self._import_state
+        for failure in failures:
+            record_no, _, error = failure.partition(': ')
+            if not record_no.isdigit():
+                # not a "record_no: error" line, e.g. from an older server
+                continue
+            print('Record {}: {}'.format(state['done'] * IMPORT_FRAME_RECORDS + int(record_no),
+                                         error))
+        state['added'] += added
+        state['failed'] += failed
+        state['done'] += 1
+        self._send_import_frame()
+        if state['done'] == state['sent']:
+            print('Imported {} books, {} failed.'.format(state['added'], state['failed']))
+            self._import_state = None
+            self._books_menu_options()
+
+    def _search_books(self):
+        try:
+            search_text = self.__get_str_or_cancel(
+                msg='Words to find, "OR" between words matches any ("c" to cancel)',
+                input_type='string', min_len=1, max_len=200)
+        except MenuCancel:
+            print('Canceled.')
+            self._books_menu_options()
+        else:
+            self._page_query = ('s', search_text)
+            self._send_formatted(command='s', client_data=search_text,
+                                 options_menu='books_menu')
+
+    def _find_books_by_tags(self):
+        try:
+            tag_query = self.__get_str_or_cancel(
+                msg='Tags all required, "OR" for any, "-tag" to exclude, '
+                    'empty for tag counts ("c" to cancel)',
+                input_type='string', default=' ', max_len=200)
+        except MenuCancel:
+            print('Canceled.')
+            self._books_menu_options()
+        else:
+            self._page_query = ('t', tag_query.strip())
+            self._send_formatted(command='t', client_data=tag_query.strip(),
+                                 options_menu='books_menu')
+
     def _delete_book(self):
         try:
             isbn_to_delete = self._get_isbn()
@@ -258,7 +391,7 @@ class BookWarmClient(asyncio.Protocol):
         asyncio.get_event_loop().stop()
 
     def _write(self, text):
-        self._transport.write(text.encode('utf-8'))
+        self._transport.write(bookwarm_frames.encode_frame(text))
 
     def _send_formatted(self, command, client_data, options_menu, format='{}  {}  {}'):
         self._write(format.format(command, client_data, options_menu))
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# Columnar NumPy view over a BookCatalog or BookCollection for reporting:
+# numeric attributes become arrays, author/genre/publisher are dictionary
+# encoded, filters and group aggregates run vectorized. A NULL number is
+# stored as 0 and left out of its column's validity mask, so filters on
+# that column and aggregates over it skip the row.
+
+
+import numpy
+
+
+class ColumnarBooks:
+
+    numeric_columns = dict(isbn=numpy.int64, year_published=numpy.int32,
+                           no_of_pages=numpy.int32, edition=numpy.int32, rating=numpy.int8)
+    encoded_columns = ('author', 'genre', 'publisher')
+
+    def __init__(self, books):
+        books = list(books)
+        self._size = len(books)
+        self._columns = {}
+        self._valid = {}
+        for name, dtype in ColumnarBooks.numeric_columns.items():
+            values = [getattr(book, name, 0) for book in books]
+            self._valid[name] = numpy.fromiter((value is not None for value in values),
+                                               dtype=bool, count=self._size)
+            self._columns[name] = numpy.fromiter((value or 0 for value in values),
+                                                 dtype=dtype, count=self._size)
+        self._categories = {}
+        for name in ColumnarBooks.encoded_columns:
+            codes = {}
+            self._columns[name] = numpy.fromiter(
+                (codes.setdefault(getattr(book, name), len(codes)) for book in books),
+                dtype=numpy.int32, count=self._size)
+            self._categories[name] = codes
+
+    @classmethod
+    def from_catalog(cls, catalog):
+        return cls(catalog.snapshot()[1])
+
+    @classmethod
+    def from_collection(cls, book_collection):
+        return cls(book_collection.values())
+
+    def __len__(self):
+        return self._size
+
+    def column(self, name):
+        if name not in self._columns:
+            raise KeyError('Valid columns: {}'.format(' '.join(self._columns)))
+        return self._columns[name]
+
+    def valid(self, name):
+        # rows whose numeric column is not NULL
+        self.column(name)
+        return self._valid.get(name, numpy.ones(self._size, dtype=bool))
+
+    def categories(self, name):
+        return list(self._categories[name])
+
+    def mask(self, **predicates):
+        selected = numpy.ones(self._size, dtype=bool)
+        for name, wanted in predicates.items():
+            column = self.column(name)
+            if name in self._categories:
+                code = self._categories[name].get(wanted)
+                if code is None:
+                    return numpy.zeros(self._size, dtype=bool)
+                selected &= column == code
+            elif isinstance(wanted, tuple):
+                selected &= self._valid[name]
+                low, high = wanted
+                if low is not None:
+                    selected &= column >= low
+                if high is not None:
+                    selected &= column <= high
+            else:
+                selected &= self._valid[name] & (column == wanted)
+        return selected
+
+    def filter(self, **predicates):
+        return self._columns['isbn'][self.mask(**predicates)]
+
+    def count_by(self, by, **predicates):
+        codes = self.column(by)[self.mask(**predicates)]
+        counts = numpy.bincount(codes, minlength=len(self._categories[by]))
+        return self._by_category(by, counts, counts)
+
+    def sum_by(self, name, by, **predicates):
+        selected = self.mask(**predicates) & self.valid(name)
+        codes = self.column(by)[selected]
+        sums = numpy.bincount(codes, weights=self.column(name)[selected],
+                              minlength=len(self._categories[by]))
+        counts = numpy.bincount(codes, minlength=len(self._categories[by]))
+        return self._by_category(by, sums, counts)
+
+    def mean_by(self, name, by, **predicates):
+        selected = self.mask(**predicates) & self.valid(name)
+        codes = self.column(by)[selected]
+        sums = numpy.bincount(codes, weights=self.column(name)[selected],
+                              minlength=len(self._categories[by]))
+        counts = numpy.bincount(codes, minlength=len(self._categories[by]))
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return self._by_category(by, sums / counts, counts)
+
+    def _by_category(self, by, values, counts):
+        return {category: values[code].item()
+                for category, code in self._categories[by].items() if counts[code]}
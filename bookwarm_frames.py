@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+# Length-prefixed framing shared by the BookWarm client and server:
+# every message is a 4-byte big-endian length followed by UTF-8 text.
+# Paged listings end with a 'next_page=<token>' line while more pages remain.
+
+
+import struct
+
+
+HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+PAGE_TOKEN_PREFIX = 'next_page='
+
+
+class FrameError(Exception): pass
+
+
+def encode_frame(text):
+    payload = text.encode('utf-8')
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError('Frame of {} bytes exceeds {} bytes.'.format(len(payload),
+                                                                     MAX_FRAME_SIZE))
+    return HEADER.pack(len(payload)) + payload
+
+
+def split_page_token(reply):
+    body, _, last_line = reply.rpartition('\n')
+    if last_line.startswith(PAGE_TOKEN_PREFIX):
+        return body, last_line[len(PAGE_TOKEN_PREFIX):]
+    return reply, None
+
+
+class FrameReader:
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self._buffer = bytearray()
+        self._max_frame_size = max_frame_size
+
+    def feed(self, data):
+        self._buffer.extend(data)
+        frames = []
+        start = 0
+        while len(self._buffer) - start >= HEADER.size:
+            frame_size, = HEADER.unpack_from(self._buffer, start)
+            if frame_size > self._max_frame_size:
+                raise FrameError('Frame of {} bytes exceeds {} bytes.'.format(
+                    frame_size, self._max_frame_size))
+            frame_end = start + HEADER.size + frame_size
+            if len(self._buffer) < frame_end:
+                break
+            frames.append(bytes(self._buffer[start + HEADER.size:frame_end]))
+            start = frame_end
+        del self._buffer[:start]
+        return frames
+
+    def __len__(self):
+        return len(self._buffer)
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# Multi-predicate queries over a BookCollection or the server's BookCatalog.
+# The planner asks the source how many books each indexed predicate selects,
+# drives the scan from the smallest range, checks the remaining predicates
+# per book and keeps order_by + limit in a top-k heap. Books without a value
+# for order_by come last.
+
+
+import heapq
+import itertools
+import operator
+
+
+class Query:
+
+    equality_fields = ('author', 'genre', 'publisher', 'read')
+    range_fields = ('isbn', 'year_published', 'no_of_pages', 'rating', 'edition')
+    containment_fields = ('tags',)
+
+    def __init__(self, order_by=None, limit=None, descending=False, **predicates):
+        assert limit is None or (isinstance(limit, int) and limit > 0), (
+            'Limit must be a positive integer.')
+        self.order_by = order_by
+        self.limit = limit
+        self.descending = descending
+        self._bounds = {}
+        self._tags = None
+        self._fields = set(predicates) | ({order_by} if order_by else set())
+        for name, wanted in predicates.items():
+            if name in Query.equality_fields:
+                self._bounds[name] = (wanted, wanted)
+            elif name in Query.range_fields:
+                self._bounds[name] = tuple(wanted) if isinstance(wanted, tuple) else (wanted, wanted)
+                assert len(self._bounds[name]) == 2, 'Range must be a (low, high) tuple.'
+            elif name in Query.containment_fields:
+                self._tags = frozenset([wanted] if isinstance(wanted, str) else wanted)
+            else:
+                raise KeyError('Valid predicates: {}'.format(' '.join(
+                    Query.equality_fields + Query.range_fields + Query.containment_fields)))
+
+    def plan(self, source):
+        best = None
+        for name, (low, high) in self._bounds.items():
+            if name in source.available_filters:
+                count = source.index_count(name, low, high)
+                if best is None or count < best[0]:
+                    best = (count, name, low, high)
+        return ('isbn', None, None) if best is None else best[1:]
+
+    def matches(self, book):
+        for name, (low, high) in self._bounds.items():
+            value = getattr(book, name, None)
+            if value is None:
+                return False
+            if (low is not None and value < low) or (high is not None and value > high):
+                return False
+        if self._tags is not None:
+            return self._tags <= set(getattr(book, 'tags', None) or ())
+        return True
+
+    def check(self, source):
+        # the catalog's records carry no tags, read or rating, so a query on
+        # them would match nothing instead of failing
+        record_fields = getattr(source, 'record_fields', None)
+        if record_fields is not None and not self._fields <= set(record_fields):
+            raise KeyError('{} not stored in this source, valid fields: {}'.format(
+                ' '.join(sorted(self._fields - set(record_fields))), ' '.join(record_fields)))
+
+    def run(self, source):
+        self.check(source)
+        return self._run(source)
+
+    def _run(self, source):
+        found = (book for book in self._candidates(source) if self.matches(book))
+        if self.order_by is None:
+            yield from itertools.islice(found, self.limit)
+            return
+        order_key = _order_key(self.order_by, self.descending)
+        if self.limit is None:
+            yield from sorted(found, key=order_key, reverse=self.descending)
+        elif self.descending:
+            yield from heapq.nlargest(self.limit, found, key=order_key)
+        else:
+            yield from heapq.nsmallest(self.limit, found, key=order_key)
+
+    def _candidates(self, source):
+        for isbn in source.index_range(*self.plan(source)):
+            try:
+                yield source[isbn]
+            except KeyError:
+                # removed from the source after the plan was made
+                continue
+
+
+def _order_key(name, descending):
+    # genre, publisher and the numbers may be NULL; None cannot be compared
+    # with values, so it gets its own rank after them in either direction
+    get_value = operator.attrgetter(name)
+
+    def order_key(book):
+        value = get_value(book)
+        return (value is not None, value) if descending else (value is None, value)
+
+    return order_key
+
+
+def query(source, order_by=None, limit=None, descending=False, **predicates):
+    return Query(order_by, limit, descending, **predicates).run(source)
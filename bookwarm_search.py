@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# Full-text inverted index over book titles, authors and UserBook notes.
+# Words are case folded into postings of isbn -> weighted term frequency;
+# AND/OR queries are ranked by tf-idf. The index is kept up to date with
+# add/discard and saved as JSON so the server can reload it at start;
+# search() takes a limit and offset so replies can be paged.
+
+
+import os
+import re
+import json
+import math
+import heapq
+import threading
+import collections
+
+
+TOKEN_PATTERN = re.compile(r'[^\W_]+')
+FIELD_WEIGHTS = dict(title=2, author=1, notes=1)
+FORMAT_VERSION = 1
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.casefold())
+
+
+def book_terms(book, notes=None):
+    # notes, when given, stand in for the book's own (catalog records
+    # carry none, the server reads them from the database)
+    terms = collections.Counter()
+    for field, weight in FIELD_WEIGHTS.items():
+        value = (notes if field == 'notes' and notes is not None
+                 else getattr(book, field, None)) or ''
+        for text in ([value] if isinstance(value, str) else value):
+            for token in tokenize(text):
+                terms[token] += weight
+    return terms
+
+
+class InvertedIndex:
+
+    def __init__(self, books=()):
+        self._lock = threading.Lock()
+        self._postings = collections.defaultdict(dict)
+        self._documents = {}
+        self.stamp = None
+        for book in books:
+            self.add(book)
+
+    def add(self, book, notes=None):
+        terms = book_terms(book, notes)
+        with self._lock:
+            self._remove(book.isbn)
+            for token, weight in terms.items():
+                self._postings[token][book.isbn] = weight
+            self._documents[book.isbn] = tuple(terms)
+
+    def discard(self, isbn):
+        with self._lock:
+            self._remove(int(isbn))
+
+    def search(self, text, mode='and', limit=None, offset=0):
+        assert mode in ('and', 'or'), 'Mode must be "and" or "or".'
+        tokens = set(tokenize(text))
+        with self._lock:
+            postings = sorted((self._postings.get(token, {}) for token in tokens), key=len)
+            if not postings or (mode == 'and' and not postings[0]):
+                return []
+            if mode == 'and':
+                isbns = set(postings[0]).intersection(*postings[1:])
+            else:
+                isbns = set().union(*postings)
+            document_count = len(self._documents)
+            idf = [math.log(1 + document_count / len(posting)) if posting else 0
+                   for posting in postings]
+            scored = [(-sum(posting.get(isbn, 0) * weight
+                            for posting, weight in zip(postings, idf)), isbn)
+                      for isbn in isbns]
+        ranked = heapq.nsmallest(offset + limit, scored) if limit else sorted(scored)
+        return [(isbn, -score) for score, isbn in ranked[offset:]]
+
+    def isbns(self):
+        with self._lock:
+            return set(self._documents)
+
+    def save(self, path, stamp=None):
+        # stamp is whatever the caller uses to tell a stale file at load
+        with self._lock:
+            data = dict(version=FORMAT_VERSION, stamp=stamp,
+                        postings={token: {str(isbn): weight for isbn, weight in posting.items()}
+                                  for token, posting in self._postings.items()})
+        temporary_path = '{}.tmp'.format(path)
+        with open(temporary_path, 'w', encoding='utf-8') as index_file:
+            json.dump(data, index_file)
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as index_file:
+            data = json.load(index_file)
+        if data.get('version') != FORMAT_VERSION:
+            raise ValueError('Unsupported search index version: {}'.format(data.get('version')))
+        search_index = cls()
+        search_index.stamp = data.get('stamp')
+        documents = collections.defaultdict(list)
+        for token, posting in data['postings'].items():
+            search_index._postings[token] = {int(isbn): weight for isbn, weight in posting.items()}
+            for isbn in search_index._postings[token]:
+                documents[isbn].append(token)
+        search_index._documents = {isbn: tuple(tokens) for isbn, tokens in documents.items()}
+        return search_index
+
+    def _remove(self, isbn):
+        for token in self._documents.pop(isbn, ()):
+            posting = self._postings[token]
+            del posting[isbn]
+            if not posting:
+                del self._postings[token]
+
+    def __contains__(self, isbn):
+        return int(isbn) in self._documents
+
+    def __len__(self):
+        return len(self._documents)
@@ -5,27 +5,143 @@ import os
 import sys
 import argparse
 import asyncio
+import threading
+import collections
+import functools
+import concurrent.futures
 
 import bookwarm
+import bookwarm_search
 from bookwarm_serverproto import ServerProtocol
 
 
+BULK_BATCH_SIZE = 1000
+READ_ONLY_ERROR = 'Server is read-only, another server owns the catalog.'
+SEARCH_PAGE_SIZE = 100
+SEARCH_INDEX_SAVE_DELAY = 30
+
+
+def _failure_text(err):
+    # failures travel one per line; SQLAlchemy errors span several lines
+    # ("...\n[SQL: INSERT ...]"), the driver's own message does not
+    text = str(getattr(err, 'orig', None) or err).strip()
+    return text.splitlines()[0] if text else ''
+
+
+class AsyncBookWarmDB:
+
+    def __init__(self, bookwarm_server, loop, max_workers=4, max_concurrency=64):
+        self._bookwarm_server = bookwarm_server
+        self._loop = loop
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    async def _run(self, method_name, *args, **kwargs):
+        method = functools.partial(getattr(self._bookwarm_server, method_name),
+                                   *args, **kwargs)
+        async with self._slots:
+            return await self._loop.run_in_executor(self._executor, method)
+
+    async def get_user_collections(self, user):
+        return await self._run('get_user_collections', user)
+
+    async def get_collection_by_name(self, user, collection_name):
+        return await self._run('get_collection_by_name', user, collection_name)
+
+    async def get_collection_books(self, user, collection_name):
+        return await self._run('get_collection_books', user, collection_name)
+
+    async def add_new_collection(self, user, collection_name):
+        return await self._run('add_new_collection', user, collection_name)
+
+    async def delete_collection(self, user, collection_name):
+        return await self._run('delete_collection', user, collection_name)
+
+    async def find_book_by_isbn(self, isbn):
+        return await self._run('find_book_by_isbn', isbn)
+
+    async def retrieve_book_details(self, isbn):
+        return await self._run('retrieve_book_details', isbn)
+
+    async def add_new_book(self, book_data):
+        return await self._run('add_new_book', book_data)
+
+    async def bulk_add_books(self, records, batch_size=None):
+        return await self._run('bulk_add_books', records, batch_size)
+
+    async def import_books(self, path, max_workers=None):
+        return await self._run('import_books', path, max_workers)
+
+    async def export_books(self, path):
+        return await self._run('export_books', path)
+
+    async def search_books(self, text, mode='and', offset=0, limit=SEARCH_PAGE_SIZE):
+        return await self._run('search_books', text, mode, offset, limit)
+
+    async def add_book_tag(self, isbn, tag):
+        return await self._run('add_book_tag', isbn, tag)
+
+    async def add_book_note(self, isbn, note):
+        return await self._run('add_book_note', isbn, note)
+
+    async def find_books_by_tags(self, all_of=(), any_of=(), none_of=(), after=None, limit=100):
+        return await self._run('find_books_by_tags', all_of, any_of, none_of, after, limit)
+
+    async def delete_book(self, isbn):
+        return await self._run('delete_book', isbn)
+
+    async def update_book(self, isbn, edition, publisher):
+        return await self._run('update_book', isbn, edition, publisher)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
 class BookWarmServer:
 
-    def __init__(self, server_name, host, port, loop):
+    def __init__(self, server_name, host, port, loop, db_workers=4, max_concurrency=64,
+                 data_folder=None, read_only=False):
         self._server_name = server_name
         self._host = host
         self._port = port
         self._loop = loop
         self._active_users = set()
-        self._database_path = self._setup_database()
-        self.__all_books = []
+        self._read_only = read_only
+        self._catalog_lock = threading.Lock()
+        self._database_path = self._setup_database(db_workers, data_folder)
+        self.__all_books = self._open_catalog()
+        self.__tag_index = bookwarm.TagIndex()
+        self.__search_index = None
+        self._search_index_saver = None
+        self._search_index_lock = threading.Lock()
         self._load_all_available_books()
+        self._load_search_index()
+        self._async_db = AsyncBookWarmDB(self, loop, db_workers, max_concurrency)
 
     @property
     def all_books(self):
         return self.__all_books
 
+    @property
+    def tag_index(self):
+        return self.__tag_index
+
+    @property
+    def search_index(self):
+        return self.__search_index
+
+    @property
+    def read_only(self):
+        return self._read_only
+
+    @property
+    def loop(self):
+        return self._loop
+
+    @property
+    def async_db(self):
+        return self._async_db
+
     def run(self):
         serv_coro = self._loop.create_server(
             protocol_factory=lambda: ServerProtocol(self),
@@ -33,6 +149,17 @@ class BookWarmServer:
             port=self._port)
         return self._loop.run_until_complete(serv_coro)
 
+    def close(self):
+        self._async_db.close()
+        with self._search_index_lock:
+            if self._search_index_saver is not None:
+                self._search_index_saver.cancel()
+                self._search_index_saver = None
+        self._save_search_index()
+        if isinstance(self.__all_books, bookwarm.MappedBookCatalog):
+            self.__all_books.close()
+        bookwarm.dispose_engine(self._database_path)
+
     def add_user(self, new_user):
         if new_user in self._active_users:
             return False
@@ -42,15 +169,24 @@ class BookWarmServer:
     def remove_user(self, user):
         self._active_users.discard(user)
 
+    def pool_status(self):
+        return bookwarm.engine_pool_status(self._database_path)
+
     def get_user_collections(self, user):
         with bookwarm.SQLSession(self._database_path) as session:
             return session.query(bookwarm.BookCollection).filter(
                 bookwarm.BookCollection.user == user).all()
 
-    def get_collection_by_name(self, collection_name):
+    def get_collection_by_name(self, user, collection_name):
         with bookwarm.SQLSession(self._database_path) as session:
-            return session.query(bookwarm.BookCollection).filter(
-                bookwarm.BookCollection.collection_name == collection_name).all()
+            return bookwarm.BookCollection.by_name(session, user, collection_name)
+
+    def get_collection_books(self, user, collection_name):
+        with bookwarm.SQLSession(self._database_path) as session:
+            collection = bookwarm.BookCollection.by_name(session, user, collection_name)
+            if collection is None:
+                return None
+            return bookwarm.Book.in_collection(session, collection.id).all()
 
     def add_new_collection(self, user, collection_name):
         with bookwarm.SQLSession(self._database_path) as session:
@@ -63,14 +199,11 @@ class BookWarmServer:
                 session.rollback()
                 return (False, add_collection_err)
 
-    def delete_collection(self, collection_name):
+    def delete_collection(self, user, collection_name):
         with bookwarm.SQLSession(self._database_path) as session:
             try:
-                collections = session.query(bookwarm.BookCollection).all()
-                for collection in collections:
-                    if collection.collection_name == collection_name:
-                        session.delete(collection)
-                        session.commit()
+                bookwarm.BookCollection.delete_by_name(session, user, collection_name)
+                session.commit()
                 return (True, '')
             except Exception as del_collection_err:
                 session.rollback()
@@ -78,87 +211,367 @@ class BookWarmServer:
 
     def find_book_by_isbn(self, isbn):
         with bookwarm.SQLSession(self._database_path) as session:
-            books = session.query(bookwarm.Book).all()
-            for book in books:
-                if book.isbn == int(isbn):
-                    return book
-        return False
+            return bookwarm.Book.by_isbn(session, isbn) or False
 
     def retrieve_book_details(self, isbn):
         book_attrs = ('title', 'author', 'genre', 'no_of_pages',
                       'year_published', 'edition', 'publisher')
 
         with bookwarm.SQLSession(self._database_path) as session:
-            books = session.query(bookwarm.Book).all()
-            for book in books:
-                if book.isbn == int(isbn):
-                    book_data = '\n'.join([str(book.__getattribute__(attr)) for attr in book_attrs])
-                    return book_data
+            book = bookwarm.Book.by_isbn(session, isbn)
+            if book is not None:
+                return '\n'.join([str(book.__getattribute__(attr)) for attr in book_attrs])
         return False
 
     def add_new_book(self, book_data):
-        with bookwarm.SQLSession(self._database_path) as session:
+        with self._catalog_lock, bookwarm.SQLSession(self._database_path) as session:
             try:
-
-                prepared_data = [int(value) if value.isdigit()
-                                            else value for value in book_data.split()]
-                new_book = bookwarm.Book(*prepared_data)
+                self._check_writable()
+                new_book = self._parse_book_data(book_data)
+                before = bookwarm.CatalogChange.current(session)
                 session.add(new_book)
-                session.commit()
-                self._load_all_available_books()
+                after = self._commit_books(session)
+                self.__all_books.put(new_book)
+                self._mark_catalog(before, after)
+                self.__tag_index.set_tags(new_book.isbn, ())
+                self.__search_index.add(new_book)
+                self._search_index_changed()
                 return (True, '')
             except Exception as add_book_err:
                 session.rollback()
                 return (False, add_book_err)
 
+    def bulk_add_books(self, records, batch_size=None):
+        if self._read_only:
+            return 0, [(0, READ_ONLY_ERROR)]
+        batch_size = batch_size or BULK_BATCH_SIZE
+        added, failures = [], []
+        batch = []
+        for record_no, book_data in enumerate(records, 1):
+            if book_data.strip():
+                batch.append((record_no, book_data))
+            if len(batch) >= batch_size:
+                self._insert_batch(batch, added, failures)
+                batch = []
+        if batch:
+            self._insert_batch(batch, added, failures)
+        self._index_added_books(added)
+        return len(added), sorted(failures)
+
+    def import_books(self, path, max_workers=None):
+        # path is a .jsonl or .csv file on the server; failures carry its
+        # line numbers, a missing or malformed file is reported as line 0
+        if self._read_only:
+            return 0, [(0, READ_ONLY_ERROR)]
+        fmt = os.path.splitext(path)[1].lstrip('.').lower()
+        added, failures = [], []
+        try:
+            with open(path, encoding='utf-8', newline='') as fh:
+                for books, chunk_failures in bookwarm.read_exchange_books(
+                        fh, fmt, 'catalog', max_workers):
+                    failures.extend(chunk_failures)
+                    self._insert_books([(line_no, bookwarm.Book.trusted(**book_values))
+                                        for line_no, book_values in books], added, failures)
+        except (EnvironmentError, UnicodeError, AssertionError,
+                bookwarm.ExchangeFormatError) as import_err:
+            failures.append((0, _failure_text(import_err)))
+        self._index_added_books(added)
+        return len(added), sorted(failures)
+
+    def export_books(self, path):
+        fmt = os.path.splitext(path)[1].lstrip('.').lower()
+        try:
+            bookwarm.save_exchange_books(path, self._iter_all_books(), fmt, 'catalog')
+            return (True, '')
+        except (EnvironmentError, AssertionError) as export_err:
+            return (False, str(export_err))
+
+    def _iter_all_books(self):
+        after = None
+        while True:
+            isbns, after = self.__all_books.page(after, 1000)
+            for isbn in isbns:
+                record = self.__all_books.get(isbn)
+                if record is not None:
+                    yield record
+            if after is None:
+                return
+
+    def _index_added_books(self, added):
+        for book in added:
+            self.__tag_index.set_tags(book.isbn, ())
+            self.__search_index.add(book)
+        if added:
+            self._search_index_changed()
+
+    def _insert_batch(self, batch, added, failures):
+        parsed = []
+        for record_no, book_data in batch:
+            try:
+                parsed.append((record_no, self._parse_book_data(book_data)))
+            except (AssertionError, ValueError, TypeError) as parse_err:
+                failures.append((record_no, _failure_text(parse_err) or 'Invalid record.'))
+        self._insert_books(parsed, added, failures)
+
+    def _insert_books(self, parsed, added, failures):
+        books = {}
+        for record_no, book in parsed:
+            if book.isbn in books:
+                failures.append((record_no, 'Duplicate ISBN {}.'.format(book.isbn)))
+                continue
+            books[book.isbn] = (record_no, book)
+        if not books:
+            return
+        with self._catalog_lock, bookwarm.SQLSession(self._database_path) as session:
+            try:
+                before = bookwarm.CatalogChange.current(session)
+                for isbn in bookwarm.Book.existing_isbns(session, list(books)):
+                    failures.append((books.pop(isbn)[0], 'ISBN {} already in DB.'.format(isbn)))
+                if books:
+                    session.execute(bookwarm.Book.__table__.insert(),
+                                    [book.column_values() for _, book in books.values()])
+                    after = self._commit_books(session)
+                    self.__all_books.put_many(book for _, book in books.values())
+                    self._mark_catalog(before, after)
+                    added.extend(book for _, book in books.values())
+            except Exception as insert_err:
+                session.rollback()
+                failures.extend((record_no, _failure_text(insert_err))
+                                for record_no, _ in books.values())
+
     def delete_book(self, isbn):
-        with bookwarm.SQLSession(self._database_path) as session:
+        with self._catalog_lock, bookwarm.SQLSession(self._database_path) as session:
             try:
-                books = session.query(bookwarm.Book).all()
-                for book in books:
-                    if book.isbn == int(isbn):
-                        session.delete(book)
-                        session.commit()
-                self._load_all_available_books()
+                self._check_writable()
+                before = bookwarm.CatalogChange.current(session)
+                book = bookwarm.Book.by_isbn(session, isbn)
+                if book is not None:
+                    session.delete(book)
+                    after = self._commit_books(session)
+                    self.__all_books.discard(isbn)
+                    self._mark_catalog(before, after)
+                    self.__tag_index.discard(book.isbn)
+                    self.__search_index.discard(isbn)
+                    self._search_index_changed()
                 return (True, '')
             except Exception as del_book_err:
                 session.rollback()
                 return (False, del_book_err)
 
     def update_book(self, isbn, edition, publisher):
-        with bookwarm.SQLSession(self._database_path) as session:
+        with self._catalog_lock, bookwarm.SQLSession(self._database_path) as session:
             try:
-                books = session.query(bookwarm.Book).all()
-                for book in books:
-                    if book.isbn == int(isbn):
-                        if not edition == 'None':
-                            book.edition = int(edition)
-                        if not publisher == 'None':
-                            book.publisher = publisher
-                        session.commit()
-                self._load_all_available_books()
+                self._check_writable()
+                before = bookwarm.CatalogChange.current(session)
+                book = bookwarm.Book.by_isbn(session, isbn)
+                if book is not None:
+                    if not edition == 'None':
+                        book.edition = int(edition)
+                    if not publisher == 'None':
+                        book.publisher = publisher
+                    after = self._commit_books(session)
+                    self.__all_books.put(book)
+                    self._mark_catalog(before, after)
+                    self.__search_index.add(book)
+                    self._search_index_changed()
                 return (True, '')
             except Exception as book_upd_err:
                 session.rollback()
                 return (False, book_upd_err)
 
-    def _setup_database(self):
+    def add_book_tag(self, isbn, tag):
+        with bookwarm.SQLSession(self._database_path) as session:
+            try:
+                self._check_writable()
+                book = bookwarm.Book.by_isbn(session, isbn)
+                assert isinstance(book, bookwarm.UserBook), (
+                    'ISBN {} is not a user book.'.format(isbn))
+                book.add_tag(tag)
+                session.commit()
+                self.__tag_index.add(book.isbn, tag)
+                return (True, '')
+            except Exception as add_tag_err:
+                session.rollback()
+                return (False, add_tag_err)
+
+    def add_book_note(self, isbn, note):
+        with bookwarm.SQLSession(self._database_path) as session:
+            try:
+                self._check_writable()
+                book = bookwarm.Book.by_isbn(session, isbn)
+                assert isinstance(book, bookwarm.UserBook), (
+                    'ISBN {} is not a user book.'.format(isbn))
+                book.add_note(note)
+                session.commit()
+                self.__search_index.add(book, list(book.notes))
+                self._search_index_changed()
+                return (True, '')
+            except Exception as add_note_err:
+                session.rollback()
+                return (False, add_note_err)
+
+    def refresh_catalog(self):
+        # a read-only server follows the writer through the shared catalog
+        # file, so its listings agree with find_book_by_isbn, which reads
+        # SQLite; the check is one stat() while nothing changed
+        if not (self._read_only and isinstance(self.__all_books, bookwarm.MappedBookCatalog)):
+            return
+        with self._catalog_lock:
+            if not self.__all_books.stale():
+                return
+            before = self.__all_books.isbns()
+            touched = self.__all_books.refresh()
+            if touched is None:
+                # rewritten by the writer: books in only one of the versions
+                touched = set(before).symmetric_difference(self.__all_books.isbns())
+            for isbn in touched:
+                record = self.__all_books.get(isbn)
+                if record is None:
+                    self.__tag_index.discard(isbn)
+                    self.__search_index.discard(isbn)
+                else:
+                    if isbn not in self.__tag_index:
+                        self.__tag_index.set_tags(isbn, ())
+                    self.__search_index.add(record)
+
+    def find_books_by_tags(self, all_of=(), any_of=(), none_of=(), after=None, limit=100):
+        isbns, next_isbn = self.__tag_index.page(all_of, any_of, none_of, after, limit)
+        return [self.__all_books[isbn] for isbn in isbns if isbn in self.__all_books], next_isbn
+
+    def search_books(self, text, mode='and', offset=0, limit=SEARCH_PAGE_SIZE):
+        # one ranked page; the extra hit only tells whether another follows
+        found = self.__search_index.search(text, mode, limit + 1, offset)
+        next_offset = offset + limit if len(found) > limit else None
+        return [(self.__all_books[isbn], score) for isbn, score in found[:limit]
+                if isbn in self.__all_books], next_offset
+
+    def _setup_database(self, db_workers, data_folder=None):
         try:
-            data_folder = os.path.join(os.path.dirname(__file__), 'data')
+            data_folder = data_folder or os.path.join(os.path.dirname(__file__), 'data')
             if not os.path.exists(data_folder):
                 os.mkdir(data_folder)
             database_file_path = os.path.join(data_folder, 'bookwarm.db')
-            if not os.path.exists(database_file_path):
-                bookwarm.setup_database(database_file_path)
+            bookwarm.configure_engine(database_file_path, pool_size=db_workers)
+            bookwarm.migrate_pickled_database(database_file_path)
             return database_file_path
         except (EnvironmentError, IOError) as data_setup_err:
             print('Server cannot create necessary database folder/file: {}\n'
                   'Exiting...'.format(data_setup_err))
             sys.exit()
+        except bookwarm.MigrationError as migrate_err:
+            print('Server cannot migrate the old database: {}\n'
+                  'Exiting...'.format(migrate_err))
+            sys.exit()
+
+    def _parse_book_data(self, book_data):
+        prepared_data = [int(value) if value.isdigit()
+                                    else value for value in book_data.split()]
+        return bookwarm.Book(*prepared_data)
+
+    def _catalog_path(self):
+        return os.path.splitext(self._database_path)[0] + '.catalog'
+
+    def _open_catalog(self):
+        try:
+            return bookwarm.MappedBookCatalog(self._catalog_path(), not self._read_only)
+        except bookwarm.CatalogLockedError as lock_err:
+            print('Server runs read-only: {}'.format(lock_err))
+            self._read_only = True
+            return bookwarm.MappedBookCatalog(self._catalog_path(), writable=False)
+        except bookwarm.BinaryFormatError as catalog_err:
+            if self._read_only:
+                raise
+            print('Server rebuilds unreadable catalog file: {}'.format(catalog_err))
+            os.remove(self._catalog_path())
+            return bookwarm.MappedBookCatalog(self._catalog_path())
+
+    def _check_writable(self):
+        assert not self._read_only, READ_ONLY_ERROR
+
+    def _commit_books(self, session):
+        # the counter is read inside the write transaction, so it takes in
+        # this change and nothing committed after it
+        session.flush()
+        after = bookwarm.CatalogChange.current(session)
+        session.commit()
+        return after
+
+    def _mark_catalog(self, before, after):
+        # only move the mark when this change is all that happened since
+        # the catalog was last in step with the books table; otherwise the
+        # next start sees the mismatch and reloads
+        if before == self.__all_books.change:
+            self.__all_books.mark(after)
 
     def _load_all_available_books(self):
         with bookwarm.SQLSession(self._database_path) as session:
-            self.__all_books = session.query(bookwarm.Book).all()
+            # the catalog file survives restarts; rows are only read back
+            # from SQLite when it no longer matches the books table
+            stamp = bookwarm.Book.catalog_stamp(session)
+            if self.__all_books.stamp() != stamp:
+                if self._read_only:
+                    print('Server keeps the books in memory, the catalog file is stale.')
+                    self.__all_books.close()
+                    self.__all_books = bookwarm.BookCatalog(
+                        bookwarm.BookRecord.load_all(session))
+                else:
+                    self.__all_books.load(bookwarm.BookRecord.load_all(session), stamp[-1])
+            book_tags = collections.defaultdict(set)
+            for isbn, tag in bookwarm.UserBookTag.isbn_tags(session):
+                book_tags[isbn].add(tag)
+        self.__tag_index = bookwarm.TagIndex((isbn, book_tags.get(isbn, ()))
+                                             for isbn in self.__all_books.isbns())
+
+    def _search_index_path(self):
+        return os.path.splitext(self._database_path)[0] + '.search.json'
+
+    def _search_stamp(self, session):
+        # notes are indexed too but live outside the catalog, so both count
+        return list(bookwarm.Book.catalog_stamp(session) +
+                    bookwarm.UserBookNote.notes_stamp(session))
+
+    def _load_search_index(self):
+        with bookwarm.SQLSession(self._database_path) as session:
+            stamp = self._search_stamp(session)
+            try:
+                search_index = bookwarm_search.InvertedIndex.load(self._search_index_path())
+                if (search_index.stamp == stamp and
+                        search_index.isbns() == set(self.__all_books.isbns())):
+                    self.__search_index = search_index
+                    return
+            except (EnvironmentError, ValueError, KeyError):
+                pass
+            book_notes = collections.defaultdict(list)
+            for isbn, text in bookwarm.UserBookNote.isbn_notes(session):
+                book_notes[isbn].append(text)
+        self.__search_index = bookwarm_search.InvertedIndex()
+        for book in self.__all_books:
+            self.__search_index.add(book, book_notes.get(book.isbn))
+        self._save_search_index()
+
+    def _search_index_changed(self):
+        # saved a while after the first change rather than only at close;
+        # after a crash the file is at most that old and its stamp no
+        # longer matches, so it is rebuilt instead of served stale
+        with self._search_index_lock:
+            if self._search_index_saver is None:
+                self._search_index_saver = threading.Timer(SEARCH_INDEX_SAVE_DELAY,
+                                                           self._save_search_index)
+                self._search_index_saver.daemon = True
+                self._search_index_saver.start()
+
+    def _save_search_index(self):
+        with self._search_index_lock:
+            self._search_index_saver = None
+        if self._read_only:
+            # the writable server owns the saved index
+            return
+        try:
+            with bookwarm.SQLSession(self._database_path) as session:
+                stamp = self._search_stamp(session)
+            self.__search_index.save(self._search_index_path(), stamp)
+        except EnvironmentError as index_save_err:
+            print('Server cannot save search index: {}'.format(index_save_err))
 
 
 def get_args():
@@ -169,17 +582,31 @@ def get_args():
                         help='Host to run on.')
     parser.add_argument('-p', '--port', type=int, default=23,
                         help='Port to run on.')
+    parser.add_argument('-w', '--db-workers', type=int, default=4,
+                        help='Threads running database calls.')
+    parser.add_argument('-c', '--max-concurrency', type=int, default=64,
+                        help='Database calls allowed in flight at once.')
+    parser.add_argument('-d', '--data-folder', type=str, default=None,
+                        help='Folder for the database and its index files.')
+    parser.add_argument('-r', '--read-only', action='store_true',
+                        help='Share the catalog of a writable server, refuse changes.')
     args = parser.parse_args()
-    return args.name, args.host, args.port
+    return (args.name, args.host, args.port, args.db_workers, args.max_concurrency,
+            args.data_folder, args.read_only)
 
 
 def main():
-    server_name, host, port = get_args()
+    (server_name, host, port, db_workers, max_concurrency,
+     data_folder, read_only) = get_args()
 
     loop = asyncio.get_event_loop()
-    bookwarm_server = BookWarmServer(server_name, host, port, loop)
+    bookwarm_server = BookWarmServer(server_name, host, port, loop,
+                                     db_workers, max_concurrency, data_folder, read_only)
     bookwarm_server.run()
-    loop.run_forever()
+    try:
+        loop.run_forever()
+    finally:
+        bookwarm_server.close()
 
 
 if __name__ == '__main__':
@@ -5,12 +5,25 @@
 import os
 import asyncio
 
+import bookwarm_frames
+
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 10000
+WRITE_CHUNK_SIZE = 64 * 1024
+
 
 class ServerProtocol(asyncio.Protocol):
 
     def __init__(self, bookwarm_server):
         self._bookwarm_server = bookwarm_server
+        self._db = bookwarm_server.async_db
         self._transport = None
+        self._frames = bookwarm_frames.FrameReader()
+        self._requests = asyncio.Queue()
+        self._handler_task = None
+        self._can_write = asyncio.Event()
+        self._can_write.set()
         self._user = None
         self._user_collections = []
         self._commands = dict(main_menu = dict(a=self._show_books,
@@ -23,6 +36,9 @@ class ServerProtocol(asyncio.Protocol):
                                                 d=self._delete_book,
                                                 f=self._find_book,
                                                 r=self._retrieve_book_details,
+                                                i=self._bulk_add_books,
+                                                s=self._search_books,
+                                                t=self._find_books_by_tags,
                                                 b=self._back),
                               collections_menu = dict(a=self._add_collection,
                                                       v=self._view_collection,
@@ -32,84 +48,94 @@ class ServerProtocol(asyncio.Protocol):
 
     def connection_made(self, transport):
         self._transport = transport
+        self._handler_task = self._bookwarm_server.loop.create_task(self._handle_requests())
 
     def data_received(self, raw_data):
         try:
-            decoded_data = raw_data.decode('utf-8')
-            if self._user is None:
-                self._setup_new_user(new_user=decoded_data)
-                self._send_formatted_reply(status='OK', command='main_menu', reply='')
-            else:
-                self._handle_client_data(decoded_data)
-        except UnicodeDecodeError as decode_err:
-            self._transport.write(str(decode_err).encode('utf-8'))
+            frames = self._frames.feed(raw_data)
+        except bookwarm_frames.FrameError as frame_err:
+            self._write(str(frame_err))
+            self._disconnect()
+            return
+        for frame in frames:
+            self._requests.put_nowait(frame)
 
     def connection_lost(self, exc, msg='Connection lost, exiting...'):
-        self._write(msg)
-        self._quit()
+        self._handler_task.cancel()
+        self._disconnect()
+
+    def pause_writing(self):
+        self._can_write.clear()
+
+    def resume_writing(self):
+        self._can_write.set()
 
     # main menu
-    def _show_books(self, client_data, next_menu='empty_books_menu', status='RE', reply='Empty'):
-        if self._bookwarm_server.all_books:
-            reply = '\n'.join(['{}'.format(book.isbn) for book in self._bookwarm_server.all_books])
-            next_menu = 'books_menu'
-        self._send_formatted_reply(status=status, command=next_menu, reply=reply)
-
-
-    def _show_user_collections(self, client_data, next_menu='empty_collections_menu',
-                               status='RE', reply='You have no collections'):
-        if self._user_collections:
-            reply = '\n'.join([collection.collection_name
-                               for collection in self._user_collections])
-            next_menu = 'collections_menu'
-        self._send_formatted_reply(status=status, command=next_menu, reply=reply)
-
-    def _quit(self, *ignore):
-        self._bookwarm_server.remove_user(self._user)
-        self._user = None
-        self._transport.close()
+    async def _show_books(self, client_data, next_menu='empty_books_menu', status='RE', reply='Empty'):
+        after, page_size = self._parse_page_request(client_data)
+        isbns, next_isbn = self._bookwarm_server.all_books.page(after, page_size)
+        if isbns:
+            await self._send_lines(status=status, command='books_menu',
+                                   lines=('{}'.format(isbn) for isbn in isbns),
+                                   next_page=next_isbn)
+        else:
+            self._send_formatted_reply(status=status, command=next_menu, reply=reply)
+
+    async def _show_user_collections(self, client_data, next_menu='empty_collections_menu',
+                                     status='RE', reply='You have no collections'):
+        offset, page_size = self._parse_page_request(client_data)
+        names = sorted(collection.collection_name for collection in self._user_collections)
+        offset = offset or 0
+        page = names[offset:offset + page_size]
+        if page:
+            next_offset = offset + page_size if offset + page_size < len(names) else None
+            await self._send_lines(status=status, command='collections_menu',
+                                   lines=page, next_page=next_offset)
+        else:
+            self._send_formatted_reply(status=status, command=next_menu, reply=reply)
+
+    async def _quit(self, *ignore):
+        self._disconnect()
 
     # collection handling
-    def _add_collection(self, client_data, next_menu='collections_menu',
-                        status='RE', reply='Collection created.'):
-        add_success, reply = self._bookwarm_server.add_new_collection(user=self._user,
-                                                          collection_name=client_data)
+    async def _add_collection(self, client_data, next_menu='collections_menu',
+                              status='RE', reply='Collection created.'):
+        add_success, reply = await self._db.add_new_collection(user=self._user,
+                                                               collection_name=client_data)
         if not add_success:
             self._send_formatted_reply(status='RE', command='main_menu',
                                        reply='Server Error: {}'.format(reply))
         else:
-            self._load_user_collections()
+            await self._load_user_collections()
             self._send_formatted_reply(status='RE', command=next_menu,
                                        reply='Collection added.')
 
-    def _view_collection(self, collection_name):
-        found = self._bookwarm_server.get_collection_by_name(collection_name)
-        if not found:
+    async def _view_collection(self, collection_name):
+        books = await self._db.get_collection_books(self._user, collection_name)
+        if books is None:
             self._send_formatted_reply(status='RE', command='collections_menu',
                                        reply='Collection {} not found.'.format(collection_name))
         else:
-            reply = ''
-            for book in found[0]:
-                reply += '{0.isbn} {0.title}\n'.format(book)
+            reply = ''.join('{0.isbn} {0.title}\n'.format(book) for book in books)
             self._send_formatted_reply(status='RE', command='collections_menu',
                                        reply=reply if reply.strip() else 'Empty.')
 
-    def _edit_collection(self, *args):
+    async def _edit_collection(self, *args):
         raise NotImplementedError()
 
-    def _delete_collection(self, collection_name):
-        del_success, reply = self._bookwarm_server.delete_collection(collection_name)
+    async def _delete_collection(self, collection_name):
+        del_success, reply = await self._db.delete_collection(self._user, collection_name)
         if not del_success:
             self._send_formatted_reply(status='RE', command='collections_menu',
                                        reply='Server Error: {}'.format(reply))
         else:
-            self._load_user_collections()
+            await self._load_user_collections()
             self._send_formatted_reply(status='RE', command='collections_menu',
                                        reply='Collection removed.')
 
     # book handling
-    def _add_book(self, book_data):
-        add_success, reply = self._bookwarm_server.add_new_book(book_data)
+    async def _add_book(self, book_data):
+        add_success, reply = await self._db.add_new_book(book_data)
         if not add_success:
             self._send_formatted_reply(status='RE', command='main_menu',
                                        reply='Server Error: {}'.format(reply))
@@ -117,8 +143,52 @@ class ServerProtocol(asyncio.Protocol):
             self._send_formatted_reply(status='RE', command='books_menu',
                                        reply='Book added.')
 
-    def _view_book(self, isbn):
-        found = self._bookwarm_server.find_book_by_isbn(isbn)
+    async def _bulk_add_books(self, records):
+        added, failures = await self._db.bulk_add_books(records.split('\n'))
+        reply = '\n'.join(['{} {}'.format(added, len(failures))] +
+                          ['{}: {}'.format(record_no, error) for record_no, error in failures])
+        self._send_formatted_reply(status='FUNC', command='_bulk_added', reply=reply)
+
+    async def _search_books(self, search_text):
+        token, words = self._split_page_token(search_text)
+        mode = 'or' if 'OR' in words else 'and'
+        found, next_page = await self._db.search_books(
+            ' '.join(word for word in words if word != 'OR'), mode,
+            int(token) if token else 0, DEFAULT_PAGE_SIZE)
+        if not found:
+            self._send_formatted_reply(status='RE', command='books_menu',
+                                       reply='No matches.')
+        else:
+            await self._send_lines(status='RE', command='books_menu',
+                                   lines=('{0.isbn} {0.title}'.format(book) for book, _ in found),
+                                   next_page=next_page)
+
+    async def _find_books_by_tags(self, tag_query):
+        token, words = self._split_page_token(tag_query)
+        if not words:
+            frequencies = self._bookwarm_server.tag_index.frequencies()
+            counts = sorted(frequencies.items(), key=lambda item: (-item[1], item[0]))
+            offset = int(token) if token else 0
+            lines = ['{} {}'.format(tag, count)
+                     for tag, count in counts[offset:offset + DEFAULT_PAGE_SIZE]]
+            next_page = (offset + DEFAULT_PAGE_SIZE
+                         if offset + DEFAULT_PAGE_SIZE < len(counts) else None)
+        else:
+            none_of = [word[1:] for word in words if word.startswith('-')]
+            wanted = [word for word in words if not word.startswith('-') and word != 'OR']
+            all_of, any_of = ((), wanted) if 'OR' in words else (wanted, ())
+            found, next_page = await self._db.find_books_by_tags(
+                all_of, any_of, none_of, int(token) if token else None, DEFAULT_PAGE_SIZE)
+            lines = ['{0.isbn} {0.title}'.format(book) for book in found]
+        if not lines:
+            self._send_formatted_reply(status='RE', command='books_menu',
+                                       reply='No matches.')
+        else:
+            await self._send_lines(status='RE', command='books_menu', lines=lines,
+                                   next_page=next_page)
+
+    async def _view_book(self, isbn):
+        found = await self._db.find_book_by_isbn(isbn)
         if not found:
             self._send_formatted_reply(status='RE', command='books_menu',
                                        reply='ISBN not found.')
@@ -127,9 +197,9 @@ class ServerProtocol(asyncio.Protocol):
             self._send_formatted_reply(status='RE', command='books_menu',
                                        reply=reply)
 
-    def _edit_book(self, isbn_updated_data):
+    async def _edit_book(self, isbn_updated_data):
         isbn, new_edition, new_publisher = isbn_updated_data.split()
-        update_success, reply = self._bookwarm_server.update_book(isbn, new_edition, new_publisher)
+        update_success, reply = await self._db.update_book(isbn, new_edition, new_publisher)
         if not update_success:
             self._send_formatted_reply(status='RE', command='books_menu',
                                        reply='Server Error: {}'.format(reply))
@@ -137,8 +207,8 @@ class ServerProtocol(asyncio.Protocol):
             self._send_formatted_reply(status='RE', command='books_menu',
                                        reply='Book updated.')
 
-    def _delete_book(self, isbn):
-        del_success, reply = self._bookwarm_server.delete_book(isbn)
+    async def _delete_book(self, isbn):
+        del_success, reply = await self._db.delete_book(isbn)
         if not del_success:
             self._send_formatted_reply(status='RE', command='books_menu',
                                        reply='Server Error: {}'.format(reply))
@@ -146,42 +216,121 @@ class ServerProtocol(asyncio.Protocol):
             self._send_formatted_reply(status='RE', command='books_menu',
                                        reply='Book removed.')
 
-    def _find_book(self, isbn_menu):
+    async def _find_book(self, isbn_menu):
         isbn_to_find, client_func_to_invoke = isbn_menu.split()
-        found = self._bookwarm_server.find_book_by_isbn(isbn_to_find)
+        found = await self._db.find_book_by_isbn(isbn_to_find)
         reply = str(found.isbn) if found else ''
         if client_func_to_invoke == '_add_new_book':
             reply = '' if found else isbn_to_find
         self._send_formatted_reply(status='FUNC', command=client_func_to_invoke, reply=reply)
 
-    def _retrieve_book_details(self, isbn_func):
+    async def _retrieve_book_details(self, isbn_func):
         isbn, client_func_to_invoke = isbn_func.split()
-        book_details_str = self._bookwarm_server.retrieve_book_details(isbn)
+        book_details_str = await self._db.retrieve_book_details(isbn)
         reply = '{}:{}'.format(isbn, book_details_str)
         self._send_formatted_reply(status='FUNC', command=client_func_to_invoke, reply=reply)
 
-    def _back(self, *args):
+    async def _back(self, *args):
         pass
 
     # supportive methods
-    def _handle_client_data(self, decoded_data):
-        command, client_data, options_menu = map(str.strip, decoded_data.split('  '))
-        self._commands[options_menu][command](client_data)
+    async def _handle_requests(self):
+        while True:
+            try:
+                decoded_data = (await self._requests.get()).decode('utf-8')
+            except UnicodeDecodeError as decode_err:
+                self._write(str(decode_err))
+                continue
+            try:
+                if self._user is None:
+                    if await self._setup_new_user(new_user=decoded_data):
+                        self._send_formatted_reply(status='OK', command='main_menu', reply='')
+                else:
+                    await self._handle_client_data(decoded_data)
+            except Exception as request_err:
+                # a bad request or a failing handler must not end this
+                # connection's task and leave the client waiting
+                print('Request {!r} failed: {!r}'.format(decoded_data[:200], request_err))
+                reply = 'Server Error: {}'.format(str(request_err) or type(request_err).__name__)
+                if self._user is None:
+                    self._send_formatted_reply(status='FUNC', command='quit', reply=reply)
+                    self._disconnect()
+                else:
+                    self._send_formatted_reply(status='RE', command='main_menu', reply=reply)
 
-    def _load_user_collections(self):
-        self._user_collections = self._bookwarm_server.get_user_collections(self._user)
+    async def _handle_client_data(self, decoded_data):
+        command, client_data = decoded_data.split('  ', 1)
+        client_data, options_menu = map(str.strip, client_data.rsplit('  ', 1))
+        command = command.strip()
+        self._bookwarm_server.refresh_catalog()
+        await self._commands[options_menu][command](client_data)
 
-    def _setup_new_user(self, new_user):
-        self._user = new_user
-        if not self._bookwarm_server.add_user(self._user):
+    async def _load_user_collections(self):
+        self._user_collections = await self._db.get_user_collections(self._user)
+
+    async def _setup_new_user(self, new_user):
+        if not self._bookwarm_server.add_user(new_user):
             self._send_formatted_reply(status='FUNC', command='quit',
                                        reply='One connection per user allowed.\n'
                                               'This client will now exit.')
-            self._quit()
-        self._load_user_collections()
+            self._transport.close()
+            return False
+        self._user = new_user
+        await self._load_user_collections()
+        return True
+
+    def _disconnect(self):
+        if self._user is not None:
+            self._bookwarm_server.remove_user(self._user)
+            self._user = None
+        self._transport.close()
+
+    def _parse_page_request(self, client_data):
+        try:
+            token, *page_size = client_data.split()
+            page_size = int(page_size[0]) if page_size else DEFAULT_PAGE_SIZE
+            return (None if token == 'None' else int(token),
+                    max(1, min(page_size, MAX_PAGE_SIZE)))
+        except ValueError:
+            return None, DEFAULT_PAGE_SIZE
+
+    def _split_page_token(self, client_data):
+        # follow-up pages of a query repeat it after a next_page=<token> word
+        words = client_data.split()
+        if words and words[0].startswith(bookwarm_frames.PAGE_TOKEN_PREFIX):
+            return words[0][len(bookwarm_frames.PAGE_TOKEN_PREFIX):], words[1:]
+        return None, words
+
+    async def _send_lines(self, status, command, lines, next_page=None):
+        encoded_lines = [line.encode('utf-8') for line in lines]
+        if next_page is not None:
+            encoded_lines.append('{}{}'.format(bookwarm_frames.PAGE_TOKEN_PREFIX,
+                                               next_page).encode('utf-8'))
+        head = '{}  {}  '.format(status, command).encode('utf-8')
+        size = len(head) + sum(map(len, encoded_lines)) + len(encoded_lines) - 1
+        if size > bookwarm_frames.MAX_FRAME_SIZE:
+            # refuse before anything is written, the client would drop
+            # the connection on an oversized frame
+            self._send_formatted_reply(status='RE', command=command,
+                                       reply='Reply of {} bytes exceeds {} bytes, '
+                                             'ask for a smaller page.'.format(
+                                             size, bookwarm_frames.MAX_FRAME_SIZE))
+            return
+        await self._can_write.wait()
+        self._transport.write(bookwarm_frames.HEADER.pack(size) + head)
+        chunk, chunk_size = [], 0
+        for line_no, line in enumerate(encoded_lines):
+            chunk.append(line if not line_no else b'\n' + line)
+            chunk_size += len(chunk[-1])
+            if chunk_size >= WRITE_CHUNK_SIZE:
+                await self._can_write.wait()
+                self._transport.write(b''.join(chunk))
+                chunk, chunk_size = [], 0
+        await self._can_write.wait()
+        self._transport.write(b''.join(chunk))
 
     def _write(self, text):
-        self._transport.write(text.encode('utf-8'))
+        self._transport.write(bookwarm_frames.encode_frame(text))
 
     def _send_formatted_reply(self, status, command, reply, format='{}  {}  {}'):
         self._write(format.format(status, command, reply))
\ No newline at end of file
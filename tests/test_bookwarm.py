@@ -4,12 +4,25 @@
 import os
 import sys
 import io
+import struct
+import pickle
+import copyreg
 import unittest
 import collections
 import datetime
 import unittest.mock
+import tempfile
 import xml
-from bookwarm import Book, UserBook, BookCollection
+import sqlalchemy.exc
+from bookwarm import (Book, UserBook, BookCollection, BookCatalog, BookRecord, SQLSession,
+                      TagIndex, UserBookTag, TextFormatError, iter_text_books,
+                      iter_xml_books, BinaryCollection, BinaryFormatError, BINARY_HEADER,
+                      write_binary_books,
+                      CatalogFile, MappedBookCatalog, catalog_stamp, CatalogLockedError,
+                      CollectionJournal,
+                      read_exchange_books, save_exchange_books, setup_database,
+                      get_engine, configure_engine, engine_pool_status, dispose_engine,
+                      migrate_pickled_database, MigrationError)
 
 
 class TestBook(unittest.TestCase):
@@ -271,6 +284,21 @@ class TestBook(unittest.TestCase):
         with self.assertRaises(AssertionError):
             book.add_collection_name('new user', 7777)
 
+    def test52_userbook_trusted_success(self):
+        in_collections = collections.defaultdict(list)
+        in_collections['user'] = ['coll']
+        book = UserBook.trusted(notes=['note'], tags={'tag'}, rating=3,
+                                in_collections=in_collections, **self.user_book_kwargs)
+        self.assertEqual((book.isbn, book.title, book.edition, book.rating),
+                         (1234567890, 'title', 1, 3))
+        self.assertEqual(book.notes, ['note'])
+        self.assertEqual(book.tags, {'tag'})
+        self.assertEqual(book.in_collections['user'], ['coll'])
+
+    def test53_userbook_trusted_skips_validation(self):
+        self.user_book_kwargs['year_published'] = 2077
+        self.assertEqual(UserBook.trusted(**self.user_book_kwargs).year_published, 2077)
+
 
 class TestBookCollection(unittest.TestCase):
 
@@ -445,11 +473,16 @@ class TestBookCollection(unittest.TestCase):
         book_collection = BookCollection(**self.valid_bookcoll_kwargs)
         self.assertEqual(book_collection._parse_text(''), [])
 
-    @unittest.mock.patch('bookwarm.open', return_value=io.StringIO(''))
-    def test26_save_to_text_success(self, io_file):
+    def test26_save_to_text_success(self):
         book_collection = BookCollection(**self.valid_bookcoll_kwargs)
         book_collection[self.test_book1.isbn] = self.test_book1
-        self.assertTrue(book_collection.save_to_text())
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'coll.txt')
+            with unittest.mock.patch('bookwarm.os.path.join', return_value=path):
+                self.assertTrue(book_collection.save_to_text())
+            self.assertEqual(os.listdir(folder), ['coll.txt'])
+            with open(path, encoding='utf-8') as fh:
+                self.assertTrue(fh.read().startswith('[1234567890]\n\ttitle=title\n'))
 
     @unittest.mock.patch('bookwarm.os.path.join', return_value='\\n')
     def test27_save_to_text_fail(self, *ignore):
@@ -457,12 +490,16 @@ class TestBookCollection(unittest.TestCase):
         book_collection[self.test_book1.isbn] = self.test_book1
         self.assertFalse(book_collection.save_to_text())
 
-    @unittest.mock.patch('bookwarm.open', return_value=io.StringIO(''))
-    @unittest.mock.patch('bookwarm.BookCollection._parse_text',
-                         return_value={'key': 'value'})
-    def test28_load_from_text_success(self, *ignore):
+    def test28_load_from_text_success(self):
         book_collection = BookCollection(**self.valid_bookcoll_kwargs)
-        self.assertTrue(book_collection.load_from_text())
+        with unittest.mock.patch('bookwarm.open', return_value=io.StringIO(self.valid_txt)):
+            self.assertTrue(book_collection.load_from_text())
+        self.assertEqual(list(book_collection), [1234567890, 1234567896])
+        self.assertIsInstance(book_collection[1234567890], UserBook)
+        self.assertEqual(book_collection[1234567890].notes, ['haha', 'whoot'])
+        self.assertFalse(book_collection[1234567890].read)
+        self.assertEqual(book_collection[1234567896].in_collections,
+                         {'w': ['qweq'], 'q': ['hallo', 'qweqwe']})
 
     def test29_load_from_text_file_not_found_fail(self):
         book_collection = BookCollection(**self.valid_bookcoll_kwargs)
@@ -475,12 +512,14 @@ class TestBookCollection(unittest.TestCase):
         book_collection = BookCollection(**self.valid_bookcoll_kwargs)
         self.assertFalse(book_collection.load_from_text())
 
-    @unittest.mock.patch('bookwarm.open', return_value=io.StringIO(''))
-    @unittest.mock.patch('bookwarm.xml.etree.ElementTree.ElementTree.write',
-                         return_value=True)
-    def test30_save_to_xml_success(self, *ignore):
+    def test30_save_to_xml_success(self):
         book_collection = BookCollection(**self.valid_bookcoll_kwargs)
-        self.assertTrue(book_collection.save_to_xml())
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'coll.xml')
+            with unittest.mock.patch('bookwarm.os.path.join', return_value=path):
+                self.assertTrue(book_collection.save_to_xml())
+            self.assertEqual(os.listdir(folder), ['coll.xml'])
+            self.assertEqual(xml.etree.ElementTree.parse(path).getroot().tag, 'books')
 
     @unittest.mock.patch('bookwarm.os.path.join', return_value='\\n')
     def test31_save_to_xml_fail(self, *ignore):
@@ -498,5 +537,1042 @@ class TestBookCollection(unittest.TestCase):
         self.assertFalse(book_collection.load_from_xml())
 
 
+    def test34_filter_index_follows_mutations_success(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        book_collection[self.test_book1.isbn] = self.test_book1
+        book_collection[self.test_book2.isbn] = self.test_book2
+        self.assertEqual(book_collection.filter(key='author'), [self.test_book2, self.test_book1])
+        del book_collection[self.test_book2.isbn]
+        self.assertEqual(book_collection.filter(key='author'), [self.test_book1])
+        book_collection[self.test_book2.isbn] = self.test_book2
+        book_collection.pop(self.test_book1.isbn)
+        self.assertEqual(book_collection.filter(key='author'), [self.test_book2])
+
+    def test35_filter_index_edited_book_success(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        book_collection[self.test_book1.isbn] = self.test_book1
+        book_collection[self.test_book2.isbn] = self.test_book2
+        book_collection.filter(key='year_published')
+        self.test_book1.year_published = 2020
+        book_collection[self.test_book1.isbn] = self.test_book1
+        self.assertEqual(book_collection.filter(key='year_published'),
+                         [self.test_book2, self.test_book1])
+
+    def test36_delitem_not_found_fail(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        with self.assertRaises(KeyError):
+            del book_collection[self.test_book1.isbn]
+
+    def test37_between_success(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        book_collection[self.test_book1.isbn] = self.test_book1
+        book_collection[self.test_book2.isbn] = self.test_book2
+        self.assertEqual(list(book_collection.between('year_published', 2014, 2016)),
+                         [self.test_book1])
+        self.assertEqual(list(book_collection.between('year_published', low=2016)),
+                         [self.test_book2])
+        self.assertEqual(list(book_collection.between('edition', high=5)),
+                         [self.test_book1, self.test_book2])
+        self.assertEqual(list(book_collection.between('year_published', 2018, 2020)), [])
+
+    def test38_between_attr_not_found_fail(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        with self.assertRaises(KeyError):
+            list(book_collection.between('invalid', 1, 2))
+
+    def test39_startswith_success(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        book_collection[self.test_book1.isbn] = self.test_book1
+        book_collection[self.test_book2.isbn] = self.test_book2
+        self.assertEqual(list(book_collection.startswith('author', 'auth')),
+                         [self.test_book2, self.test_book1])
+        self.assertEqual(list(book_collection.startswith('genre', 'b')), [self.test_book2])
+        self.assertEqual(list(book_collection.startswith('genre', 'x')), [])
+
+    def test40_iter_sorted_after_mutations_success(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        book_collection[self.test_book2.isbn] = self.test_book2
+        self.assertEqual(list(book_collection), [self.test_book2.isbn])
+        book_collection[self.test_book1.isbn] = self.test_book1
+        self.assertEqual(list(book_collection.keys()),
+                         [self.test_book1.isbn, self.test_book2.isbn])
+        book_collection.pop(self.test_book1.isbn)
+        self.assertEqual(list(book_collection), [self.test_book2.isbn])
+        del book_collection[self.test_book2.isbn]
+        self.assertEqual(list(book_collection), [])
+
+    def test41_iter_while_deleting_success(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        book_collection[self.test_book1.isbn] = self.test_book1
+        book_collection[self.test_book2.isbn] = self.test_book2
+        for isbn in book_collection:
+            del book_collection[isbn]
+        self.assertEqual(len(book_collection), 0)
+
+    def test42_tagged_success(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        self.test_book1.add_tag('scifi')
+        book_collection[self.test_book1.isbn] = self.test_book1
+        book_collection[self.test_book2.isbn] = self.test_book2
+        book_collection.add_tag(self.test_book2.isbn, 'scifi')
+        book_collection.add_tag(self.test_book2.isbn, 'favourite')
+        self.assertEqual(book_collection.tagged(all_of=['scifi', 'favourite']), [self.test_book2])
+        self.assertEqual(book_collection.tagged(any_of=['scifi', 'dull']),
+                         [self.test_book1, self.test_book2])
+        self.assertEqual(book_collection.tagged(none_of=['favourite']), [self.test_book1])
+        self.assertEqual(book_collection.tag_frequencies(), {'scifi': 2, 'favourite': 1})
+
+    def test43_tagged_follows_mutations_success(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        book_collection[self.test_book1.isbn] = self.test_book1
+        self.assertEqual(book_collection.tagged(all_of=['scifi']), [])
+        book_collection.add_tag(self.test_book1.isbn, 'scifi')
+        self.test_book2.add_tag('scifi')
+        book_collection[self.test_book2.isbn] = self.test_book2
+        self.assertEqual(book_collection.tagged(all_of=['scifi']),
+                         [self.test_book1, self.test_book2])
+        del book_collection[self.test_book1.isbn]
+        self.assertEqual(book_collection.tag_frequencies(), {'scifi': 1})
+
+    def test44_add_tag_not_found_fail(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        with self.assertRaises(KeyError):
+            book_collection.add_tag(self.test_book1.isbn, 'scifi')
+
+    def test45_save_to_text_file_object_success(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        self.test_book1.add_note('a note')
+        book_collection[self.test_book1.isbn] = self.test_book1
+        text_file, binary_file = io.StringIO(), io.BytesIO()
+        self.assertTrue(book_collection.save_to_text(text_file))
+        self.assertTrue(book_collection.save_to_text(binary_file))
+        self.assertEqual(text_file.getvalue().encode('utf-8'), binary_file.getvalue())
+        self.assertIn('\tNOTES>\n\t\ta note\n\t<NOTES\n\n', text_file.getvalue())
+
+    @unittest.mock.patch('bookwarm.BookCollection.write_text', side_effect=IOError('disk full'))
+    def test46_save_to_text_keeps_previous_file_fail(self, *ignore):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'coll.txt')
+            with open(path, 'w') as fh:
+                fh.write('previous')
+            self.assertFalse(book_collection.save_to_text(path))
+            self.assertEqual(os.listdir(folder), ['coll.txt'])
+            with open(path) as fh:
+                self.assertEqual(fh.read(), 'previous')
+
+
+    def test47_save_load_text_round_trip_success(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        self.test_book1.add_note('first note')
+        self.test_book1.add_tag('scifi')
+        self.test_book1.read = True
+        self.test_book1.read_date = datetime.date(2017, 5, 1)
+        book_collection[self.test_book1.isbn] = self.test_book1
+        book_collection[self.test_book2.isbn] = self.test_book2
+        text_file = io.StringIO()
+        book_collection.save_to_text(text_file)
+        loaded = BookCollection(**self.valid_bookcoll_kwargs)
+        self.assertTrue(loaded.load_from_text(io.StringIO(text_file.getvalue())))
+        for isbn in book_collection:
+            for attr in BookCollection.book_attribute_names:
+                self.assertEqual(getattr(loaded[isbn], attr),
+                                 getattr(book_collection[isbn], attr))
+
+    def test48_iter_text_books_line_error_fail(self):
+        broken_txt = self.valid_txt.replace('no_of_pages=151', 'no_of_pages=many')
+        with self.assertRaisesRegex(TextFormatError, 'line 23: invalid no_of_pages'):
+            list(iter_text_books(io.StringIO(broken_txt)))
+        with self.assertRaisesRegex(TextFormatError, 'line 34: .* from line 19 is missing'):
+            list(iter_text_books(io.StringIO(self.valid_txt.rsplit('<NOTES', 1)[0])))
+
+    def test49_iter_text_books_streams_success(self):
+        books = iter_text_books(io.StringIO(self.valid_txt))
+        line_no, book_values = next(books)
+        self.assertEqual((line_no, book_values['isbn'], book_values['no_of_pages']),
+                         (1, 1234567890, 150))
+
+    def test50_load_from_text_invalid_book_fail(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        book_collection[self.test_book1.isbn] = self.test_book1
+        invalid_txt = self.valid_txt.replace('genre=fiction1', 'genre=x')
+        self.assertFalse(book_collection.load_from_text(io.StringIO(invalid_txt)))
+        self.assertEqual(list(book_collection), [self.test_book1.isbn])
+
+
+    def test51_load_from_xml_path_success(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        valid_xml_path = os.path.join(os.path.dirname(__file__), 'test_data/valid.xml')
+        self.assertTrue(book_collection.load_from_xml(valid_xml_path))
+        self.assertEqual(list(book_collection), [1234567890, 1234567897])
+        self.assertEqual(book_collection[1234567890].notes, ['haha', 'whoot'])
+        self.assertFalse(book_collection[1234567890].read)
+        self.assertEqual(book_collection[1234567897].in_collections,
+                         {'q': ['hallo', 'qweqwe'], 'w': ['qweq']})
+
+    def test52_iter_xml_books_streams_success(self):
+        books = iter_xml_books(io.StringIO(self.valid_xml))
+        book_values = next(books)
+        self.assertEqual((book_values['isbn'], book_values['no_of_pages'], book_values['tags']),
+                         (1234567890, 150, set()))
+        self.assertEqual(book_values['read_date'], datetime.date.min)
+
+    def test53_load_from_xml_invalid_fail(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        book_collection[self.test_book1.isbn] = self.test_book1
+        self.assertFalse(book_collection.load_from_xml(io.StringIO(self.invalid_xml)))
+        self.assertFalse(book_collection.load_from_xml(
+            io.StringIO(self.valid_xml.replace('<rating>0</rating>', ''))))
+        self.assertEqual(list(book_collection), [self.test_book1.isbn])
+
+
+    def test54_save_load_xml_round_trip_success(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        self.test_book1.add_note('notes <&> more')
+        self.test_book1.add_tag('sci&fi')
+        self.test_book1.add_collection_name('valid user', 'valid coll name')
+        self.test_book1.add_collection_name('valid user', 'other coll')
+        book_collection[self.test_book1.isbn] = self.test_book1
+        book_collection[self.test_book2.isbn] = self.test_book2
+        binary_file = io.BytesIO()
+        self.assertTrue(book_collection.save_to_xml(binary_file))
+        binary_file.seek(0)
+        loaded = BookCollection(**self.valid_bookcoll_kwargs)
+        self.assertTrue(loaded.load_from_xml(binary_file))
+        for isbn in book_collection:
+            for attr in BookCollection.book_attribute_names:
+                self.assertEqual(getattr(loaded[isbn], attr),
+                                 getattr(book_collection[isbn], attr))
+
+    @unittest.mock.patch('bookwarm.BookCollection.write_xml', side_effect=IOError('disk full'))
+    def test55_save_to_xml_keeps_previous_file_fail(self, *ignore):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'coll.xml')
+            with open(path, 'w') as fh:
+                fh.write('previous')
+            self.assertFalse(book_collection.save_to_xml(path))
+            self.assertEqual(os.listdir(folder), ['coll.xml'])
+
+
+    def test56_save_load_binary_round_trip_success(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        self.test_book1.add_note('first note')
+        self.test_book1.add_tag('scifi')
+        self.test_book1.add_collection_name('valid user', 'valid coll name')
+        self.test_book1.read_date = datetime.date(2017, 5, 1)
+        book_collection[self.test_book2.isbn] = self.test_book2
+        book_collection[self.test_book1.isbn] = self.test_book1
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'coll.bwc')
+            self.assertTrue(book_collection.save_to_binary(path))
+            loaded = BookCollection(**self.valid_bookcoll_kwargs)
+            self.assertTrue(loaded.load_from_binary(path))
+        self.assertEqual(list(loaded), [self.test_book1.isbn, self.test_book2.isbn])
+        for isbn in book_collection:
+            for attr in BookCollection.book_attribute_names:
+                self.assertEqual(getattr(loaded[isbn], attr),
+                                 getattr(book_collection[isbn], attr))
+
+    def test57_save_to_binary_control_character_fail(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        self.test_book1.add_note('bad\x00note')
+        book_collection[self.test_book1.isbn] = self.test_book1
+        self.assertFalse(book_collection.save_to_binary(io.BytesIO()))
+
+    def test58_load_from_binary_not_found_fail(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        self.assertFalse(book_collection.load_from_binary(
+            os.path.join(tempfile.gettempdir(), 'no_such_collection.bwc')))
+
+    def test59_save_load_jsonl_csv_round_trip_success(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        self.test_book1.add_note('first, "quoted" note')
+        self.test_book1.add_note('second note')
+        self.test_book1.add_tag('scifi')
+        self.test_book1.add_collection_name('valid user', 'valid coll name')
+        self.test_book1.read_date = datetime.date(2017, 5, 1)
+        book_collection[self.test_book2.isbn] = self.test_book2
+        book_collection[self.test_book1.isbn] = self.test_book1
+        for fmt in ('jsonl', 'csv'):
+            with tempfile.TemporaryDirectory() as folder:
+                path = os.path.join(folder, 'coll.{}'.format(fmt))
+                self.assertTrue(getattr(book_collection, 'save_to_' + fmt)(path))
+                loaded = BookCollection(**self.valid_bookcoll_kwargs)
+                self.assertTrue(getattr(loaded, 'load_from_' + fmt)(path, max_workers=0))
+            self.assertEqual(list(loaded), [self.test_book1.isbn, self.test_book2.isbn])
+            for isbn in book_collection:
+                for attr in BookCollection.book_attribute_names:
+                    self.assertEqual(getattr(loaded[isbn], attr),
+                                     getattr(book_collection[isbn], attr))
+
+    def test60_load_from_csv_process_pool_success(self):
+        rows = ['isbn,title,author,genre,no_of_pages,year_published,rating']
+        rows.extend('{},title {},author,genre,100,2000,3'.format(isbn, isbn)
+                    for isbn in range(1234567000, 1234567050))
+        rows.append('1234567000,last title,author,genre,100,2000,3')
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        with unittest.mock.patch('bookwarm.EXCHANGE_CHUNK_SIZE', 7):
+            self.assertTrue(book_collection.load_from_csv(io.StringIO('\n'.join(rows)),
+                                                          max_workers=2))
+        self.assertEqual(len(book_collection), 50)
+        self.assertEqual(book_collection[1234567000].title, 'last title')
+
+    def test61_load_from_jsonl_invalid_book_fail(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        book_collection[self.test_book1.isbn] = self.test_book1
+        text = ('{"isbn": 1234567891, "title": "title", "author": "author", '
+                '"genre": "genre", "no_of_pages": 50, "year_published": 2015}\n'
+                '\n{"isbn": 1234567893, "title": "t"}\n')
+        with unittest.mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertFalse(book_collection.load_from_jsonl(io.StringIO(text), max_workers=0))
+        self.assertIn('line 3', stdout.getvalue())
+        self.assertEqual(list(book_collection), [self.test_book1.isbn])
+
+    def test62_load_from_csv_unknown_column_fail(self):
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        self.assertFalse(book_collection.load_from_csv(io.StringIO('isbn,title,bogus\n'),
+                                                       max_workers=0))
+
+    def test63_load_from_jsonl_wrong_value_types_fail(self):
+        book = ('{"isbn": 12345678%s, "title": "title", "author": "author", "genre": "genre", '
+                '"no_of_pages": 50, "year_published": 2015, %s}')
+        lines = [book % ('91', '"tags": "scifi"'), book % ('92', '"notes": "a note"'),
+                 book % ('93', '"in_collections": {"user": "reading"}'),
+                 book % ('94', '"tags": ["scifi"], "in_collections": {"user": ["reading"]}')]
+        (books, failures), = read_exchange_books(io.StringIO('\n'.join(lines)), 'jsonl',
+                                                 max_workers=0)
+        self.assertEqual([line_no for line_no, _ in failures], [1, 2, 3])
+        self.assertIn('tags must be a list', failures[0][1])
+        self.assertEqual([(values['isbn'], values['tags']) for _, values in books],
+                         [(1234567894, {'scifi'})])
+
+    def test64_filter_null_genre_success(self):
+        null_book = UserBook.trusted(1234567891, 'title2', 'author', None, 50, 2015)
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        book_collection[self.test_book1.isbn] = self.test_book1
+        book_collection[null_book.isbn] = null_book
+        self.assertEqual(book_collection.filter(key='genre'), [self.test_book1, null_book])
+        book_collection[self.test_book2.isbn] = self.test_book2
+        self.assertEqual(list(book_collection.startswith('genre', 'b')), [self.test_book2])
+        self.assertEqual(book_collection.index_count('genre'), 2)
+        del book_collection[null_book.isbn]
+        self.assertEqual(book_collection.filter(key='genre'), [self.test_book2, self.test_book1])
+
+    def _null_fields_round_trip(self, save, load):
+        null_book = UserBook.trusted(1234567891, 'title2', 'author', None, None, 2015,
+                                     edition=None, publisher=None)
+        book_collection = BookCollection(**self.valid_bookcoll_kwargs)
+        book_collection[self.test_book1.isbn] = self.test_book1
+        book_collection[null_book.isbn] = null_book
+        saved = io.StringIO()
+        self.assertTrue(getattr(book_collection, save)(saved))
+        loaded = BookCollection(**self.valid_bookcoll_kwargs)
+        self.assertTrue(getattr(loaded, load)(io.StringIO(saved.getvalue())))
+        book = loaded[1234567891]
+        self.assertEqual((book.genre, book.no_of_pages, book.edition, book.publisher),
+                         (None, None, None, ''))
+        self.assertEqual(loaded[self.test_book1.isbn].genre, 'genre')
+
+    def test65_text_null_fields_round_trip_success(self):
+        self._null_fields_round_trip('save_to_text', 'load_from_text')
+
+    def test66_xml_null_fields_round_trip_success(self):
+        self._null_fields_round_trip('save_to_xml', 'load_from_xml')
+
+class TestBinaryCollection(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'coll.bwc')
+        books = {isbn: UserBook(isbn=isbn, title='title {}'.format(isbn), author='author',
+                                genre='genre', no_of_pages=50, year_published=2015)
+                 for isbn in (1234567893, 1234567890, 1234567891)}
+        BookCollection('valid user', 'valid coll name', books).save_to_binary(self.path)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test01_getitem_success(self):
+        with BinaryCollection(self.path) as binary_collection:
+            book = binary_collection[1234567891]
+        self.assertIsInstance(book, UserBook)
+        self.assertEqual(book.title, 'title 1234567891')
+
+    def test02_getitem_not_found_fail(self):
+        with BinaryCollection(self.path) as binary_collection:
+            with self.assertRaises(KeyError):
+                binary_collection[1234567892]
+            self.assertIsNone(binary_collection.get(1234567899))
+
+    def test03_iter_sorted_success(self):
+        with BinaryCollection(self.path) as binary_collection:
+            self.assertEqual(list(binary_collection), [1234567890, 1234567891, 1234567893])
+            self.assertEqual(len(binary_collection), 3)
+            self.assertIn(1234567893, binary_collection)
+
+    def test04_bad_magic_fail(self):
+        with open(self.path, 'r+b') as fh:
+            fh.write(b'XXXX')
+        with self.assertRaises(BinaryFormatError):
+            BinaryCollection(self.path)
+
+    def test05_truncated_fail(self):
+        with open(self.path, 'r+b') as fh:
+            fh.truncate(100)
+        with self.assertRaises(BinaryFormatError):
+            BinaryCollection(self.path)
+
+    def test06_fields_success(self):
+        with BinaryCollection(self.path) as binary_collection:
+            fields = binary_collection.fields(1234567893)
+        self.assertEqual((fields['title'], fields['no_of_pages'], fields['tags']),
+                         ('title 1234567893', 50, set()))
+
+    def test07_empty_file_fail(self):
+        open(self.path, 'wb').close()
+        with self.assertRaises(BinaryFormatError):
+            BinaryCollection(self.path)
+
+    def test08_bad_record_offset_fail(self):
+        with open(self.path, 'r+b') as fh:
+            _, _, _, count, index_offset = BINARY_HEADER.unpack(fh.read(BINARY_HEADER.size))
+            fh.seek(index_offset + 8 * count)
+            fh.write(struct.pack('<Q', 2 ** 40))
+        with BinaryCollection(self.path) as binary_collection:
+            with self.assertRaises(BinaryFormatError):
+                binary_collection[1234567890]
+        collection = BookCollection('valid user', 'valid coll name', {})
+        with unittest.mock.patch('builtins.print'):
+            self.assertFalse(collection.load_from_binary(self.path))
+
+    def test09_plain_book_success(self):
+        with open(self.path, 'wb') as fh:
+            write_binary_books(fh, [Book.trusted(1234567890, 'title', 'author', None, 50, 2015)])
+        with BinaryCollection(self.path) as binary_collection:
+            book = binary_collection[1234567890]
+        self.assertEqual((book.genre, book.rating, book.tags), ('', 0, set()))
+
+
+class TestCollectionJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'coll.bwc')
+        self.collection = BookCollection('valid user', 'valid coll name', None)
+        self.collection.open_journal(self.path)
+        for isbn in (1234567890, 1234567891, 1234567892):
+            self.collection[isbn] = UserBook(isbn=isbn, title='title {}'.format(isbn),
+                                             author='author', genre='genre', no_of_pages=50,
+                                             year_published=2015)
+
+    def tearDown(self):
+        self.collection.close_journal()
+        self.folder.cleanup()
+
+    def reopened(self):
+        self.collection.close_journal()
+        book_collection = BookCollection('valid user', 'valid coll name', None)
+        self.assertTrue(book_collection.open_journal(self.path))
+        self.addCleanup(book_collection.close_journal)
+        return book_collection
+
+    def test01_replay_add_update_remove_success(self):
+        self.collection.add_tag(1234567891, 'scifi')
+        del self.collection[1234567890]
+        self.collection.pop(1234567892)
+        book_collection = self.reopened()
+        self.assertEqual(list(book_collection), [1234567891])
+        self.assertEqual(book_collection[1234567891].tags, {'scifi'})
+
+    def test02_compact_success(self):
+        self.collection.compact_journal(wait=True)
+        self.assertEqual(os.path.getsize(self.path + '.journal'), 0)
+        self.assertFalse(os.path.exists(self.path + '.journal.compacting'))
+        del self.collection[1234567891]
+        self.assertEqual(list(self.reopened()), [1234567890, 1234567892])
+
+    def test03_compact_on_size_success(self):
+        self.collection.close_journal()
+        self.collection.open_journal(self.path, compact_size=256)
+        self.collection.add_tag(1234567890, 'tag')
+        self.collection.close_journal()
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual(list(self.reopened()), [1234567890, 1234567891, 1234567892])
+
+    def test04_torn_entry_dropped_success(self):
+        self.collection.close_journal()
+        with open(self.path + '.journal', 'ab') as fh:
+            fh.write(b'\x40\x00\x00\x00\x00\x00')
+        book_collection = self.reopened()
+        del book_collection[1234567890]
+        book_collection.close_journal()
+        self.assertEqual(list(self.reopened()), [1234567891, 1234567892])
+
+    def test05_corrupt_entry_stops_replay_success(self):
+        self.collection.close_journal()
+        with open(self.path + '.journal', 'r+b') as fh:
+            fh.seek(-1, os.SEEK_END)
+            fh.write(b'X')
+        self.assertEqual(list(self.reopened()), [1234567890, 1234567891])
+
+    def test06_interrupted_compaction_replayed_success(self):
+        self.collection.close_journal()
+        os.replace(self.path + '.journal', self.path + '.journal.compacting')
+        journal = CollectionJournal(self.path)
+        self.assertEqual(sorted(journal.open()), [1234567890, 1234567891, 1234567892])
+        journal.remove(1234567891)
+        journal.close()
+        self.assertEqual(list(self.reopened()), [1234567890, 1234567892])
+
+    def test07_compact_on_every_change_success(self):
+        self.collection.close_journal()
+        self.collection.open_journal(self.path, compact_size=1)
+        for isbn in (1234567893, 1234567894):
+            self.collection[isbn] = UserBook(isbn=isbn, title='title {}'.format(isbn),
+                                             author='author', genre='genre', no_of_pages=50,
+                                             year_published=2015)
+        del self.collection[1234567890]
+        self.collection.pop(1234567891)
+        self.assertEqual(list(self.reopened()), [1234567892, 1234567893, 1234567894])
+
+    def test08_compact_snapshot_ignores_later_edits_success(self):
+        book = self.collection[1234567890]
+        with unittest.mock.patch('threading.Thread.start'):
+            self.collection.compact_journal()
+        book.add_tag('later')
+        book.add_note('later note')
+        journal = self.collection._BookCollection__journal
+        journal._compaction.run()
+        journal._compaction = None
+        with BinaryCollection(self.path) as snapshot:
+            self.assertEqual((snapshot[1234567890].tags, snapshot[1234567890].notes),
+                             (set(), []))
+
+
+class TestTagIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tag_index = TagIndex([(1234567890, {'scifi', 'favourite'}),
+                                   (1234567891, {'scifi'}),
+                                   (1234567892, set())])
+
+    def test01_query_all_of_success(self):
+        self.assertEqual(self.tag_index.query(all_of=['scifi', 'favourite']), [1234567890])
+
+    def test02_query_any_of_success(self):
+        self.assertEqual(self.tag_index.query(any_of=['favourite', 'missing']), [1234567890])
+
+    def test03_query_none_of_success(self):
+        self.assertEqual(self.tag_index.query(none_of=['scifi']), [1234567892])
+        self.assertEqual(self.tag_index.query(all_of=['scifi'], none_of=['favourite']),
+                         [1234567891])
+
+    def test04_query_unknown_tag_success(self):
+        self.assertEqual(self.tag_index.query(all_of=['missing']), [])
+
+    def test05_frequencies_success(self):
+        self.assertEqual(self.tag_index.frequencies(), {'scifi': 2, 'favourite': 1})
+
+    def test06_discard_and_readd_success(self):
+        self.tag_index.discard(1234567890)
+        self.tag_index.add(1234567893, 'favourite')
+        self.assertNotIn(1234567890, self.tag_index)
+        self.assertEqual(self.tag_index.query(any_of=['favourite']), [1234567893])
+        self.assertEqual(self.tag_index.query(), [1234567891, 1234567892, 1234567893])
+
+    def test07_set_tags_replaces_success(self):
+        self.tag_index.set_tags(1234567890, ['drama'])
+        self.assertEqual(self.tag_index.tags_of(1234567890), {'drama'})
+        self.assertEqual(self.tag_index.frequencies(), {'scifi': 1, 'drama': 1})
+
+    def test08_page_success(self):
+        tag_index = TagIndex((isbn, {'even'} if isbn % 2 == 0 else ())
+                             for isbn in range(1000000000, 1000000100))
+        pages, after = [], None
+        while True:
+            isbns, after = tag_index.page(none_of=['even'], after=after, limit=30)
+            pages.append(isbns)
+            if after is None:
+                break
+        self.assertEqual([len(isbns) for isbns in pages], [30, 20])
+        self.assertEqual(sum(pages, []), list(range(1000000001, 1000000100, 2)))
+        self.assertEqual(tag_index.page(all_of=['even'], limit=50),
+                         (list(range(1000000000, 1000000100, 2)), None))
+
+    def test09_page_after_changes_success(self):
+        self.tag_index.discard(1234567891)
+        self.tag_index.set_tags(1234567889, ['scifi'])
+        self.tag_index.set_tags(1234567891, [])
+        self.assertEqual(self.tag_index.page(limit=2), ([1234567889, 1234567890], 1234567890))
+        self.assertEqual(self.tag_index.page(after=1234567890, limit=2),
+                         ([1234567891, 1234567892], None))
+
+
+class TestBookCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.test_book1 = Book(isbn=1234567890, title='title', author='author',
+                               genre='genre', no_of_pages=50, year_published=2015)
+        self.test_book2 = Book(isbn=1234567891, title='title1', author='author',
+                               genre='genre', no_of_pages=50, year_published=2015)
+        self.catalog = BookCatalog([self.test_book1])
+
+    def test01_catalog_load_success(self):
+        self.assertEqual(self.catalog.isbns(), [1234567890])
+        self.assertEqual(self.catalog.version, 1)
+
+    def test02_catalog_put_success(self):
+        self.catalog.put(self.test_book2)
+        self.assertEqual(self.catalog.get('1234567891'), BookRecord.from_book(self.test_book2))
+        self.assertEqual(self.catalog.version, 2)
+
+    def test03_catalog_put_wrong_type_fail(self):
+        with self.assertRaises(AssertionError):
+            self.catalog.put('not a book')
+
+    def test04_catalog_discard_success(self):
+        self.catalog.discard('1234567890')
+        self.assertFalse(1234567890 in self.catalog)
+        self.assertEqual(len(self.catalog), 0)
+        self.assertEqual(self.catalog.version, 2)
+
+    def test05_catalog_discard_not_found_keeps_version(self):
+        self.catalog.discard(1234567899)
+        self.assertEqual(self.catalog.version, 1)
+
+    def test06_catalog_snapshot_success(self):
+        self.assertEqual(self.catalog.snapshot(), (1, [BookRecord.from_book(self.test_book1)]))
+
+    def test07_catalog_page_success(self):
+        self.catalog.put(self.test_book2)
+        self.assertEqual(self.catalog.page(limit=1), ([1234567890], 1234567890))
+        self.assertEqual(self.catalog.page(after='1234567890', limit=1), ([1234567891], None))
+        self.assertEqual(self.catalog.page(after=1234567891), ([], None))
+
+    def test08_catalog_isbns_sorted_success(self):
+        self.catalog.put(Book(isbn=1234567889, title='title2', author='author',
+                              genre='genre', no_of_pages=50, year_published=2015))
+        self.catalog.put(self.test_book2)
+        self.catalog.discard(1234567890)
+        self.assertEqual(self.catalog.isbns(), [1234567889, 1234567891])
+
+    def test09_catalog_put_many_success(self):
+        self.catalog.put_many([self.test_book2, self.test_book1])
+        self.assertEqual(self.catalog.isbns(), [1234567890, 1234567891])
+        self.assertEqual(self.catalog.version, 2)
+
+    def test10_catalog_put_record_success(self):
+        record = BookRecord.from_book(self.test_book2)
+        self.catalog.put(record)
+        self.assertIs(self.catalog.get(1234567891), record)
+
+    def test11_record_to_book_success(self):
+        record = BookRecord.from_book(self.test_book1)
+        book = record.to_book()
+        self.assertIsInstance(book, Book)
+        self.assertEqual(BookRecord.from_book(book), record)
+
+    def test12_record_immutable_fail(self):
+        with self.assertRaises(AttributeError):
+            BookRecord.from_book(self.test_book1).title = 'other'
+
+    def test13_catalog_exchange_round_trip_success(self):
+        self.catalog.put(self.test_book2)
+        for fmt in ('jsonl', 'csv'):
+            fh = io.StringIO()
+            save_exchange_books(fh, self.catalog, fmt, 'catalog')
+            fh.write('{"isbn": 12}\n' if fmt == 'jsonl' else '12,t,a,g,1,1,1,p\n')
+            fh.seek(0)
+            (books, failures), = read_exchange_books(fh, fmt, 'catalog', max_workers=0)
+            self.assertEqual([BookRecord.from_book(Book.trusted(**values)) for _, values in books],
+                             list(self.catalog))
+            self.assertEqual([line_no for line_no, _ in failures], [3 if fmt == 'jsonl' else 4])
+
+
+class TestMappedBookCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'books.catalog')
+        self.test_book1 = Book(isbn=1234567890, title='title', author='author',
+                               genre='genre', no_of_pages=50, year_published=2015)
+        self.test_book2 = Book(isbn=1234567891, title='title1', author='author',
+                               genre='genre', no_of_pages=50, year_published=2015)
+        self.catalog = MappedBookCatalog(self.path)
+        self.catalog.load([self.test_book2, self.test_book1])
+
+    def tearDown(self):
+        self.catalog.close()
+        self.folder.cleanup()
+
+    def test01_load_success(self):
+        self.assertEqual(self.catalog.isbns(), [1234567890, 1234567891])
+        self.assertEqual(self.catalog[1234567891], BookRecord.from_book(self.test_book2))
+
+    def test02_put_discard_success(self):
+        self.catalog.put(Book(isbn=1234567892, title='title2', author='author',
+                              genre='genre', no_of_pages=50, year_published=2015))
+        self.catalog.discard(1234567890)
+        self.assertEqual(self.catalog.isbns(), [1234567891, 1234567892])
+        self.assertEqual(len(self.catalog), 2)
+        self.assertIsNone(self.catalog.get(1234567890))
+
+    def test03_reopen_success(self):
+        self.catalog.put(BookRecord.from_book(self.test_book1)._replace(edition=2))
+        self.catalog.close()
+        self.catalog = MappedBookCatalog(self.path)
+        self.assertEqual(self.catalog[1234567890].edition, 2)
+        self.assertEqual(self.catalog.index_range('edition', 2, 2), [1234567890])
+
+    def test04_reader_refresh_success(self):
+        reader = MappedBookCatalog(self.path, writable=False)
+        self.catalog.discard(1234567891)
+        self.assertIn(1234567891, reader)
+        reader.refresh()
+        self.assertEqual(reader.isbns(), [1234567890])
+        self.catalog.load([self.test_book2])
+        reader.refresh()
+        self.assertEqual(reader.isbns(), [1234567891])
+        reader.close()
+
+    def test05_reader_put_fail(self):
+        reader = MappedBookCatalog(self.path, writable=False)
+        with self.assertRaises(AssertionError):
+            reader.put(self.test_book1)
+        reader.close()
+
+    def test06_truncated_record_dropped_success(self):
+        self.catalog.close()
+        with open(self.path, 'ab') as fh:
+            fh.write(b'\x40\x00\x00\x00\x01')
+        self.catalog = MappedBookCatalog(self.path)
+        self.assertEqual(len(self.catalog), 2)
+        self.catalog.put(self.test_book1)
+        self.assertEqual(self.catalog[1234567890].title, 'title')
+
+    def test07_missing_index_rebuilt_success(self):
+        self.catalog.discard(1234567890)
+        self.catalog.close()
+        os.remove(self.path + '.idx')
+        with CatalogFile(self.path, writable=True) as catalog_file:
+            self.assertEqual(list(catalog_file), [1234567891])
+        self.assertTrue(os.path.exists(self.path + '.idx'))
+
+    def test08_bad_magic_fail(self):
+        self.catalog.close()
+        with open(self.path, 'r+b') as fh:
+            fh.write(b'XXXX')
+        with self.assertRaises(BinaryFormatError):
+            MappedBookCatalog(self.path)
+
+    def test09_stamp_success(self):
+        self.assertEqual(self.catalog.stamp(), catalog_stamp([1234567890, 1234567891]))
+
+    def test10_mark_survives_reopen_success(self):
+        self.catalog.load([self.test_book1], change=7)
+        self.catalog.mark(9)
+        self.catalog.close()
+        self.catalog = MappedBookCatalog(self.path)
+        self.assertEqual(self.catalog.stamp(), catalog_stamp([1234567890], 9))
+        self.catalog.close()
+        os.remove(self.path + '.idx')
+        self.catalog = MappedBookCatalog(self.path)
+        self.assertEqual(self.catalog.change, 9)
+
+    def test11_second_writer_locked_fail(self):
+        with self.assertRaises(CatalogLockedError):
+            MappedBookCatalog(self.path)
+        reader = MappedBookCatalog(self.path, writable=False)
+        self.assertEqual(reader.isbns(), [1234567890, 1234567891])
+        reader.close()
+        self.catalog.close()
+        MappedBookCatalog(self.path).close()
+
+    def test12_null_fields_survive_reopen_success(self):
+        record = BookRecord(1234567892, 'title2', 'author', None, None, 2015, None, None)
+        self.catalog.put(record)
+        self.catalog.close()
+        self.catalog = MappedBookCatalog(self.path)
+        self.assertEqual(self.catalog[1234567892], record)
+        self.assertEqual(self.catalog[1234567890].publisher, '')
+        self.assertEqual(self.catalog.index_range('edition', 0), [1234567890, 1234567891])
+
+    def test13_reader_follows_writer_success(self):
+        reader = MappedBookCatalog(self.path, writable=False)
+        try:
+            self.assertFalse(reader.stale())
+            self.catalog.put(Book(isbn=1234567889, title='title2', author='author',
+                                  genre='genre', no_of_pages=50, year_published=2015))
+            self.catalog.discard(1234567891)
+            self.assertTrue(reader.stale())
+            self.assertEqual(reader.refresh(), {1234567889, 1234567891})
+            self.assertEqual(reader.isbns(), [1234567889, 1234567890])
+            self.assertEqual(reader[1234567889].title, 'title2')
+            self.assertFalse(reader.stale())
+            self.catalog.load([self.test_book2])
+            self.assertIsNone(reader.refresh())
+            self.assertEqual(reader.isbns(), [1234567891])
+        finally:
+            reader.close()
+
+
+class PickledBook:
+
+    # pickles like a UserBook stored by the old PickleType book_collection column
+    def __init__(self, state):
+        self.state = state
+
+    def __reduce__(self):
+        return (copyreg._reconstructor, (UserBook, object, None), self.state)
+
+
+class TestDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.db_folder = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.db_folder.name, 'test.db')
+        setup_database(self.db_path)
+        with SQLSession(self.db_path) as session:
+            session.add(Book(isbn=1234567890, title='title', author='author',
+                             genre='genre', no_of_pages=50, year_published=2015))
+            session.add(Book(isbn=1234567891, title='title1', author='author',
+                             genre='genre', no_of_pages=50, year_published=2015))
+            session.commit()
+
+    def tearDown(self):
+        dispose_engine(self.db_path)
+        self.db_folder.cleanup()
+
+    def test01_by_isbn_success(self):
+        with SQLSession(self.db_path) as session:
+            self.assertEqual(Book.by_isbn(session, '1234567891').title, 'title1')
+
+    def test02_by_isbn_not_found(self):
+        with SQLSession(self.db_path) as session:
+            self.assertIsNone(Book.by_isbn(session, 1234567899))
+
+    def test03_isbn_unique_fail(self):
+        with SQLSession(self.db_path) as session:
+            session.add(Book(isbn=1234567890, title='title', author='author',
+                             genre='genre', no_of_pages=50, year_published=2015))
+            with self.assertRaises(sqlalchemy.exc.IntegrityError):
+                session.commit()
+
+    def test04_engine_shared_success(self):
+        self.assertIs(get_engine(self.db_path)[0], get_engine(self.db_path)[0])
+
+    def test05_engine_pragmas_success(self):
+        with SQLSession(self.db_path) as session:
+            journal_mode = session.execute(sqlalchemy.text('PRAGMA journal_mode')).scalar()
+        self.assertEqual(journal_mode, 'wal')
+
+    def test06_engine_pool_status_success(self):
+        with SQLSession(self.db_path) as session:
+            Book.by_isbn(session, 1234567890)
+            self.assertEqual(engine_pool_status(self.db_path)['checked_out'], 1)
+        self.assertEqual(engine_pool_status(self.db_path)['checked_out'], 0)
+
+    def test07_configure_engine_after_creation_fail(self):
+        with self.assertRaises(RuntimeError):
+            configure_engine(self.db_path, pool_size=1)
+
+    def test08_configure_engine_invalid_option_fail(self):
+        with self.assertRaises(KeyError):
+            configure_engine(self.db_path, invalid=1)
+
+    def test09_existing_isbns_success(self):
+        with SQLSession(self.db_path) as session:
+            self.assertEqual(Book.existing_isbns(session, [1234567890, 1234567899]),
+                             {1234567890})
+
+    def test10_column_values_bulk_insert_success(self):
+        book = Book(isbn=1234567892, title='title2', author='author',
+                    genre='genre', no_of_pages=50, year_published=2015)
+        with SQLSession(self.db_path) as session:
+            session.execute(Book.__table__.insert(), [book.column_values()])
+            session.commit()
+            self.assertEqual(Book.by_isbn(session, 1234567892).title, 'title2')
+
+    def _add_collection(self):
+        in_collections = collections.defaultdict(list)
+        in_collections['user'] = ['coll1', 'coll2']
+        book = UserBook(isbn=1234567892, title='title2', author='author', genre='genre',
+                        no_of_pages=50, year_published=2015, notes=['note1', 'note2'],
+                        tags={'scifi', 'favourite'}, in_collections=in_collections)
+        with SQLSession(self.db_path) as session:
+            collection = BookCollection('user', 'coll1', {book.isbn: book})
+            session.add(collection)
+            session.commit()
+            return collection.id
+
+    def test11_userbook_normalized_fields_success(self):
+        self._add_collection()
+        with SQLSession(self.db_path) as session:
+            book = Book.by_isbn(session, 1234567892)
+            self.assertEqual(book.notes, ['note1', 'note2'])
+            self.assertEqual(book.tags, {'scifi', 'favourite'})
+            self.assertEqual(book.in_collections['user'], ['coll1', 'coll2'])
+
+    def test12_userbook_by_tag_success(self):
+        self._add_collection()
+        with SQLSession(self.db_path) as session:
+            self.assertEqual([book.isbn for book in UserBook.by_tag(session, 'scifi')],
+                             [1234567892])
+            self.assertEqual(UserBook.by_tag(session, 'fantasy').all(), [])
+
+    def test13_bookcoll_find_add_remove_book_success(self):
+        collection_id = self._add_collection()
+        with SQLSession(self.db_path) as session:
+            collection = session.get(BookCollection, collection_id)
+            self.assertEqual(collection.find_book(session, 1234567892).title, 'title2')
+            self.assertIsNone(collection.find_book(session, 1234567890))
+            collection.add_book(session, Book.by_isbn(session, 1234567890))
+            self.assertEqual(list(collection), [1234567890, 1234567892])
+            self.assertEqual(collection.remove_book(session, 1234567892).isbn, 1234567892)
+            session.commit()
+            self.assertEqual(list(collection), [1234567890])
+
+    def _add_pickled_collection(self, book_collection):
+        with SQLSession(self.db_path) as session:
+            session.execute(sqlalchemy.text(
+                'ALTER TABLE book_collection ADD COLUMN _BookCollection__book_collection BLOB'))
+            session.execute(sqlalchemy.text(
+                "INSERT INTO book_collection (user, collection_name, "
+                "_BookCollection__book_collection) VALUES ('user', 'old', :blob)"),
+                dict(blob=pickle.dumps(book_collection)))
+            session.commit()
+
+    def test14_migrate_pickled_database_success(self):
+        state = {'_Book__isbn': 1234567893, '_Book__title': 'title3', '_Book__author': 'author',
+                 '_Book__genre': 'genre', '_Book__no_of_pages': 50, '_Book__edition': 1,
+                 '_Book__year_published': 2015, '_Book__publisher': '', '_UserBook__read': False,
+                 '_UserBook__rating': 4, '_UserBook__notes': ['old note'],
+                 '_UserBook__tags': {'old'}, '_UserBook__in_collections': None}
+        self._add_pickled_collection({1234567890: None, 1234567893: PickledBook(state)})
+        self.assertEqual(migrate_pickled_database(self.db_path), 1)
+        with SQLSession(self.db_path) as session:
+            collection = session.query(BookCollection).one()
+            self.assertEqual(list(collection), [1234567890, 1234567893])
+            self.assertEqual(collection[1234567893].notes, ['old note'])
+            self.assertEqual(collection[1234567893].rating, 4)
+        self.assertEqual(migrate_pickled_database(self.db_path), 0)
+
+    def test15_bookcoll_by_name_user_scoped_success(self):
+        self._add_collection()
+        with SQLSession(self.db_path) as session:
+            session.add(BookCollection('other user', 'coll1', None))
+            session.commit()
+            self.assertEqual(BookCollection.by_name(session, 'user', 'coll1').user, 'user')
+            self.assertIsNone(BookCollection.by_name(session, 'nobody', 'coll1'))
+
+    def test16_bookcoll_user_name_unique_fail(self):
+        self._add_collection()
+        with SQLSession(self.db_path) as session:
+            session.add(BookCollection('user', 'coll1', None))
+            with self.assertRaises(sqlalchemy.exc.IntegrityError):
+                session.commit()
+
+    def test17_bookcoll_delete_by_name_success(self):
+        self._add_collection()
+        with SQLSession(self.db_path) as session:
+            session.add(BookCollection('other user', 'coll1', None))
+            session.commit()
+            self.assertEqual(BookCollection.delete_by_name(session, 'user', 'coll1'), 1)
+            session.commit()
+            self.assertEqual(session.query(BookCollection.user).all(), [('other user',)])
+            self.assertEqual(session.execute(
+                sqlalchemy.text('SELECT COUNT(*) FROM collection_book')).scalar(), 0)
+
+    def test18_trusted_book_persist_success(self):
+        with SQLSession(self.db_path) as session:
+            session.add(UserBook.trusted(isbn=1234567894, title='title4', author='author',
+                                         genre='genre', no_of_pages=50, year_published=2015,
+                                         tags={'tag'}))
+            session.commit()
+        with SQLSession(self.db_path) as session:
+            book = Book.by_isbn(session, 1234567894)
+            self.assertIsInstance(book, UserBook)
+            self.assertEqual(book.tags, {'tag'})
+
+    def test19_record_load_all_success(self):
+        with SQLSession(self.db_path) as session:
+            records = BookRecord.load_all(session)
+        self.assertEqual([record.title for record in records], ['title', 'title1'])
+        self.assertIsInstance(records[0], BookRecord)
+
+    def test20_userbook_tag_isbn_tags_success(self):
+        with SQLSession(self.db_path) as session:
+            session.add(UserBook.trusted(isbn=1234567894, title='title4', author='author',
+                                         genre='genre', no_of_pages=50, year_published=2015,
+                                         tags={'scifi', 'favourite'}))
+            session.commit()
+            self.assertEqual(sorted(map(tuple, UserBookTag.isbn_tags(session))),
+                             [(1234567894, 'favourite'), (1234567894, 'scifi')])
+
+    def test21_catalog_stamp_success(self):
+        with SQLSession(self.db_path) as session:
+            self.assertEqual(Book.catalog_stamp(session),
+                             catalog_stamp([1234567890, 1234567891], 2))
+            Book.by_isbn(session, 1234567890).publisher = 'publisher'
+            session.commit()
+            self.assertEqual(Book.catalog_stamp(session),
+                             catalog_stamp([1234567890, 1234567891], 3))
+            session.query(Book).delete()
+            self.assertEqual(Book.catalog_stamp(session), (0, 0, 5))
+
+    def test22_trusted_book_rows_stored_on_flush_success(self):
+        book = UserBook.trusted(isbn=1234567894, title='title4', author='author',
+                                genre='genre', no_of_pages=50, year_published=2015,
+                                notes=['note'], tags={'tag'})
+        book.add_tag('other')
+        book.add_collection_name('user', 'coll')
+        with SQLSession(self.db_path) as session:
+            session.add(BookCollection('user', 'coll', {book.isbn: book}))
+            session.commit()
+        with SQLSession(self.db_path) as session:
+            book = Book.by_isbn(session, 1234567894)
+            self.assertEqual((book.notes, book.tags, dict(book.in_collections)),
+                             (['note'], {'tag', 'other'}, {'user': ['coll']}))
+
+    def test23_record_load_all_null_columns_success(self):
+        with SQLSession(self.db_path) as session:
+            session.execute(sqlalchemy.update(Book.__table__).values(
+                _Book__genre=None, _Book__publisher=None, _Book__edition=None))
+            session.commit()
+            records = BookRecord.load_all(session)
+        self.assertEqual([(record.genre, record.publisher, record.edition)
+                          for record in records], [(None, None, None)] * 2)
+
+    def test24_migrate_plain_dict_in_collections_success(self):
+        state = {'_Book__isbn': 1234567893, '_Book__title': 'title3', '_Book__author': 'author',
+                 '_Book__genre': 'genre', '_Book__no_of_pages': 50,
+                 '_Book__year_published': 2015, '_UserBook__in_collections': {'user': ['old']}}
+        self._add_pickled_collection({1234567893: PickledBook(state)})
+        self.assertEqual(migrate_pickled_database(self.db_path), 1)
+        with SQLSession(self.db_path) as session:
+            in_collections = Book.by_isbn(session, 1234567893).in_collections
+            self.assertIsInstance(in_collections, collections.defaultdict)
+            self.assertEqual(dict(in_collections), {'user': ['old']})
+
+    def test25_migrate_disallowed_global_fail(self):
+        self._add_pickled_collection({1234567893: collections.OrderedDict()})
+        with self.assertRaises(MigrationError):
+            migrate_pickled_database(self.db_path)
+        with SQLSession(self.db_path) as session:
+            self.assertIsNotNone(session.execute(sqlalchemy.text(
+                'SELECT _BookCollection__book_collection FROM book_collection')).scalar())
+
+    def test26_setup_duplicate_isbns_fail(self):
+        index_name = next(index.name for index in Book.__table__.indexes if index.unique)
+        with SQLSession(self.db_path) as session:
+            session.execute(sqlalchemy.text('DROP INDEX {}'.format(index_name)))
+            session.add(Book(isbn=1234567890, title='title', author='author',
+                             genre='genre', no_of_pages=50, year_published=2015))
+            session.commit()
+        with self.assertRaisesRegex(MigrationError, '1234567890'):
+            setup_database(self.db_path)
+
+
 if __name__ == '__main__':
     unittest.main()
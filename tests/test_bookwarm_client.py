@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+
+import os
+import tempfile
+import unittest
+import unittest.mock
+from bookwarm_frames import FrameReader, encode_frame
+from bookwarm_client import BookWarmClient
+
+
+class FakeTransport:
+
+    def __init__(self):
+        self.frames = FrameReader()
+        self.requests = []
+
+    def write(self, data):
+        self.requests.extend(frame.decode('utf-8') for frame in self.frames.feed(data))
+
+    def close(self):
+        pass
+
+
+@unittest.mock.patch('bookwarm_client.IMPORT_FRAME_RECORDS', 2)
+@unittest.mock.patch('bookwarm_client.IMPORT_FRAMES_IN_FLIGHT', 2)
+class TestBulkImport(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'books.txt')
+        self.transport = FakeTransport()
+        self.client = BookWarmClient('test user')
+        self.client.connection_made(self.transport)
+        self.transport.requests.clear()
+        self.menu = unittest.mock.patch.object(self.client, '_books_menu_options').start()
+        unittest.mock.patch.object(self.client, '_BookWarmClient__get_str_or_cancel',
+                                   return_value=self.path).start()
+        self.print = unittest.mock.patch('builtins.print').start()
+
+    def tearDown(self):
+        unittest.mock.patch.stopall()
+        self.folder.cleanup()
+
+    def write_records(self, count):
+        with open(self.path, 'w', encoding='utf-8') as fh:
+            fh.writelines('{} title author genre 100 2000 1 publisher\n'.format(isbn)
+                          for isbn in range(1234567890, 1234567890 + count))
+
+    def ack(self, reply):
+        self.client.data_received(encode_frame('FUNC  _bulk_added  ' + reply))
+
+    def test01_frames_wait_for_acks_success(self):
+        self.write_records(5)
+        self.client._bulk_import()
+        self.assertEqual(len(self.transport.requests), 2)
+        self.ack('2 0')
+        self.assertEqual(len(self.transport.requests), 3)
+        self.assertEqual(self.transport.requests[-1].split('  ')[1],
+                         '1234567894 title author genre 100 2000 1 publisher')
+        self.ack('1 1\n2: Duplicate ISBN 1234567893.')
+        self.print.assert_called_with('Record 4: Duplicate ISBN 1234567893.')
+        self.menu.assert_not_called()
+        self.ack('1 0')
+        self.print.assert_called_with('Imported 4 books, 1 failed.')
+        self.menu.assert_called_once_with()
+        self.assertIsNone(self.client._import_state)
+
+    def test02_empty_file_fail(self):
+        self.write_records(0)
+        self.client._bulk_import()
+        self.assertEqual(self.transport.requests, [])
+        self.print.assert_called_with('Nothing to import.')
+        self.menu.assert_called_once_with()
+
+    def test03_missing_file_fail(self):
+        self.client._bulk_import()
+        self.assertEqual(self.transport.requests, [])
+        self.assertTrue(self.print.call_args[0][0].startswith('Cannot import: '))
+
+    def test04_multiline_failure_ignored_success(self):
+        self.write_records(1)
+        self.client._bulk_import()
+        self.ack('0 1\n1: (sqlite3.IntegrityError) UNIQUE constraint failed\n'
+                 '[SQL: INSERT INTO book]')
+        self.print.assert_any_call('Record 1: (sqlite3.IntegrityError) UNIQUE constraint failed')
+        self.print.assert_called_with('Imported 0 books, 1 failed.')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+
+import unittest
+from bookwarm import Book, UserBook, BookCollection, BookCatalog, BookRecord
+from bookwarm_columnar import ColumnarBooks
+
+
+class TestColumnarBooks(unittest.TestCase):
+
+    def setUp(self):
+        self.books = [UserBook(isbn=1234567890, title='title', author='author1', genre='scifi',
+                               no_of_pages=100, year_published=1995, rating=5),
+                      UserBook(isbn=1234567891, title='title1', author='author1', genre='scifi',
+                               no_of_pages=300, year_published=1985, rating=4),
+                      UserBook(isbn=1234567892, title='title2', author='author2', genre='drama',
+                               no_of_pages=200, year_published=1999, rating=3)]
+        self.collection = BookCollection('user', 'coll', {book.isbn: book for book in self.books})
+        self.columns = ColumnarBooks.from_collection(self.collection)
+
+    def test01_len_success(self):
+        self.assertEqual(len(self.columns), 3)
+
+    def test02_filter_equality_and_ranges_success(self):
+        self.assertEqual(list(self.columns.filter(genre='scifi', year_published=(1990, 2000),
+                                                  rating=(4, None))), [1234567890])
+
+    def test03_filter_unknown_category_success(self):
+        self.assertEqual(len(self.columns.filter(genre='poetry')), 0)
+
+    def test04_filter_invalid_column_fail(self):
+        with self.assertRaises(KeyError):
+            self.columns.filter(invalid=1)
+
+    def test05_sum_by_success(self):
+        self.assertEqual(self.columns.sum_by('no_of_pages', by='genre'),
+                         {'scifi': 400, 'drama': 200})
+
+    def test06_mean_by_success(self):
+        self.assertEqual(self.columns.mean_by('rating', by='author'),
+                         {'author1': 4.5, 'author2': 3})
+
+    def test07_count_by_with_filter_success(self):
+        self.assertEqual(self.columns.count_by('genre', year_published=(None, 1996)),
+                         {'scifi': 2})
+
+    def test08_from_catalog_success(self):
+        catalog = BookCatalog([Book(isbn=1234567893, title='title3', author='author',
+                                    genre='genre', no_of_pages=50, year_published=2015)])
+        columns = ColumnarBooks.from_catalog(catalog)
+        self.assertEqual(columns.sum_by('rating', by='genre'), {'genre': 0})
+
+    def test09_from_catalog_null_fields_success(self):
+        catalog = BookCatalog([BookRecord(1234567893, 'title3', 'author', 'genre', None,
+                                          2015, 1, None),
+                               BookRecord(1234567894, 'title4', 'author', 'genre', 50,
+                                          None, 1, 'publisher')])
+        columns = ColumnarBooks.from_catalog(catalog)
+        self.assertEqual(list(columns.valid('no_of_pages')), [False, True])
+        self.assertEqual(list(columns.filter(no_of_pages=(0, None))), [1234567894])
+        self.assertEqual(list(columns.filter(year_published=2015)), [1234567893])
+        self.assertEqual(columns.mean_by('no_of_pages', by='genre'), {'genre': 50})
+        self.assertEqual(columns.count_by('publisher'), {None: 1, 'publisher': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
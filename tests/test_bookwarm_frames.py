@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+
+
+import unittest
+import bookwarm_frames
+from bookwarm_frames import FrameReader, FrameError, encode_frame, split_page_token
+
+
+class TestFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = FrameReader()
+
+    def test01_single_frame_success(self):
+        self.assertEqual(self.reader.feed(encode_frame('a  None  main_menu')),
+                         [b'a  None  main_menu'])
+
+    def test02_coalesced_frames_success(self):
+        data = encode_frame('first') + encode_frame('second') + encode_frame('')
+        self.assertEqual(self.reader.feed(data), [b'first', b'second', b''])
+
+    def test03_split_frame_success(self):
+        data = encode_frame('zażółć  gęślą  jaźń')
+        frames = []
+        for byte in range(len(data)):
+            frames.extend(self.reader.feed(data[byte:byte + 1]))
+        self.assertEqual([frame.decode('utf-8') for frame in frames], ['zażółć  gęślą  jaźń'])
+        self.assertEqual(len(self.reader), 0)
+
+    def test04_partial_frame_buffered(self):
+        data = encode_frame('first') + encode_frame('second')
+        self.assertEqual(self.reader.feed(data[:-2]), [b'first'])
+        self.assertEqual(self.reader.feed(data[-2:]), [b'second'])
+
+    def test05_oversized_frame_fail(self):
+        reader = FrameReader(max_frame_size=4)
+        with self.assertRaises(FrameError):
+            reader.feed(encode_frame('too long'))
+
+    def test06_encode_oversized_frame_fail(self):
+        with self.assertRaises(FrameError):
+            encode_frame('x' * (bookwarm_frames.MAX_FRAME_SIZE + 1))
+
+    def test07_split_page_token_success(self):
+        self.assertEqual(split_page_token('1234567890\n1234567891\nnext_page=1234567891'),
+                         ('1234567890\n1234567891', '1234567891'))
+
+    def test08_split_page_token_last_page_success(self):
+        self.assertEqual(split_page_token('1234567890\n1234567891'),
+                         ('1234567890\n1234567891', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
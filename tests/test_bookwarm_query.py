@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+
+import unittest
+from bookwarm import Book, UserBook, BookCollection, BookCatalog, BookRecord
+from bookwarm_query import Query, query
+
+
+class TestQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.books = [UserBook(isbn=1234567890, title='title', author='author1', genre='scifi',
+                               no_of_pages=100, year_published=1995, rating=5, read=True),
+                      UserBook(isbn=1234567891, title='title1', author='author1', genre='scifi',
+                               no_of_pages=300, year_published=1985, rating=4),
+                      UserBook(isbn=1234567892, title='title2', author='author2', genre='drama',
+                               no_of_pages=200, year_published=1999, rating=3)]
+        self.books[0].add_tag('favourite')
+        self.books[0].add_tag('space')
+        self.books[2].add_tag('favourite')
+        self.collection = BookCollection('user', 'coll', {book.isbn: book for book in self.books})
+        self.catalog = BookCatalog(self.books)
+
+    def test01_equality_and_range_success(self):
+        self.assertEqual(list(query(self.collection, genre='scifi', year_published=(1990, 2000))),
+                         [self.books[0]])
+
+    def test02_residual_predicates_success(self):
+        self.assertEqual(list(query(self.collection, no_of_pages=(150, None), rating=(None, 3))),
+                         [self.books[2]])
+        self.assertEqual(list(query(self.collection, read=False)), self.books[1:])
+
+    def test03_tags_success(self):
+        self.assertEqual(list(query(self.collection, tags='favourite')),
+                         [self.books[0], self.books[2]])
+        self.assertEqual(list(query(self.collection, tags={'favourite', 'space'})),
+                         [self.books[0]])
+
+    def test04_plan_most_selective_success(self):
+        plan = Query(author='author1', year_published=(1998, None)).plan(self.collection)
+        self.assertEqual(plan, ('year_published', 1998, None))
+
+    def test05_plan_full_scan_success(self):
+        self.assertEqual(Query(rating=(4, 5)).plan(self.collection), ('isbn', None, None))
+
+    def test06_order_by_limit_success(self):
+        self.assertEqual(list(query(self.collection, order_by='no_of_pages', limit=2)),
+                         [self.books[0], self.books[2]])
+        self.assertEqual(list(query(self.collection, order_by='year_published', limit=1,
+                                    descending=True)), [self.books[2]])
+
+    def test07_invalid_predicate_fail(self):
+        with self.assertRaises(KeyError):
+            Query(invalid=1)
+
+    def test08_catalog_success(self):
+        self.assertEqual([record.isbn for record in query(self.catalog, author='author1',
+                                                          order_by='year_published')],
+                         [1234567891, 1234567890])
+
+    def test09_catalog_index_follows_changes_success(self):
+        self.assertEqual(self.catalog.index_count('genre', 'scifi', 'scifi'), 2)
+        self.catalog.discard(1234567890)
+        self.catalog.put(Book(isbn=1234567893, title='title3', author='author3', genre='scifi',
+                              no_of_pages=50, year_published=2015))
+        self.assertEqual(self.catalog.index_range('genre', 'scifi', 'scifi'),
+                         [1234567891, 1234567893])
+
+    def test10_catalog_missing_fields_fail(self):
+        for predicates in (dict(tags='favourite'), dict(read=True), dict(order_by='rating')):
+            with self.assertRaisesRegex(KeyError, 'not stored'):
+                query(self.catalog, **predicates)
+
+    def test11_order_by_null_values_success(self):
+        catalog = BookCatalog(self.books + [BookRecord(1234567893, 'title3', 'author3', None,
+                                                       None, 2001, 1, None)])
+        self.assertEqual([record.isbn for record in query(catalog, order_by='genre')],
+                         [1234567892, 1234567890, 1234567891, 1234567893])
+        self.assertEqual([record.isbn for record in query(catalog, order_by='no_of_pages',
+                                                          limit=2, descending=True)],
+                         [1234567891, 1234567892])
+        self.assertEqual([record.isbn for record in query(catalog, order_by='publisher',
+                                                          limit=1)], [1234567890])
+
+
+if __name__ == '__main__':
+    unittest.main()
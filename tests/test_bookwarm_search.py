@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+
+import os
+import tempfile
+import unittest
+from bookwarm import Book, UserBook, BookCatalog
+from bookwarm_search import InvertedIndex, tokenize
+
+
+class TestInvertedIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.books = [UserBook(isbn=1234567890, title='War and Peace', author='Leo Tolstoy',
+                               genre='novel', no_of_pages=1225, year_published=1869),
+                      UserBook(isbn=1234567891, title='Peace Talks', author='Jim Butcher',
+                               genre='fantasy', no_of_pages=340, year_published=2020),
+                      Book(isbn=1234567892, title='The Art of War', author='Sun Tzu',
+                           genre='strategy', no_of_pages=100, year_published=2000)]
+        self.books[1].add_note('Dresden files, war with the Fomor')
+        self.search_index = InvertedIndex(self.books)
+
+    def test01_tokenize_success(self):
+        self.assertEqual(tokenize('War, and_PEACE!'), ['war', 'and', 'peace'])
+
+    def test02_search_and_success(self):
+        self.assertEqual([isbn for isbn, _ in self.search_index.search('peace WAR')],
+                         [1234567890, 1234567891])
+
+    def test03_search_or_ranked_success(self):
+        found = [isbn for isbn, _ in self.search_index.search('tolstoy art', mode='or')]
+        self.assertEqual(sorted(found), [1234567890, 1234567892])
+        self.assertEqual(self.search_index.search('war', limit=1)[0][0], 1234567890)
+
+    def test04_search_no_match_success(self):
+        self.assertEqual(self.search_index.search('dickens war'), [])
+        self.assertEqual(self.search_index.search(''), [])
+
+    def test05_search_invalid_mode_fail(self):
+        with self.assertRaises(AssertionError):
+            self.search_index.search('war', mode='xor')
+
+    def test06_update_and_discard_success(self):
+        self.books[0].add_note('read in the summer')
+        self.search_index.add(self.books[0])
+        self.assertEqual([isbn for isbn, _ in self.search_index.search('summer')], [1234567890])
+        self.search_index.discard(1234567890)
+        self.assertEqual([isbn for isbn, _ in self.search_index.search('peace')], [1234567891])
+        self.assertNotIn(1234567890, self.search_index)
+        self.assertEqual(self.search_index.search('tolstoy'), [])
+
+    def test07_save_load_success(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'search.json')
+            self.search_index.save(path)
+            loaded = InvertedIndex.load(path)
+        self.assertEqual(loaded.isbns(), self.search_index.isbns())
+        self.assertEqual(loaded.search('war', mode='or'), self.search_index.search('war', mode='or'))
+
+    def test08_load_missing_file_fail(self):
+        with self.assertRaises(EnvironmentError):
+            InvertedIndex.load(os.path.join(tempfile.gettempdir(), 'no_such_index.json'))
+
+    def test09_from_catalog_success(self):
+        search_index = InvertedIndex(BookCatalog(self.books))
+        self.assertEqual([isbn for isbn, _ in search_index.search('sun tzu')], [1234567892])
+
+    def test10_search_pages_success(self):
+        ranked = self.search_index.search('war', mode='or')
+        self.assertEqual(self.search_index.search('war', mode='or', limit=2), ranked[:2])
+        self.assertEqual(self.search_index.search('war', mode='or', limit=2, offset=2),
+                         ranked[2:])
+
+    def test11_add_with_notes_success(self):
+        search_index = InvertedIndex(BookCatalog(self.books))
+        self.assertEqual(search_index.search('fomor'), [])
+        search_index.add(BookCatalog(self.books)[1234567891], ['war with the Fomor'])
+        self.assertEqual([isbn for isbn, _ in search_index.search('fomor')], [1234567891])
+
+    def test12_save_load_stamp_success(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'search.json')
+            self.search_index.save(path, stamp=[3, 12345])
+            self.assertEqual(InvertedIndex.load(path).stamp, [3, 12345])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,341 @@
+#!/usr/bin/python3
+
+
+import os
+import pickle
+import asyncio
+import collections
+import tempfile
+import unittest
+import unittest.mock
+import sqlalchemy
+import bookwarm
+from bookwarm_frames import FrameReader, encode_frame
+import bookwarm_server
+from bookwarm_server import BookWarmServer
+from bookwarm_serverproto import ServerProtocol
+
+
+class FakeTransport:
+
+    def __init__(self):
+        self.frames = FrameReader()
+        self.replies = []
+        self.closed = False
+
+    def write(self, data):
+        self.replies.extend(frame.decode('utf-8') for frame in self.frames.feed(data))
+
+    def close(self):
+        self.closed = True
+
+
+class ServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.loop = asyncio.new_event_loop()
+        self.server = BookWarmServer('test server', 'localhost', 0, self.loop,
+                                     db_workers=2, data_folder=self.folder.name)
+        self.db = self.server.async_db
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.close()
+        self.folder.cleanup()
+
+    def run_coro(self, coro):
+        return self.loop.run_until_complete(coro)
+
+
+class TestAsyncBookWarmDB(ServerTestCase):
+
+    def test01_add_and_find_book_success(self):
+        self.assertEqual(self.run_coro(self.db.add_new_book(
+            '1234567890 title author genre 100 2000 1 publisher')), (True, ''))
+        found = self.run_coro(self.db.find_book_by_isbn(1234567890))
+        self.assertEqual((found.isbn, found.title), (1234567890, 'title'))
+        self.assertIn(1234567890, self.server.all_books)
+
+    def test02_add_invalid_book_fail(self):
+        add_success, add_err = self.run_coro(self.db.add_new_book('1234567890 title'))
+        self.assertFalse(add_success)
+        self.assertIsInstance(add_err, Exception)
+
+    def test03_update_and_delete_book_success(self):
+        self.run_coro(self.db.add_new_book('1234567890 title author genre 100 2000 1 publisher'))
+        self.assertEqual(self.run_coro(self.db.update_book('1234567890', '2', 'None')),
+                         (True, ''))
+        self.assertEqual(self.server.all_books[1234567890].edition, 2)
+        self.assertEqual(self.run_coro(self.db.delete_book('1234567890')), (True, ''))
+        self.assertFalse(self.run_coro(self.db.find_book_by_isbn(1234567890)))
+        self.assertNotIn(1234567890, self.server.tag_index)
+
+    def test04_search_books_pages_success(self):
+        for isbn in range(1234567890, 1234567895):
+            self.run_coro(self.db.add_new_book(
+                '{} war author genre 100 2000 1 publisher'.format(isbn)))
+        found, next_offset = self.run_coro(self.db.search_books('war', limit=3))
+        self.assertEqual((len(found), next_offset), (3, 3))
+        found, next_offset = self.run_coro(self.db.search_books('war', offset=3, limit=3))
+        self.assertEqual((len(found), next_offset), (2, None))
+
+    def test05_collections_success(self):
+        self.assertEqual(self.run_coro(self.db.add_new_collection('test user', 'reading')),
+                         (True, ''))
+        collections = self.run_coro(self.db.get_user_collections('test user'))
+        self.assertEqual([collection.collection_name for collection in collections],
+                         ['reading'])
+        self.assertEqual(self.run_coro(self.db.get_collection_books('test user', 'reading')), [])
+        self.assertEqual(self.run_coro(self.db.delete_collection('test user', 'reading')),
+                         (True, ''))
+        self.assertIsNone(self.run_coro(self.db.get_collection_books('test user', 'reading')))
+
+    def test06_export_books_fail(self):
+        export_success, export_err = self.run_coro(self.db.export_books(
+            os.path.join(self.folder.name, 'missing', 'books.jsonl')))
+        self.assertFalse(export_success)
+        self.assertIsInstance(export_err, str)
+
+
+class TestBookWarmServer(ServerTestCase):
+
+    def restart(self, **kwargs):
+        self.server.close()
+        self.server = BookWarmServer('test server', 'localhost', 0, self.loop, db_workers=2,
+                                     data_folder=self.folder.name, **kwargs)
+
+    def database_stamp(self):
+        with bookwarm.SQLSession(self.server._database_path) as session:
+            return bookwarm.Book.catalog_stamp(session)
+
+    def test01_catalog_in_step_after_changes_success(self):
+        self.server.add_new_book('1234567890 title author genre 100 2000 1 publisher')
+        self.server.bulk_add_books(['1234567891 title author genre 100 2000 1 publisher'])
+        self.server.update_book('1234567890', '2', 'None')
+        self.server.delete_book('1234567891')
+        self.assertEqual(self.server.all_books.stamp(), self.database_stamp())
+
+    def test02_restart_sees_outside_edit_success(self):
+        self.server.add_new_book('1234567890 title author genre 100 2000 1 publisher')
+        with bookwarm.SQLSession(self.server._database_path) as session:
+            bookwarm.Book.by_isbn(session, 1234567890).publisher = 'other'
+            session.commit()
+        self.restart()
+        self.assertEqual(self.server.all_books[1234567890].publisher, 'other')
+
+    def test03_second_writer_runs_read_only_success(self):
+        self.server.add_new_book('1234567890 title author genre 100 2000 1 publisher')
+        catalog_path = self.server._catalog_path()
+        self.server.close()
+        writer = bookwarm.MappedBookCatalog(catalog_path)
+        try:
+            self.server = BookWarmServer('test server', 'localhost', 0, self.loop,
+                                         db_workers=2, data_folder=self.folder.name)
+            self.assertTrue(self.server.read_only)
+            self.assertIn(1234567890, self.server.all_books)
+            self.assertFalse(self.server.delete_book('1234567890')[0])
+            self.assertEqual(self.server.bulk_add_books(['x']),
+                             (0, [(0, bookwarm_server.READ_ONLY_ERROR)]))
+        finally:
+            writer.close()
+
+    def test04_bad_pickled_column_exits_fail(self):
+        with bookwarm.SQLSession(self.server._database_path) as session:
+            session.execute(sqlalchemy.text(
+                'ALTER TABLE book_collection ADD COLUMN _BookCollection__book_collection BLOB'))
+            session.execute(sqlalchemy.text(
+                "INSERT INTO book_collection (user, collection_name, "
+                "_BookCollection__book_collection) VALUES ('user', 'old', :blob)"),
+                dict(blob=pickle.dumps(collections.OrderedDict())))
+            session.commit()
+        with unittest.mock.patch('builtins.print') as print_mock:
+            with self.assertRaises(SystemExit):
+                self.restart()
+        self.assertIn('cannot migrate', print_mock.call_args[0][0])
+
+    def test05_bulk_add_books_failures_success(self):
+        self.server.add_new_book('1234567890 title author genre 100 2000 1 publisher')
+        records = ['{} title author genre 100 2000 1 publisher'.format(isbn) for isbn in
+                   (1234567890, 1234567891)] + ['', 'garbage'] + [
+                  '{} title author genre 100 2000 1 publisher'.format(isbn) for isbn in
+                   (1234567891, 1234567892, 1234567892)]
+        added, failures = self.server.bulk_add_books(records, batch_size=2)
+        self.assertEqual(added, 2)
+        self.assertEqual([record_no for record_no, _ in failures], [1, 4, 5, 7])
+        self.assertEqual(failures[0][1], 'ISBN 1234567890 already in DB.')
+        self.assertEqual(failures[2][1], 'ISBN 1234567891 already in DB.')
+        self.assertEqual(failures[3][1], 'Duplicate ISBN 1234567892.')
+        self.assertIn(1234567892, self.server.all_books)
+        self.assertIn(1234567892, self.server.tag_index)
+        self.assertEqual(self.server.all_books.stamp(), self.database_stamp())
+
+    def test06_insert_books_rolls_back_fail(self):
+        with unittest.mock.patch.object(bookwarm.Book, 'column_values',
+                                        side_effect=RuntimeError('no insert')):
+            self.assertEqual(self.server.bulk_add_books(
+                ['1234567890 title author genre 100 2000 1 publisher']),
+                (0, [(1, 'no insert')]))
+        self.assertNotIn(1234567890, self.server.all_books)
+        self.assertEqual(self.server.all_books.stamp(), self.database_stamp())
+
+    def test07_integrity_error_one_line_fail(self):
+        self.server.add_new_book('1234567890 title author genre 100 2000 1 publisher')
+        with unittest.mock.patch.object(bookwarm.Book, 'existing_isbns', return_value=[]):
+            added, failures = self.server.bulk_add_books(
+                ['1234567890 title author genre 100 2000 1 publisher'])
+        self.assertEqual(added, 0)
+        (record_no, error), = failures
+        self.assertEqual(record_no, 1)
+        self.assertIn('UNIQUE constraint failed', error)
+        self.assertNotIn('\n', error)
+
+
+    def test08_read_only_server_follows_writer_success(self):
+        # a second server in this process shares the first one's engine
+        with unittest.mock.patch('bookwarm.configure_engine'):
+            reader = BookWarmServer('test server', 'localhost', 0, self.loop, db_workers=2,
+                                    data_folder=self.folder.name)
+        try:
+            self.assertTrue(reader.read_only)
+            self.server.add_new_book('1234567890 war author genre 100 2000 1 publisher')
+            self.assertNotIn(1234567890, reader.all_books)
+            reader.refresh_catalog()
+            self.assertIn(1234567890, reader.all_books)
+            self.assertIn(1234567890, reader.tag_index)
+            self.assertEqual([book.isbn for book, _ in reader.search_books('war')[0]],
+                             [1234567890])
+            self.server.delete_book('1234567890')
+            reader.refresh_catalog()
+            self.assertEqual(reader.all_books.isbns(), [])
+            self.assertEqual(reader.search_books('war'), ([], None))
+        finally:
+            reader.close()
+
+class TestServerProtocol(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.transport = FakeTransport()
+        self.protocol = ServerProtocol(self.server)
+        self.protocol.connection_made(self.transport)
+        self.assertEqual(self.request('test user'), 'OK  main_menu  ')
+
+    def tearDown(self):
+        self.protocol.connection_lost(None)
+        self.run_coro(asyncio.sleep(0))
+        super().tearDown()
+
+    def request(self, text):
+        replies = len(self.transport.replies)
+        self.protocol.data_received(encode_frame(text))
+
+        async def reply():
+            while len(self.transport.replies) == replies:
+                await asyncio.sleep(0.005)
+            return self.transport.replies[-1]
+
+        return self.run_coro(asyncio.wait_for(reply(), 5))
+
+    def add_books(self, count, title='title'):
+        for isbn in range(1234567890, 1234567890 + count):
+            self.server.add_new_book('{} {} author genre 100 2000 1 publisher'.format(isbn, title))
+
+    def test01_show_books_empty_success(self):
+        self.assertEqual(self.request('a  None  main_menu'), 'RE  empty_books_menu  Empty')
+
+    def test02_show_books_pages_success(self):
+        self.add_books(3)
+        self.assertEqual(self.request('a  None 2  main_menu'),
+                         'RE  books_menu  1234567890\n1234567891\nnext_page=1234567891')
+        self.assertEqual(self.request('a  1234567891 2  main_menu'),
+                         'RE  books_menu  1234567892')
+
+    def test03_malformed_request_fail(self):
+        self.assertTrue(self.request('garbage').startswith('RE  main_menu  Server Error: '))
+        self.assertEqual(self.request('a  None  main_menu'), 'RE  empty_books_menu  Empty')
+
+    def test04_unknown_command_fail(self):
+        self.assertTrue(self.request('x  None  main_menu').startswith(
+            'RE  main_menu  Server Error: '))
+        self.assertTrue(self.request('a  None  no_menu').startswith(
+            'RE  main_menu  Server Error: '))
+        self.assertFalse(self.transport.closed)
+
+    def test05_handler_error_fail(self):
+        self.assertEqual(self.request('e  reading  collections_menu'),
+                         'RE  main_menu  Server Error: NotImplementedError')
+        self.assertTrue(self.request('e  1234567890  books_menu').startswith(
+            'RE  main_menu  Server Error: '))
+        self.assertEqual(self.request('a  None  main_menu'), 'RE  empty_books_menu  Empty')
+
+    def test06_add_and_view_book_success(self):
+        self.assertEqual(self.request(
+            'a  1234567890 title author genre 100 2000 1 publisher  books_menu'),
+            'RE  books_menu  Book added.')
+        self.assertEqual(self.request('v  1234567890  books_menu'),
+                         'RE  books_menu  1234567890 title\n')
+        self.assertEqual(self.request('f  1234567890 _add_new_book  books_menu'),
+                         'FUNC  _add_new_book  ')
+
+    def test07_search_pages_success(self):
+        with unittest.mock.patch('bookwarm_serverproto.DEFAULT_PAGE_SIZE', 2):
+            self.add_books(3, title='war')
+            first = self.request('s  war  books_menu')
+            self.assertTrue(first.endswith('\nnext_page=2'))
+            self.assertEqual(len(self.request('s  next_page=2 war  books_menu').split('\n')), 1)
+        self.assertEqual(self.request('s  peace  books_menu'), 'RE  books_menu  No matches.')
+
+    def test08_tag_query_pages_success(self):
+        with unittest.mock.patch('bookwarm_serverproto.DEFAULT_PAGE_SIZE', 2):
+            self.add_books(3)
+            self.assertEqual(self.request('t  -scifi  books_menu'),
+                             'RE  books_menu  1234567890 title\n1234567891 title\n'
+                             'next_page=1234567891')
+            self.assertEqual(self.request('t  next_page=1234567891 -scifi  books_menu'),
+                             'RE  books_menu  1234567892 title')
+
+    def test09_oversized_reply_refused_fail(self):
+        self.add_books(20)
+        with unittest.mock.patch('bookwarm_frames.MAX_FRAME_SIZE', 100):
+            reply = self.request('a  None  main_menu')
+        self.assertTrue(reply.startswith('RE  books_menu  Reply of '))
+        self.assertFalse(self.transport.closed)
+
+    def test10_second_connection_same_user_fail(self):
+        transport = FakeTransport()
+        protocol = ServerProtocol(self.server)
+        protocol.connection_made(transport)
+        protocol.data_received(encode_frame('test user'))
+        self.run_coro(asyncio.sleep(0.05))
+        self.assertEqual(transport.replies[0].split('  ')[:2], ['FUNC', 'quit'])
+        self.assertTrue(transport.closed)
+        protocol.connection_lost(None)
+
+
+    def test11_bulk_import_reply_success(self):
+        self.assertEqual(self.request('i  1234567890 title author genre 100 2000 1 publisher\n'
+                                      '1234567890 title author genre 100 2000 1 publisher  '
+                                      'books_menu'),
+                         'FUNC  _bulk_added  1 1\n2: Duplicate ISBN 1234567890.')
+
+    def test12_pipelined_requests_answered_in_order_success(self):
+        self.protocol.data_received(b''.join(encode_frame(text) for text in (
+            'a  1234567890 title author genre 100 2000 1 publisher  books_menu',
+            'v  1234567890  books_menu',
+            'garbage',
+            'a  None  main_menu')))
+
+        async def replies():
+            while len(self.transport.replies) < 5:
+                await asyncio.sleep(0.005)
+
+        self.run_coro(asyncio.wait_for(replies(), 5))
+        self.assertEqual(self.transport.replies[1:3], ['RE  books_menu  Book added.',
+                                                       'RE  books_menu  1234567890 title\n'])
+        self.assertTrue(self.transport.replies[3].startswith('RE  main_menu  Server Error: '))
+        self.assertEqual(self.transport.replies[4], 'RE  books_menu  1234567890')
+
+
+if __name__ == '__main__':
+    unittest.main()